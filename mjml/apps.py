@@ -1,31 +1,11 @@
 from django.apps import AppConfig
-from django.core.exceptions import ImproperlyConfigured
 
 from mjml import settings as mjml_settings
-from mjml.tools import mjml_render
+from mjml.backends import get_backend_class
+from mjml.checks import check_mjml_command, start_background_check
+from mjml.stats import enable_stats
 
-
-def check_mjml_command() -> None:
-    try:
-        html = mjml_render(
-            '<mjml><mj-body><mj-container><mj-text>'
-            'MJMLv3'
-            '</mj-text></mj-container></mj-body></mjml>'
-        )
-    except RuntimeError:
-        try:
-            html = mjml_render(
-                '<mjml><mj-body><mj-section><mj-column><mj-text>'
-                'MJMLv4'
-                '</mj-text></mj-column></mj-section></mj-body></mjml>'
-            )
-        except RuntimeError as e:
-            raise ImproperlyConfigured(e) from e
-    if '<html ' not in html:
-        raise ImproperlyConfigured(
-            'mjml command returns wrong result.\n'
-            'Check MJML is installed correctly. See https://github.com/mjmlio/mjml#installation'
-        )
+__all__ = ('check_mjml_command', 'MJMLConfig')
 
 
 class MJMLConfig(AppConfig):
@@ -33,5 +13,12 @@ class MJMLConfig(AppConfig):
     verbose_name = 'Use MJML in Django templates'
 
     def ready(self) -> None:
-        if mjml_settings.MJML_BACKEND_MODE == 'cmd' and mjml_settings.MJML_CHECK_CMD_ON_STARTUP:
-            check_mjml_command()
+        for mode in [mjml_settings.MJML_BACKEND_MODE] + list(mjml_settings.MJML_FALLBACK_BACKEND_MODES):
+            get_backend_class(mode)  # raise ImproperlyConfigured if the backend is wrong
+        if mjml_settings.MJML_STATS:
+            enable_stats()
+        if mjml_settings.MJML_BACKEND_MODE == 'cmd':
+            if mjml_settings.MJML_CHECK_CMD_ON_STARTUP is True:
+                check_mjml_command()
+            elif mjml_settings.MJML_CHECK_CMD_ON_STARTUP == 'background':
+                start_background_check()
@@ -0,0 +1,186 @@
+import asyncio
+import concurrent.futures
+import os
+from typing import Any, Dict, List, Type, Union
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from mjml import settings as mjml_settings
+from mjml import tools
+from mjml.checks import get_mjml_command_version
+from mjml.instrumentation import measure
+
+
+class BaseMJMLBackend:
+    """
+    Base class of backends which compile MJML to HTML.
+
+    The library calls the backend via mjml_render(), so the render cache, coalescing of renders, fallbacks
+    and render stats work for any backend. A subclass must implement render(), other methods are optional:
+
+        class MyBackend(BaseMJMLBackend):
+            def render(self, mjml_source: str) -> str:
+                ...
+
+        MJML_BACKEND = 'myproject.mjml.MyBackend'
+
+    render() should raise RuntimeError on MJML errors and mjml.tools.BackendUnavailableError if it can't render
+    at the moment, then the render is passed to the next backend of settings.MJML_FALLBACK_BACKEND_MODES.
+    Backend instance is shared by all threads of the process.
+    """
+    # render_many() compiles several sources faster than separate renders
+    batch_render = False
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def render(self, mjml_source: str) -> str:
+        raise NotImplementedError
+
+    async def render_async(self, mjml_source: str) -> str:
+        return await asyncio.to_thread(self.render, mjml_source)
+
+    def render_many(self, mjml_sources: List[str], max_workers: int) -> List[Union[str, Exception]]:
+        """
+        Return HTML or an exception for every source in the same order.
+        """
+        def render(mjml_source: str) -> Union[str, Exception]:
+            try:
+                return self.render(mjml_source)
+            except Exception as e:
+                return e
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            return list(executor.map(render, mjml_sources))
+
+    def is_circuit_open(self) -> bool:
+        """
+        Return True if the backend is known to be broken now, so it's skipped if there are fallback backends.
+        """
+        return False
+
+    def get_max_workers(self) -> int:
+        """
+        Return the number of renders which the backend can process at the same time (default of mjml_render_many).
+        """
+        return os.cpu_count() or 1
+
+    def get_identity(self) -> Any:
+        """
+        Return configuration which affects the result (it's a part of the render cache key).
+        """
+        return None
+
+
+class CMDBackend(BaseMJMLBackend):
+    @property
+    def batch_render(self) -> bool:
+        return mjml_settings.MJML_CMD_BATCH
+
+    def render(self, mjml_source: str) -> str:
+        tools._check_cmd_lazily()
+        with measure('compile'):
+            return tools._mjml_render_by_cmd(mjml_source)
+
+    async def render_async(self, mjml_source: str) -> str:
+        tools._check_cmd_lazily()
+        with measure('compile'):
+            return await tools._mjml_render_by_cmd_async(mjml_source)
+
+    def render_many(self, mjml_sources: List[str], max_workers: int) -> List[Union[str, Exception]]:
+        return tools._mjml_render_many_by_cmd(mjml_sources, max(min(max_workers, len(mjml_sources)), 1))
+
+    def get_identity(self) -> Any:
+        return mjml_settings.MJML_EXEC_CMD, get_mjml_command_version()
+
+
+class WorkerBackend(BaseMJMLBackend):
+    def render(self, mjml_source: str) -> str:
+        return tools._mjml_render_by_worker(mjml_source)
+
+    async def render_async(self, mjml_source: str) -> str:
+        return await tools._mjml_render_by_worker_async(mjml_source)
+
+    def get_max_workers(self) -> int:
+        return mjml_settings.MJML_WORKER_POOL_SIZE
+
+    def get_identity(self) -> Any:
+        return mjml_settings.MJML_WORKER_NODE_PATH, mjml_settings.MJML_WORKER_MJML_OPTIONS
+
+
+class TCPServerBackend(BaseMJMLBackend):
+    def render(self, mjml_source: str) -> str:
+        return tools._mjml_render_by_tcpserver(mjml_source)
+
+    async def render_async(self, mjml_source: str) -> str:
+        return await tools._mjml_render_by_tcpserver_async(mjml_source)
+
+    def is_circuit_open(self) -> bool:
+        keys = [tools._get_tcpserver_key(server) for server in mjml_settings.MJML_TCPSERVERS]
+        return tools._get_server_health().is_open(keys)
+
+    def get_max_workers(self) -> int:
+        return len(mjml_settings.MJML_TCPSERVERS) * max(mjml_settings.MJML_TCPSERVER_POOL_SIZE, 1)
+
+    def get_identity(self) -> Any:
+        return sorted(tools._get_tcpserver_key(server) for server in mjml_settings.MJML_TCPSERVERS)
+
+
+class HTTPServerBackend(BaseMJMLBackend):
+    def render(self, mjml_source: str) -> str:
+        return tools._mjml_render_by_httpserver(mjml_source)
+
+    async def render_async(self, mjml_source: str) -> str:
+        return await tools._mjml_render_by_httpserver_async(mjml_source)
+
+    def is_circuit_open(self) -> bool:
+        keys = [tools._get_httpserver_key(server_conf) for server_conf in mjml_settings.MJML_HTTPSERVERS]
+        return tools._get_server_health().is_open(keys)
+
+    def get_max_workers(self) -> int:
+        return len(mjml_settings.MJML_HTTPSERVERS) * mjml_settings.MJML_HTTPSERVER_POOL_SIZE
+
+    def get_identity(self) -> Any:
+        return sorted(server_conf['URL'] for server_conf in mjml_settings.MJML_HTTPSERVERS)
+
+
+# names of backends which can be used in settings.MJML_BACKEND_MODE and settings.MJML_FALLBACK_BACKEND_MODES
+_registry: Dict[str, Union[str, Type[BaseMJMLBackend]]] = {
+    'cmd': CMDBackend,
+    'worker': WorkerBackend,
+    'tcpserver': TCPServerBackend,
+    'httpserver': HTTPServerBackend,
+}
+
+
+def register_backend(name: str, backend_class: Union[str, Type[BaseMJMLBackend]]) -> None:
+    """
+    Register the backend class (or dotted path to it) under a short name.
+    """
+    _registry[name] = backend_class
+    tools._cache.pop(('backend', name), None)
+
+
+def get_backend_class(name: str) -> Type[BaseMJMLBackend]:
+    """
+    Return the backend class by registered name or dotted path.
+    """
+    backend_class = _registry.get(name)
+    if backend_class is None and '.' not in name:
+        raise ImproperlyConfigured(
+            f'Unknown MJML backend "{name}". Use one of {", ".join(sorted(_registry))} '
+            'or dotted path to a subclass of mjml.backends.BaseMJMLBackend.'
+        )
+    if backend_class is None or isinstance(backend_class, str):
+        try:
+            backend_class = import_string(backend_class or name)
+        except ImportError as e:
+            raise ImproperlyConfigured(f'Can\'t import MJML backend "{name}": {e}') from e
+    if not (isinstance(backend_class, type) and issubclass(backend_class, BaseMJMLBackend)):
+        raise ImproperlyConfigured(f'MJML backend "{name}" is not a subclass of mjml.backends.BaseMJMLBackend.')
+    return backend_class
+
+
+def get_backend(name: str) -> BaseMJMLBackend:
+    return tools._get_process_local(('backend', name), lambda: get_backend_class(name)(name))
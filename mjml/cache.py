@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+from django.utils.encoding import force_bytes
+
+from mjml import settings as mjml_settings
+
+logger = logging.getLogger('mjml')
+
+
+def normalize_source(mjml_source: str) -> str:
+    return mjml_source.replace('\r\n', '\n').strip()
+
+
+def get_backend_identity() -> str:
+    from mjml.backends import get_backend
+    mode = mjml_settings.MJML_BACKEND_MODE
+    return f'{mode}|{get_backend(mode).get_identity()!r}'
+
+
+def get_cache_key(mjml_source: str) -> str:
+    h = hashlib.sha256()
+    h.update(force_bytes(get_backend_identity()))
+    h.update(b'\0')
+    h.update(force_bytes(mjml_settings.MJML_CACHE.get('VERSION', '')))
+    h.update(b'\0')
+    h.update(force_bytes(normalize_source(mjml_source)))
+    return h.hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU storage limited by number of entries and total size of values in bytes.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (value, value size in bytes)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, value: str) -> None:
+        value_size = len(force_bytes(value))
+        if value_size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._data[key] = (value, value_size)
+            self._size += value_size
+            while len(self._data) > self.max_entries or self._size > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self._size -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+
+class RenderCache:
+    """
+    Two-tier cache of compiled HTML: in-process LRU and optional Django cache backend.
+    The Django cache is best-effort: its errors are logged and the render goes on as if it's a miss.
+    """
+
+    def __init__(self, config: Dict) -> None:
+        self.local = LRUCache(
+            max_entries=config.get('MAX_ENTRIES', 1000),
+            max_bytes=config.get('MAX_BYTES', 64 * 1024 * 1024),
+        )
+        self.shared_alias: Optional[str] = config.get('BACKEND')
+        self.timeout: Optional[int] = config.get('TIMEOUT', 86400)
+        self.key_prefix: str = config.get('KEY_PREFIX', 'mjml')
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'shared_errors': 0}
+
+    @property
+    def shared(self):
+        if self.shared_alias is None:
+            return None
+        from django.core.cache import caches
+        return caches[self.shared_alias]
+
+    def _incr(self, *names: str) -> None:
+        with self._lock:
+            for name in names:
+                self._stats[name] += 1
+
+    def get(self, key: str) -> Optional[str]:
+        html = self.local.get(key)
+        if html is not None:
+            self._incr('hits', 'local_hits')
+            return html
+        shared = self.shared
+        if shared is not None:
+            try:
+                html = shared.get(f'{self.key_prefix}:{key}')
+            except Exception as e:
+                self._log_shared_error('get', e)
+            if html is not None:
+                self.local.set(key, html)
+                self._incr('hits', 'shared_hits')
+                return html
+        self._incr('misses')
+        return None
+
+    def set(self, key: str, html: str) -> None:
+        self.local.set(key, html)
+        shared = self.shared
+        if shared is not None:
+            try:
+                shared.set(f'{self.key_prefix}:{key}', html, self.timeout)
+            except Exception as e:
+                self._log_shared_error('set', e)
+
+    def _log_shared_error(self, operation: str, error: Exception) -> None:
+        self._incr('shared_errors')
+        logger.warning('MJML render cache: %s in Django cache "%s" failed: %r', operation, self.shared_alias, error)
+
+    def get_or_render(self, mjml_source: str, render_func: Callable[[str], str]) -> str:
+        key = get_cache_key(mjml_source)
+        html = self.get(key)
+        if html is None:
+            html = render_func(mjml_source)
+            self.set(key, html)
+        return html
+
+    def get_or_render_many(self, mjml_sources: List[str],
+                           render_many_func: Callable[[List[str]], List[Union[str, Exception]]],
+                           ) -> List[Union[str, Exception]]:
+        keys = [get_cache_key(mjml_source) for mjml_source in mjml_sources]
+        results = [self.get(key) for key in keys]
+        missed = [i for i, html in enumerate(results) if html is None]
+        if missed:
+            for i, html in zip(missed, render_many_func([mjml_sources[i] for i in missed])):
+                results[i] = html
+                if not isinstance(html, Exception):
+                    self.set(keys[i], html)
+        return results
+
+    async def get_or_render_async(self, mjml_source: str, render_func: Callable[[str], Awaitable[str]]) -> str:
+        key = get_cache_key(mjml_source)
+        if self.shared_alias is None:
+            html = self.get(key)
+        else:
+            html = await asyncio.to_thread(self.get, key)
+        if html is None:
+            html = await render_func(mjml_source)
+            if self.shared_alias is None:
+                self.set(key, html)
+            else:
+                await asyncio.to_thread(self.set, key, html)
+        return html
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['entries'] = len(self.local)
+        stats['bytes'] = self.local.size
+        return stats
+
+    def clear(self) -> None:
+        self.local.clear()
+        with self._lock:
+            for name in self._stats:
+                self._stats[name] = 0
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Dict, Optional
+
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_str
+
+from mjml import settings as mjml_settings
+from mjml.tools import _cache, _get_cmd_args, _get_cmd_batch_args, _mjml_render_by_cmd
+
+logger = logging.getLogger('mjml')
+
+_check_lock = threading.Lock()
+
+CHECK_SOURCES = (
+    (4, '<mjml><mj-body><mj-section><mj-column><mj-text>MJMLv4</mj-text></mj-column></mj-section></mj-body></mjml>'),
+    (3, '<mjml><mj-body><mj-container><mj-text>MJMLv3</mj-text></mj-container></mj-body></mjml>'),
+)
+
+
+def _get_check_cache_key() -> Optional[str]:
+    """
+    Return a key which changes when the command or the executable file is changed,
+    or None if the executable can't be found (the command is checked every time then).
+    """
+    cmd_args = _get_cmd_args()
+    path = shutil.which(cmd_args[0])
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = json.dumps([cmd_args, path, stat.st_mtime, stat.st_size])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _read_check_cache() -> Dict[str, Dict]:
+    try:
+        with open(mjml_settings.MJML_CHECK_CMD_CACHE_FILE, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _write_check_cache(key: str, result: Dict) -> None:
+    path = mjml_settings.MJML_CHECK_CMD_CACHE_FILE
+    data = _read_check_cache()
+    data[key] = result
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or None, prefix='.mjml-check-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass  # the cache is optional
+
+
+def check_mjml_command() -> int:
+    """
+    Check that mjml command works and return major version of MJML.
+    The result is cached in settings.MJML_CHECK_CMD_CACHE_FILE until the command or the executable is changed.
+    """
+    cache_key = None
+    if mjml_settings.MJML_CHECK_CMD_CACHE_FILE is not None:
+        cache_key = _get_check_cache_key()
+        if cache_key is not None:
+            result = _read_check_cache().get(cache_key)
+            if result is not None:
+                return result['version']
+
+    error = None
+    for version, mjml_source in CHECK_SOURCES:
+        try:
+            html = _mjml_render_by_cmd(mjml_source)
+        except RuntimeError as e:
+            error = e
+            continue
+        if '<html ' not in html:
+            raise ImproperlyConfigured(
+                'mjml command returns wrong result.\n'
+                'Check MJML is installed correctly. See https://github.com/mjmlio/mjml#installation'
+            )
+        break
+    else:
+        raise ImproperlyConfigured(error) from error
+
+    if cache_key is not None:
+        _write_check_cache(cache_key, {'version': version, 'cmd': _get_cmd_args()})
+    return version
+
+
+def _run_mjml_version_command() -> str:
+    try:
+        p = subprocess.run(_get_cmd_batch_args() + ['--version'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL, timeout=60)
+    except (OSError, subprocess.SubprocessError):
+        return ''
+    return force_str(p.stdout).strip() if p.returncode == 0 else ''
+
+
+def get_mjml_command_version() -> str:
+    """
+    Return versions of MJML packages printed by "mjml --version" or empty string if they can't be got.
+    It's a part of the render cache key, so HTML of the old MJML isn't used after update of MJML.
+    The result is cached like the result of check_mjml_command.
+    """
+    version = _cache.get('cmd_version')
+    if version is not None:
+        return version
+    cache_key = None
+    if mjml_settings.MJML_CHECK_CMD_CACHE_FILE is not None:
+        cache_key = _get_check_cache_key()
+        if cache_key is not None:
+            result = _read_check_cache().get(f'{cache_key}:version')
+            if result is not None:
+                version = _cache['cmd_version'] = result['version']
+                return version
+    version = _run_mjml_version_command()
+    if version and cache_key is not None:
+        _write_check_cache(f'{cache_key}:version', {'version': version})
+    _cache['cmd_version'] = version
+    return version
+
+
+def check_mjml_command_once() -> None:
+    """
+    Check mjml command once per process (for lazy and background checks).
+    Raise ImproperlyConfigured on every call if the command doesn't work.
+    """
+    result = _cache.get('cmd_check')
+    if result is None:
+        with _check_lock:
+            result = _cache.get('cmd_check')
+            if result is None:
+                try:
+                    check_mjml_command()
+                    result = True
+                except ImproperlyConfigured as e:
+                    result = e
+                _cache['cmd_check'] = result
+    if isinstance(result, ImproperlyConfigured):
+        raise result
+
+
+def _check_mjml_command_in_background() -> None:
+    try:
+        check_mjml_command_once()
+    except ImproperlyConfigured as e:
+        logger.error('MJML command check failed: %s', e)
+
+
+def start_background_check() -> threading.Thread:
+    thread = threading.Thread(target=_check_mjml_command_in_background, name='mjml-check', daemon=True)
+    thread.start()
+    return thread
+
+
+@checks.register('mjml', deploy=True)
+def check_mjml_setup(app_configs, **kwargs):
+    errors = []
+    if mjml_settings.MJML_BACKEND_MODE == 'cmd':
+        try:
+            check_mjml_command()
+        except ImproperlyConfigured as e:
+            errors.append(checks.Error(
+                f'mjml command doesn\'t work: {e}',
+                hint='Check settings.MJML_EXEC_CMD and that MJML is installed.',
+                id='mjml.E001',
+            ))
+    return errors
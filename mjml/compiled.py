@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+from django.utils.encoding import force_bytes
+
+from mjml import settings as mjml_settings
+from mjml.cache import normalize_source
+from mjml.tools import _cache
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def get_compiled_key(mjml_source: str) -> str:
+    return hashlib.sha256(force_bytes(normalize_source(mjml_source))).hexdigest()
+
+
+class CompiledManifest:
+    """
+    Directory with HTML compiled by mjml_compile command: manifest.json and <key>.html file per MJML source.
+    HTML files are read on the first use.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._html: Dict[str, str] = {}
+        try:
+            with open(os.path.join(path, MANIFEST_FILENAME), encoding='utf-8') as f:
+                self.entries: Dict[str, List[str]] = json.load(f)['entries']
+        except FileNotFoundError:
+            self.entries = {}
+
+    def get(self, mjml_source: str) -> Optional[str]:
+        key = get_compiled_key(mjml_source)
+        if key not in self.entries:
+            return None
+        html = self._html.get(key)
+        if html is None:
+            with open(os.path.join(self.path, f'{key}.html'), encoding='utf-8') as f:
+                html = f.read()
+            with self._lock:
+                self._html[key] = html
+        return html
+
+    @classmethod
+    def save(cls, path: str, compiled: Dict[str, str], templates: Dict[str, List[str]]) -> None:
+        """
+        Write HTML of MJML sources (compiled: mjml_source -> html) and manifest with names of templates
+        which contain the sources. Files of sources which aren't in the new manifest are removed.
+        """
+        os.makedirs(path, exist_ok=True)
+        entries = {}
+        for mjml_source, html in compiled.items():
+            key = get_compiled_key(mjml_source)
+            with open(os.path.join(path, f'{key}.html'), 'w', encoding='utf-8') as f:
+                f.write(html)
+            entries[key] = sorted(templates.get(mjml_source, []))
+        for filename in os.listdir(path):
+            if filename.endswith('.html') and filename[:-5] not in entries:
+                os.remove(os.path.join(path, filename))
+        tmp_path = os.path.join(path, f'{MANIFEST_FILENAME}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'entries': entries}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, os.path.join(path, MANIFEST_FILENAME))
+
+
+def get_compiled_manifest() -> Optional[CompiledManifest]:
+    if mjml_settings.MJML_COMPILED_DIR is None:
+        return None
+    if 'compiled_manifest' not in _cache:
+        _cache['compiled_manifest'] = CompiledManifest(mjml_settings.MJML_COMPILED_DIR)
+    return _cache['compiled_manifest']
+
@@ -0,0 +1,175 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Sequence
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ServerHealth:
+    def __init__(self) -> None:
+        self.latency: Optional[float] = None  # EWMA of response time in seconds
+        self.recent_latencies = deque(maxlen=100)
+        self.in_flight = 0
+        self.failures = 0  # consecutive failures
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+
+    def is_available(self, now: float, recovery_timeout: float) -> bool:
+        if self.state == OPEN and now - self.opened_at >= recovery_timeout:
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN:
+            return not self.probing  # only one request checks whether the server is alive again
+        return self.state == CLOSED
+
+    def get_score(self) -> float:
+        return (self.latency or 0.0) * (self.in_flight + 1)
+
+
+class ServerHealthRegistry:
+    """
+    Thread-safe registry of servers health.
+
+    It tracks EWMA of latency and number of requests in progress for each server to choose the server
+    by "power of two choices" and it works as a circuit breaker: a server is excluded after failure_threshold
+    consecutive failures and after recovery_timeout seconds one probe request is allowed to check it.
+    """
+
+    def __init__(self, ewma_alpha: float, failure_threshold: int, recovery_timeout: float,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.ewma_alpha = ewma_alpha
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.clock = clock
+        self._servers: Dict[Hashable, ServerHealth] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key: Hashable) -> ServerHealth:
+        health = self._servers.get(key)
+        if health is None:
+            health = self._servers[key] = ServerHealth()
+        return health
+
+    def get_servers_order(self, servers: Sequence[Any], key: Callable[[Any], Hashable]) -> List[Any]:
+        """
+        Return servers in order they should be tried. Servers with open circuit are skipped
+        unless all of them have open circuit.
+        """
+        with self._lock:
+            now = self.clock()
+            scores = []
+            available, broken = [], []
+            for i, server in enumerate(servers):
+                health = self._get(key(server))
+                scores.append(health.get_score())
+                (available if health.is_available(now, self.recovery_timeout) else broken).append(i)
+        if not available:
+            available, broken = broken, []
+        if len(available) > 1:
+            a, b = random.sample(available, 2)
+            first = a if scores[a] <= scores[b] else b
+            available = [first] + sorted((i for i in available if i != first), key=lambda i: scores[i])
+        return [servers[i] for i in available]
+
+    def is_open(self, keys: Sequence[Hashable]) -> bool:
+        """
+        Return True if circuits of all the servers are open, so none of them would be tried by a healthy order.
+        """
+        if not keys:
+            return False
+        with self._lock:
+            now = self.clock()
+            for key in keys:
+                health = self._servers.get(key)
+                if health is None or health.state == CLOSED:
+                    return False
+                if health.state == OPEN and now - health.opened_at >= self.recovery_timeout:
+                    return False
+                if health.state == HALF_OPEN and not health.probing:
+                    return False
+            return True
+
+    def begin(self, key: Hashable) -> None:
+        with self._lock:
+            health = self._get(key)
+            health.in_flight += 1
+            if health.state == HALF_OPEN:
+                health.probing = True
+
+    def record_success(self, key: Hashable, latency: float) -> None:
+        with self._lock:
+            health = self._get(key)
+            health.in_flight = max(health.in_flight - 1, 0)
+            health.recent_latencies.append(latency)
+            if health.latency is None:
+                health.latency = latency
+            else:
+                health.latency += self.ewma_alpha * (latency - health.latency)
+            health.failures = 0
+            health.state = CLOSED
+            health.probing = False
+
+    def record_failure(self, key: Hashable) -> None:
+        with self._lock:
+            health = self._get(key)
+            health.in_flight = max(health.in_flight - 1, 0)
+            health.failures += 1
+            if health.state == HALF_OPEN or health.failures >= self.failure_threshold:
+                health.state = OPEN
+                health.opened_at = self.clock()
+            health.probing = False
+
+    def record_cancel(self, key: Hashable) -> None:
+        """
+        The request has been cancelled (e.g. it has lost to a hedged request), it says nothing about the server.
+        """
+        with self._lock:
+            health = self._get(key)
+            health.in_flight = max(health.in_flight - 1, 0)
+            health.probing = False
+
+    def get_latency_percentile(self, key: Hashable, percentile: float, min_samples: int = 10) -> Optional[float]:
+        """
+        Return percentile of recent response times of the server or None if there are not enough samples.
+        """
+        with self._lock:
+            latencies = sorted(self._get(key).recent_latencies)
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+
+    @contextmanager
+    def track(self, key: Hashable) -> Iterator[None]:
+        """
+        Track request to the server: any exception except cancellation is a failure of the server.
+        """
+        self.begin(key)
+        started_at = self.clock()
+        try:
+            yield
+        except asyncio.CancelledError:
+            self.record_cancel(key)
+            raise
+        except BaseException:
+            self.record_failure(key)
+            raise
+        self.record_success(key, self.clock() - started_at)
+
+    def get_stats(self) -> Dict[Hashable, Dict[str, Any]]:
+        with self._lock:
+            return {
+                key: {
+                    'latency': health.latency,
+                    'in_flight': health.in_flight,
+                    'failures': health.failures,
+                    'state': health.state,
+                }
+                for key, health in self._servers.items()
+            }
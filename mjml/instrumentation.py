@@ -0,0 +1,95 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+from mjml.signals import render_finished
+
+_current_render_info: contextvars.ContextVar = contextvars.ContextVar('mjml_render_info', default=None)
+
+
+class RenderInfo:
+    """
+    Details of one render which are sent with render_finished signal.
+    """
+
+    def __init__(self, backend: str, input_size: int) -> None:
+        self.backend = backend
+        self.fallbacks = 0  # backends of settings.MJML_FALLBACK_BACKEND_MODES which have been tried
+        self.server: Optional[str] = None  # the server which has returned the result
+        self.attempts = 0  # requests to servers (failovers and hedged requests are counted too)
+        self.timeouts = 0
+        self.cache: Optional[str] = None  # None (cache is disabled), 'hit' or 'miss'
+        self.coalesced = False  # the result of the same concurrent render has been used
+        self.batch_size = 1  # number of sources compiled by the same run of mjml command
+        self.input_size = input_size  # bytes
+        self.output_size: Optional[int] = None  # bytes
+        self.duration: Optional[float] = None  # seconds
+        self.timings: Dict[str, float] = {}  # seconds of phases: queue, connect, transfer, compile
+        self.error: Optional[BaseException] = None
+
+    def add_timing(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+
+def get_render_info() -> Optional[RenderInfo]:
+    return _current_render_info.get()
+
+
+def is_enabled() -> bool:
+    return render_finished.has_listeners()
+
+
+@contextmanager
+def measure(name: str) -> Iterator[None]:
+    """
+    Add time of the block to the timing of the current render (if it is tracked).
+    """
+    info = _current_render_info.get()
+    if info is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        info.add_timing(name, time.perf_counter() - start)
+
+
+def send_render_info(info: RenderInfo) -> None:
+    render_finished.send(sender=RenderInfo, info=info)
+
+
+@contextmanager
+def track_render(backend: str, mjml_source: str) -> Iterator[RenderInfo]:
+    info = RenderInfo(backend, len(mjml_source.encode('utf-8')))
+    token = _current_render_info.set(info)
+    start = time.perf_counter()
+    try:
+        yield info
+    except BaseException as e:
+        info.error = e
+        raise
+    finally:
+        info.duration = time.perf_counter() - start
+        _current_render_info.reset(token)
+        send_render_info(info)
+
+
+@contextmanager
+def track_attempt(server: str, timeout_errors: Tuple) -> Iterator[None]:
+    """
+    Count the request to the server for the current render (if it is tracked).
+    """
+    info = _current_render_info.get()
+    if info is None:
+        yield
+        return
+    info.attempts += 1
+    try:
+        yield
+    except timeout_errors:
+        info.timeouts += 1
+        raise
+    if info.server is None:
+        info.server = server
@@ -0,0 +1,69 @@
+import os
+from typing import Dict, Optional
+
+from django.template.base import Lexer, TokenType
+from django.template.loaders.cached import Loader as CachedLoader
+
+
+def get_mjml_template_code(contents: str) -> str:
+    """
+    Wrap code of .mjml template by mjml tag. The template which extends another one isn't changed,
+    because the parent template is compiled with the blocks of the child.
+    """
+    for token in Lexer(contents).tokenize():
+        if token.token_type == TokenType.BLOCK:
+            if token.split_contents()[0] == 'extends':
+                return contents
+            break
+    return '{% load mjml %}{% mjml precompile %}' + contents + '{% endmjml %}'
+
+
+class Loader(CachedLoader):
+    """
+    Cached loader which compiles templates with .mjml extension as MJML.
+    The template without variables and tags is compiled to HTML on load, the other one is precompiled if it is possible
+    (see precompile mode of mjml tag). In debug mode .mjml templates are reloaded when the file is changed.
+
+        'loaders': [
+            ('mjml.loaders.Loader', [
+                'django.template.loaders.filesystem.Loader',
+                'django.template.loaders.app_directories.Loader',
+            ]),
+        ]
+    """
+    extensions = ('.mjml',)
+
+    def __init__(self, engine, loaders) -> None:
+        super().__init__(engine, loaders)
+        self.mtimes: Dict[str, Optional[float]] = {}
+
+    def is_mjml_template(self, template_name) -> bool:
+        return str(template_name).endswith(self.extensions)
+
+    @staticmethod
+    def _get_mtime(origin) -> Optional[float]:
+        try:
+            return os.path.getmtime(origin.name)
+        except (OSError, TypeError, ValueError):
+            return None
+
+    def get_contents(self, origin) -> str:
+        if not self.is_mjml_template(origin.template_name):
+            return super().get_contents(origin)
+        mtime = self._get_mtime(origin)
+        contents = get_mjml_template_code(super().get_contents(origin))
+        self.mtimes[origin.name] = mtime
+        return contents
+
+    def get_template(self, template_name, skip=None):
+        template = super().get_template(template_name, skip)
+        if self.engine.debug and self.is_mjml_template(template_name):
+            mtime = self._get_mtime(template.origin)
+            if mtime != self.mtimes.get(template.origin.name):
+                self.get_template_cache.pop(self.cache_key(template_name, skip), None)
+                template = super().get_template(template_name, skip)
+        return template
+
+    def reset(self) -> None:
+        super().reset()
+        self.mtimes.clear()
@@ -0,0 +1,114 @@
+import os
+from typing import Dict, Iterator, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template import Template, TemplateSyntaxError, engines
+from django.template.backends.django import DjangoTemplates
+from django.template.base import Origin
+
+from mjml import settings as mjml_settings
+from mjml.compiled import CompiledManifest
+from mjml.loaders import Loader as MJMLLoader, get_mjml_template_code
+from mjml.templatetags.mjml import MJMLRenderNode
+from mjml.tools import mjml_render_many
+
+
+class Command(BaseCommand):
+    help = (
+        'Compile static mjml blocks and precompile skeletons of all templates (including .mjml templates) '
+        'to the directory which is used instead of the backend at runtime (settings.MJML_COMPILED_DIR).'
+    )
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            '-o', '--output', default=mjml_settings.MJML_COMPILED_DIR,
+            help='Output directory (default: settings.MJML_COMPILED_DIR).',
+        )
+        parser.add_argument(
+            '-e', '--extension', action='append', dest='extensions',
+            help='Extension of template files (default: html, txt and mjml). Can be used several times.',
+        )
+        parser.add_argument(
+            '-w', '--workers', type=int, default=None,
+            help='Number of concurrent renders (default depends on the backend mode).',
+        )
+
+    def handle(self, *args, **options) -> None:
+        output = options['output']
+        if not output:
+            raise CommandError('Set output directory by --output or settings.MJML_COMPILED_DIR.')
+        extensions = tuple(f'.{e.lstrip(".")}' for e in (options['extensions'] or ('html', 'txt', 'mjml')))
+        verbosity = options['verbosity']
+
+        templates: Dict[str, List[str]] = {}
+        for name, mjml_source in self.find_sources(extensions, verbosity):
+            templates.setdefault(mjml_source, []).append(name)
+        if verbosity >= 1:
+            self.stdout.write(f'Found {len(templates)} MJML sources, compiling...')
+
+        mjml_sources = list(templates)
+        results = mjml_render_many(mjml_sources, max_workers=options['workers'], return_exceptions=True)
+        compiled = {}
+        failed = 0
+        for mjml_source, html in zip(mjml_sources, results):
+            if isinstance(html, Exception):
+                failed += 1
+                self.stderr.write(f'Error in {", ".join(sorted(set(templates[mjml_source])))}: {html}')
+            else:
+                compiled[mjml_source] = html
+        CompiledManifest.save(output, compiled, templates)
+        if verbosity >= 1:
+            self.stdout.write(f'Compiled {len(compiled)} MJML sources to {output}')
+        if failed:
+            raise CommandError(f'{failed} MJML sources are not compiled.')
+
+    def get_loader_dirs(self, loader) -> List[str]:
+        """
+        Return template directories of the loader or of its child loaders (cached loader of Django < 3.2).
+        """
+        if hasattr(loader, 'get_dirs'):
+            return [str(template_dir) for template_dir in loader.get_dirs()]
+        template_dirs = []
+        for child_loader in getattr(loader, 'loaders', []):
+            template_dirs.extend(self.get_loader_dirs(child_loader))
+        return template_dirs
+
+    def get_template_dirs(self) -> List[Tuple[DjangoTemplates, str]]:
+        template_dirs = []
+        for engine in engines.all():
+            if not isinstance(engine, DjangoTemplates):
+                continue
+            for loader in engine.engine.template_loaders:
+                for template_dir in self.get_loader_dirs(loader):
+                    if (engine, template_dir) not in template_dirs:
+                        template_dirs.append((engine, template_dir))
+        if not template_dirs:
+            raise CommandError('Template directories are not found, check loaders of settings.TEMPLATES.')
+        return template_dirs
+
+    def find_sources(self, extensions: Tuple[str, ...], verbosity: int) -> Iterator[Tuple[str, str]]:
+        """
+        Yield (template name, MJML source) for every mjml block which can be compiled without context
+        and for every .mjml template (see mjml.loaders.Loader).
+        """
+        for engine, template_dir in self.get_template_dirs():
+            for root, _, filenames in os.walk(template_dir):
+                for filename in sorted(filenames):
+                    if not filename.endswith(extensions):
+                        continue
+                    path = os.path.join(root, filename)
+                    name = os.path.relpath(path, template_dir).replace(os.sep, '/')
+                    try:
+                        with open(path, encoding='utf-8') as f:
+                            contents = f.read()
+                        if filename.endswith(MJMLLoader.extensions):
+                            contents = get_mjml_template_code(contents)
+                        tpl = Template(contents, origin=Origin(path, name), engine=engine.engine)
+                    except (UnicodeDecodeError, TemplateSyntaxError) as e:
+                        if verbosity >= 2:
+                            self.stderr.write(f'Skip template {path}: {e}')
+                        continue
+                    for node in tpl.nodelist.get_nodes_by_type(MJMLRenderNode):
+                        mjml_source = node.get_compile_source()
+                        if mjml_source is not None and mjml_source.strip():
+                            yield name, mjml_source
@@ -0,0 +1,64 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from mjml import settings as mjml_settings
+from mjml.stats import clear_stats, format_prometheus, get_histogram_quantile, get_stats_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        'Show stats of renders. Stats of all processes are available if settings.MJML_STATS_DIR is set, '
+        'otherwise only stats of this process are shown.'
+    )
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            '-f', '--format', choices=('text', 'json', 'prometheus'), default='text',
+            help='Output format (default: text).',
+        )
+        parser.add_argument('--clear', action='store_true', help='Remove collected stats.')
+
+    def handle(self, *args, **options) -> None:
+        if options['clear']:
+            clear_stats()
+            return
+        snapshot = get_stats_snapshot()
+        if options['format'] == 'json':
+            self.stdout.write(json.dumps(snapshot, indent=2))
+        elif options['format'] == 'prometheus':
+            self.stdout.write(format_prometheus(snapshot), ending='')
+        else:
+            self.write_text(snapshot)
+
+    def write_text(self, snapshot) -> None:
+        if not mjml_settings.MJML_STATS:
+            self.stderr.write('Stats are disabled, set settings.MJML_STATS = True.')
+        renders = {}
+        for name, labels, value in snapshot['counters']:
+            if name == 'mjml_renders_total':
+                row = renders.setdefault((labels['backend'], labels['server']), {'ok': 0, 'error': 0})
+                row[labels['status']] += value
+        if not renders:
+            self.stdout.write('No renders.')
+            return
+        self.stdout.write(f'{"backend":<12} {"server":<40} {"ok":>8} {"errors":>8} {"mean":>8} {"p50":>8} '
+                          f'{"p95":>8} {"p99":>8}')
+        durations = {
+            (labels['backend'], labels['server']): values
+            for name, labels, values in snapshot['histograms'] if name == 'mjml_render_duration_seconds'
+        }
+        for (backend, server), row in sorted(renders.items()):
+            values = durations.get((backend, server))
+            stats = ['-'] * 4
+            if values:
+                count = sum(values[:-1])
+                stats = [f'{values[-1] / count:.3f}'] + [
+                    f'{get_histogram_quantile(snapshot["buckets"], values, q):.3f}' for q in (0.5, 0.95, 0.99)
+                ]
+            self.stdout.write(f'{backend:<12} {server or "-":<40} {int(row["ok"]):>8} {int(row["error"]):>8} '
+                              + ' '.join(f'{s:>8}' for s in stats))
+        for name, labels, value in snapshot['counters']:
+            if name != 'mjml_renders_total' and value:
+                labels_str = ', '.join(f'{k}={v}' for k, v in labels.items())
+                self.stdout.write(f'{name} ({labels_str}): {int(value)}')
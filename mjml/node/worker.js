@@ -0,0 +1,60 @@
+'use strict';
+
+// MJML render worker used by django-mjml in "worker" backend mode.
+//
+// It reads requests from stdin and writes responses to stdout using the same framing as MJML TCP-Server:
+//   request:  9-digit length of body in bytes + body (MJML source)
+//   response: status ("0" - ok, "1" - error) + 9-digit length of body in bytes + body (HTML or error message)
+// The process exits when stdin is closed.
+//
+// Usage: node worker.js ['<JSON with mjml options>']
+
+const mjml2html = require('mjml');
+
+const options = process.argv[2] ? JSON.parse(process.argv[2]) : {};
+
+function frame(status, text) {
+  const body = Buffer.from(text, 'utf8');
+  return Buffer.concat([Buffer.from(status + String(body.length).padStart(9, '0'), 'ascii'), body]);
+}
+
+async function render(source) {
+  try {
+    const result = await mjml2html(source, options);
+    if (result.errors && result.errors.length) {
+      return frame('1', result.errors.map((e) => e.formattedMessage || e.message).join('\n'));
+    }
+    return frame('0', result.html);
+  } catch (e) {
+    return frame('1', String(e && e.stack ? e.stack : e));
+  }
+}
+
+let chunks = [];
+let bufferedLength = 0;
+let bodyLength = null;
+let queue = Promise.resolve();
+
+function take(n) {
+  const data = chunks.length === 1 ? chunks[0] : Buffer.concat(chunks, bufferedLength);
+  chunks = data.length > n ? [data.subarray(n)] : [];
+  bufferedLength = data.length - n;
+  return data.subarray(0, n);
+}
+
+process.stdin.on('data', (chunk) => {
+  chunks.push(chunk);
+  bufferedLength += chunk.length;
+  for (;;) {
+    if (bodyLength === null) {
+      if (bufferedLength < 9) break;
+      bodyLength = parseInt(take(9).toString('ascii'), 10);
+    }
+    if (bufferedLength < bodyLength) break;
+    const source = take(bodyLength).toString('utf8');
+    bodyLength = null;
+    queue = queue.then(() => render(source)).then((response) => {
+      process.stdout.write(response);
+    });
+  }
+});
@@ -0,0 +1,328 @@
+import asyncio
+import concurrent.futures
+import select
+import socket
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Dict, Optional, Tuple, Union
+
+# (host, port) of TCP socket or path of unix domain socket
+Address = Union[Tuple[str, int], str]
+
+
+class TCPConnectionPool:
+    """
+    Thread-safe pool of persistent connections to one MJML TCP-Server (TCP or unix domain socket).
+
+    Idle connections are reused in LIFO order. A connection is dropped on checkout if it has been idle
+    longer than idle_timeout or if the server has closed it. At most max_size idle connections are kept.
+    """
+
+    def __init__(self, address: Address, max_size: int, idle_timeout: float) -> None:
+        self.address = address
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = deque()  # (socket, time of release)
+        self._lock = threading.Lock()
+
+    def connect(self, timeout: float) -> socket.socket:
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def is_healthy(sock: socket.socket) -> bool:
+        # an idle connection must not be readable: readable means EOF (closed by server) or unexpected data
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def acquire(self, connect_timeout: float) -> Tuple[socket.socket, bool]:
+        """
+        Return (socket, reused).
+        """
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                sock, released_at = self._idle.pop()
+            if now - released_at <= self.idle_timeout and self.is_healthy(sock):
+                return sock, True
+            sock.close()
+        return self.connect(connect_timeout), False
+
+    def release(self, sock: socket.socket) -> None:
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    @staticmethod
+    def discard(sock: socket.socket) -> None:
+        sock.close()
+
+    def close(self) -> None:
+        with self._lock:
+            while self._idle:
+                sock, _ = self._idle.pop()
+                sock.close()
+
+
+class AsyncTCPConnectionPool:
+    """
+    Pool of persistent asyncio connections (reader, writer) to one MJML TCP-Server.
+    It must be used only in the event loop which has created it.
+    """
+
+    def __init__(self, address: Address, max_size: int, idle_timeout: float) -> None:
+        self.address = address
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = deque()  # ((reader, writer), time of release)
+
+    async def connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if isinstance(self.address, str):
+            return await asyncio.open_unix_connection(self.address)
+        return await asyncio.open_connection(*self.address)
+
+    @staticmethod
+    def is_healthy(conn: Tuple[asyncio.StreamReader, asyncio.StreamWriter]) -> bool:
+        reader, writer = conn
+        return not reader.at_eof() and not writer.is_closing()
+
+    async def acquire(self) -> Tuple[Tuple[asyncio.StreamReader, asyncio.StreamWriter], bool]:
+        """
+        Return ((reader, writer), reused).
+        """
+        now = time.monotonic()
+        while self._idle:
+            conn, released_at = self._idle.pop()
+            if now - released_at <= self.idle_timeout and self.is_healthy(conn):
+                return conn, True
+            self.discard(conn)
+        return await self.connect(), False
+
+    def release(self, conn: Tuple[asyncio.StreamReader, asyncio.StreamWriter]) -> None:
+        if len(self._idle) < self.max_size:
+            self._idle.append((conn, time.monotonic()))
+        else:
+            self.discard(conn)
+
+    @staticmethod
+    def discard(conn: Tuple[asyncio.StreamReader, asyncio.StreamWriter]) -> None:
+        conn[1].close()
+
+    def close(self) -> None:
+        while self._idle:
+            conn, _ = self._idle.pop()
+            self.discard(conn)
+
+
+def encode_body(body: bytes, compress_min_size: Optional[int], compress_level: int) -> Tuple[bytes, bytes]:
+    """
+    Return (body, encoding) for the frame of protocol 2, encoding is empty if compression isn't negotiated.
+    """
+    if compress_min_size is None:
+        return body, b''
+    if len(body) >= compress_min_size:
+        return zlib.compress(body, compress_level), b'z'
+    return body, b'0'
+
+
+def decode_response(status: bytes, encoding: bytes, result: bytes) -> Tuple[bool, str]:
+    if encoding == b'z':
+        try:
+            result = zlib.decompress(result)
+        except zlib.error as e:
+            raise ConnectionError(f'Wrong response from MJML TCP server: {e}') from e
+    elif encoding not in (b'', b'0'):
+        raise ConnectionError(f'Wrong response from MJML TCP server: unknown encoding {encoding!r}')
+    return status == b'0', result.decode('utf-8')
+
+
+class MultiplexedTCPConnection:
+    """
+    Connection to MJML TCP-Server which has accepted protocol 2: requests are sent with ids and can be in flight
+    at the same time, responses come in any order and are matched by id. The connection is shared by all threads,
+    responses are read by a background thread.
+
+    Request is 8 hex digits of id, 9 digits of length and MJML code.
+    Response is "0" (ok) or "1" (error), 8 hex digits of id, 9 digits of length and HTML or error message.
+    If compression has been negotiated (compress_min_size isn't None), the length is preceded by encoding of the body:
+    "z" (zlib) or "0" (not compressed). Requests not shorter than compress_min_size bytes are compressed.
+    """
+    MAX_REQUEST_ID = 16 ** 8
+
+    def __init__(self, sock: socket.socket, timeout: float, compress_min_size: Optional[int] = None,
+                 compress_level: int = 1) -> None:
+        self.sock = sock
+        self.sock.settimeout(timeout)  # timeout of sending, the reader waits for responses as long as necessary
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        self.closed = False
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._waiters: Dict[int, concurrent.futures.Future] = {}
+        self._last_request_id = 0
+        self._reader = threading.Thread(target=self._read_responses, name='mjml-tcpserver-reader', daemon=True)
+        self._reader.start()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._waiters)
+
+    def request(self, body: bytes, timeout: float) -> Tuple[bool, str]:
+        """
+        Send MJML code and return (ok, HTML or error message).
+        """
+        body, encoding = encode_body(body, self.compress_min_size, self.compress_level)
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self.closed:
+                raise ConnectionResetError('Connection to MJML TCP server is closed')
+            self._last_request_id = request_id = (self._last_request_id + 1) % self.MAX_REQUEST_ID
+            self._waiters[request_id] = future
+        try:
+            with self._send_lock:
+                self.sock.sendall(b'%08x%s%09d' % (request_id, encoding, len(body)))
+                self.sock.sendall(body)
+        except OSError as e:
+            self.close(e)  # a part of the request may be sent, the stream is broken
+            raise
+        try:
+            return decode_response(*future.result(timeout))
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                self._waiters.pop(request_id, None)  # the late response is dropped
+            raise socket.timeout('MJML TCP server has not responded in time') from None
+
+    def _recvall(self, n: int) -> Optional[bytearray]:
+        data = bytearray(n)
+        view = memoryview(data)
+        received = 0
+        while received < n:
+            try:
+                size = self.sock.recv_into(view[received:], n - received)
+            except socket.timeout:
+                if self.closed:
+                    return None
+                continue
+            if not size:
+                return None
+            received += size
+        return data
+
+    def _read_responses(self) -> None:
+        error = None
+        header_size = 18 if self.compress_min_size is None else 19
+        try:
+            while True:
+                header = self._recvall(header_size)
+                if header is None:
+                    break
+                result = self._recvall(int(header[-9:]))
+                if result is None:
+                    break
+                with self._lock:
+                    future = self._waiters.pop(int(header[1:9], 16), None)
+                if future is not None:
+                    future.set_result((bytes(header[:1]), bytes(header[9:-9]), result))
+        except (OSError, ValueError) as e:
+            error = e
+        self.close(error)
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            waiters, self._waiters = self._waiters, {}
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for future in waiters.values():
+            exc = ConnectionResetError(f'Connection closed by MJML TCP server{f": {error}" if error else ""}')
+            future.set_exception(exc)
+
+
+class AsyncMultiplexedTCPConnection:
+    """
+    Async version of MultiplexedTCPConnection. It must be used only in the event loop which has created it.
+    """
+    MAX_REQUEST_ID = MultiplexedTCPConnection.MAX_REQUEST_ID
+
+    def __init__(self, conn: Tuple[asyncio.StreamReader, asyncio.StreamWriter], compress_min_size: Optional[int] = None,
+                 compress_level: int = 1) -> None:
+        self.reader, self.writer = conn
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        self.closed = False
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._last_request_id = 0
+        self._reader_task = asyncio.ensure_future(self._read_responses())
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._waiters)
+
+    async def request(self, body: bytes, timeout: float) -> Tuple[bool, str]:
+        if self.closed:
+            raise ConnectionResetError('Connection to MJML TCP server is closed')
+        body, encoding = encode_body(body, self.compress_min_size, self.compress_level)
+        self._last_request_id = request_id = (self._last_request_id + 1) % self.MAX_REQUEST_ID
+        future = self._waiters[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            # the whole request is put into the buffer at once, so requests of different tasks aren't mixed
+            self.writer.writelines((b'%08x%s%09d' % (request_id, encoding, len(body)), body))
+            await asyncio.wait_for(self.writer.drain(), timeout=timeout)
+            return decode_response(*await asyncio.wait_for(asyncio.shield(future), timeout=timeout))
+        finally:
+            self._waiters.pop(request_id, None)
+
+    async def _read_responses(self) -> None:
+        error = None
+        header_size = 18 if self.compress_min_size is None else 19
+        try:
+            while True:
+                header = await self.reader.readexactly(header_size)
+                result = await self.reader.readexactly(int(header[-9:]))
+                future = self._waiters.pop(int(header[1:9], 16), None)
+                if future is not None and not future.done():
+                    future.set_result((header[:1], header[9:-9], result))
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            error = e
+        except asyncio.CancelledError:
+            pass
+        self._close(error)
+
+    def _close(self, error: Optional[BaseException] = None) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        waiters, self._waiters = self._waiters, {}
+        for future in waiters.values():
+            if not future.done():
+                exc = ConnectionResetError(f'Connection closed by MJML TCP server{f": {error}" if error else ""}')
+                future.set_exception(exc)
+
+    def close(self) -> None:
+        self._reader_task.cancel()
+        self._close()
@@ -1,17 +1,60 @@
+import os
+import tempfile
+
 from django.conf import settings
 
-MJML_BACKEND_MODE = getattr(settings, 'MJML_BACKEND_MODE', 'cmd')
-assert MJML_BACKEND_MODE in {'cmd', 'tcpserver', 'httpserver'}
+# name of registered backend (cmd, worker, tcpserver, httpserver) or dotted path to a subclass of BaseMJMLBackend,
+# backends are checked on startup (see mjml.backends)
+MJML_BACKEND_MODE = getattr(settings, 'MJML_BACKEND', None) or getattr(settings, 'MJML_BACKEND_MODE', 'cmd')
+assert isinstance(MJML_BACKEND_MODE, str)
+# backend modes which render when the previous ones are unavailable or busy, e.g. ['httpserver', 'cmd']
+MJML_FALLBACK_BACKEND_MODES = getattr(settings, 'MJML_FALLBACK_BACKEND_MODES', [])
+assert isinstance(MJML_FALLBACK_BACKEND_MODES, (list, tuple))
+assert all(isinstance(m, str) for m in MJML_FALLBACK_BACKEND_MODES)
+assert len({MJML_BACKEND_MODE, *MJML_FALLBACK_BACKEND_MODES}) == len(MJML_FALLBACK_BACKEND_MODES) + 1
+# max number of renders in progress per process by backend mode, e.g. {'tcpserver': 20}, others are not limited
+MJML_BACKEND_MAX_CONCURRENCY = getattr(settings, 'MJML_BACKEND_MAX_CONCURRENCY', {})
+assert isinstance(MJML_BACKEND_MAX_CONCURRENCY, dict)
+assert all(isinstance(v, int) and v > 0 for v in MJML_BACKEND_MAX_CONCURRENCY.values())
 
 # cmd backend mode configs
 MJML_EXEC_CMD = getattr(settings, 'MJML_EXEC_CMD', 'mjml')
-MJML_CHECK_CMD_ON_STARTUP = getattr(settings, 'MJML_CHECK_CMD_ON_STARTUP', True)
+MJML_CHECK_CMD_ON_STARTUP = getattr(settings, 'MJML_CHECK_CMD_ON_STARTUP', True)  # True, False, 'lazy', 'background'
+assert MJML_CHECK_CMD_ON_STARTUP in (True, False, 'lazy', 'background')
+MJML_CHECK_CMD_CACHE_FILE = getattr(settings, 'MJML_CHECK_CMD_CACHE_FILE',  # None - don't cache result of the check
+                                    os.path.join(tempfile.gettempdir(), 'django-mjml-check-cmd.json'))
+assert isinstance(MJML_CHECK_CMD_CACHE_FILE, (type(None), str))
+MJML_CMD_MAX_OUTPUT_SIZE = getattr(settings, 'MJML_CMD_MAX_OUTPUT_SIZE', 100 * 1024 * 1024)  # bytes, None - no limit
+assert MJML_CMD_MAX_OUTPUT_SIZE is None or (isinstance(MJML_CMD_MAX_OUTPUT_SIZE, int) and MJML_CMD_MAX_OUTPUT_SIZE > 0)
+MJML_CMD_BATCH = getattr(settings, 'MJML_CMD_BATCH', True)  # mjml_render_many() compiles files by a few mjml runs
+assert isinstance(MJML_CMD_BATCH, bool)
+
+# worker backend mode configs
+MJML_WORKER_NODE_CMD = getattr(settings, 'MJML_WORKER_NODE_CMD', 'node')
+MJML_WORKER_NODE_PATH = getattr(settings, 'MJML_WORKER_NODE_PATH', None)  # None or path to node_modules with mjml
+assert isinstance(MJML_WORKER_NODE_PATH, (type(None), str))
+MJML_WORKER_POOL_SIZE = getattr(settings, 'MJML_WORKER_POOL_SIZE', 2)
+assert isinstance(MJML_WORKER_POOL_SIZE, int) and MJML_WORKER_POOL_SIZE > 0
+MJML_WORKER_MAX_RENDERS = getattr(settings, 'MJML_WORKER_MAX_RENDERS', 1000)  # 0 - no limit
+assert isinstance(MJML_WORKER_MAX_RENDERS, int) and MJML_WORKER_MAX_RENDERS >= 0
+MJML_WORKER_MJML_OPTIONS = getattr(settings, 'MJML_WORKER_MJML_OPTIONS', {})  # options passed to mjml2html()
+assert isinstance(MJML_WORKER_MJML_OPTIONS, dict)
 
 # tcpserver backend mode configs
 MJML_TCPSERVERS = getattr(settings, 'MJML_TCPSERVERS', [('127.0.0.1', 28101)])
 assert isinstance(MJML_TCPSERVERS, (list, tuple))
 for t in MJML_TCPSERVERS:
-    assert isinstance(t, (list, tuple)) and len(t) == 2 and isinstance(t[0], str) and isinstance(t[1], int)
+    if isinstance(t, str):  # unix domain socket: 'unix:///path/to.sock'
+        assert t.startswith('unix://') and len(t) > len('unix://')
+    else:
+        assert isinstance(t, (list, tuple)) and len(t) == 2 and isinstance(t[0], str) and isinstance(t[1], int)
+MJML_TCPSERVER_POOL_SIZE = getattr(settings, 'MJML_TCPSERVER_POOL_SIZE', 10)  # 0 - don't keep connections
+assert isinstance(MJML_TCPSERVER_POOL_SIZE, int) and MJML_TCPSERVER_POOL_SIZE >= 0
+MJML_TCPSERVER_POOL_IDLE_TIMEOUT = getattr(settings, 'MJML_TCPSERVER_POOL_IDLE_TIMEOUT', 60)  # seconds
+assert isinstance(MJML_TCPSERVER_POOL_IDLE_TIMEOUT, (int, float))
+# 1 - one render per connection at a time, 'auto' - use multiplexed protocol 2 if the server supports it
+MJML_TCPSERVER_PROTOCOL = getattr(settings, 'MJML_TCPSERVER_PROTOCOL', 1)
+assert MJML_TCPSERVER_PROTOCOL in (1, 'auto')
 
 # httpserver backend mode configs
 MJML_HTTPSERVERS = getattr(settings, 'MJML_HTTPSERVERS', [{
@@ -27,3 +70,63 @@ for t in MJML_HTTPSERVERS:
         assert isinstance(http_auth, (type(None), list, tuple))
         if http_auth is not None:
             assert len(http_auth) == 2 and isinstance(http_auth[0], str) and isinstance(http_auth[1], str)
+    # compression of requests (see MJML_COMPRESSION_MIN_SIZE), the stock mjml-http-server doesn't support it
+    assert isinstance(t.get('COMPRESSION', False), bool)
+MJML_HTTPSERVER_POOL_SIZE = getattr(settings, 'MJML_HTTPSERVER_POOL_SIZE', 10)  # max keep-alive connections
+assert isinstance(MJML_HTTPSERVER_POOL_SIZE, int) and MJML_HTTPSERVER_POOL_SIZE > 0
+MJML_HTTPSERVER_MAX_RETRIES = getattr(settings, 'MJML_HTTPSERVER_MAX_RETRIES', 1)  # retries of failed connection
+assert isinstance(MJML_HTTPSERVER_MAX_RETRIES, int) and MJML_HTTPSERVER_MAX_RETRIES >= 0
+
+# compression of requests and responses (tcpserver with MJML_TCPSERVER_PROTOCOL = 'auto' and httpserver backend modes)
+# requests of this size in bytes and larger are compressed, None - don't compress
+MJML_COMPRESSION_MIN_SIZE = getattr(settings, 'MJML_COMPRESSION_MIN_SIZE', None)
+if MJML_COMPRESSION_MIN_SIZE is not None:
+    assert isinstance(MJML_COMPRESSION_MIN_SIZE, int) and MJML_COMPRESSION_MIN_SIZE >= 0
+MJML_COMPRESSION_LEVEL = getattr(settings, 'MJML_COMPRESSION_LEVEL', 1)  # 1 (fastest) - 9 (smallest)
+assert isinstance(MJML_COMPRESSION_LEVEL, int) and 1 <= MJML_COMPRESSION_LEVEL <= 9
+
+# timeouts configs (worker, tcpserver and httpserver backend modes)
+MJML_CONNECT_TIMEOUT = getattr(settings, 'MJML_CONNECT_TIMEOUT', 25)  # seconds
+assert isinstance(MJML_CONNECT_TIMEOUT, (int, float)) and MJML_CONNECT_TIMEOUT > 0
+MJML_READ_TIMEOUT = getattr(settings, 'MJML_READ_TIMEOUT', 25)  # seconds
+assert isinstance(MJML_READ_TIMEOUT, (int, float)) and MJML_READ_TIMEOUT > 0
+MJML_RENDER_TIMEOUT = getattr(settings, 'MJML_RENDER_TIMEOUT', None)  # None or seconds for all attempts of render
+assert MJML_RENDER_TIMEOUT is None or (isinstance(MJML_RENDER_TIMEOUT, (int, float)) and MJML_RENDER_TIMEOUT > 0)
+MJML_HEDGE_PERCENTILE = getattr(settings, 'MJML_HEDGE_PERCENTILE', None)  # None (disabled) or percentile, e.g. 95
+assert MJML_HEDGE_PERCENTILE is None or (isinstance(MJML_HEDGE_PERCENTILE, (int, float))
+                                         and 0 < MJML_HEDGE_PERCENTILE < 100)
+
+# servers health configs (tcpserver and httpserver backend modes)
+MJML_SERVER_LATENCY_EWMA_ALPHA = getattr(settings, 'MJML_SERVER_LATENCY_EWMA_ALPHA', 0.3)
+assert isinstance(MJML_SERVER_LATENCY_EWMA_ALPHA, (int, float)) and 0 < MJML_SERVER_LATENCY_EWMA_ALPHA <= 1
+MJML_CIRCUIT_BREAKER_FAILURES = getattr(settings, 'MJML_CIRCUIT_BREAKER_FAILURES', 3)  # consecutive failures
+assert isinstance(MJML_CIRCUIT_BREAKER_FAILURES, int) and MJML_CIRCUIT_BREAKER_FAILURES > 0
+MJML_CIRCUIT_BREAKER_RECOVERY_TIMEOUT = getattr(settings, 'MJML_CIRCUIT_BREAKER_RECOVERY_TIMEOUT', 30)  # seconds
+assert isinstance(MJML_CIRCUIT_BREAKER_RECOVERY_TIMEOUT, (int, float))
+
+# directory made by mjml_compile command with HTML of static mjml blocks
+MJML_COMPILED_DIR = getattr(settings, 'MJML_COMPILED_DIR', None)
+assert isinstance(MJML_COMPILED_DIR, (type(None), str))
+
+# concurrent renders of the same source in the process make one request to the backend
+MJML_COALESCE_RENDERS = getattr(settings, 'MJML_COALESCE_RENDERS', True)
+assert isinstance(MJML_COALESCE_RENDERS, bool)
+
+# render stats configs (see mjml.signals.render_finished)
+MJML_STATS = getattr(settings, 'MJML_STATS', False)  # collect stats of renders in the process
+assert isinstance(MJML_STATS, bool)
+MJML_STATS_DIR = getattr(settings, 'MJML_STATS_DIR', None)  # None or directory for stats of all processes
+assert isinstance(MJML_STATS_DIR, (type(None), str))
+MJML_STATS_FLUSH_INTERVAL = getattr(settings, 'MJML_STATS_FLUSH_INTERVAL', 10)  # seconds
+assert isinstance(MJML_STATS_FLUSH_INTERVAL, (int, float)) and MJML_STATS_FLUSH_INTERVAL >= 0
+
+# render cache configs
+MJML_CACHE = getattr(settings, 'MJML_CACHE', None)  # None (default, disabled) or dict
+assert isinstance(MJML_CACHE, (type(None), dict))
+if MJML_CACHE is not None:
+    assert isinstance(MJML_CACHE.get('MAX_ENTRIES', 1000), int)
+    assert isinstance(MJML_CACHE.get('MAX_BYTES', 0), int)
+    assert isinstance(MJML_CACHE.get('BACKEND'), (type(None), str))
+    assert isinstance(MJML_CACHE.get('TIMEOUT'), (type(None), int))
+    assert isinstance(MJML_CACHE.get('KEY_PREFIX', ''), str)
+    assert isinstance(MJML_CACHE.get('VERSION', ''), str)
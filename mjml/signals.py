@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# sent after every render with argument "info" (mjml.instrumentation.RenderInfo)
+render_finished = Signal()
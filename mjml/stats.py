@@ -0,0 +1,236 @@
+import atexit
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from mjml import settings as mjml_settings
+from mjml.instrumentation import RenderInfo
+from mjml.signals import render_finished
+from mjml.tools import _get_process_local
+
+# upper bounds of histogram buckets in seconds (the last bucket is +Inf)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class RenderStats:
+    """
+    In-process aggregator of render_finished signals: counters and histograms of latency by backend and server.
+    """
+
+    def __init__(self, buckets: Iterable[float] = DURATION_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], List[float]] = {}  # counts of buckets, +Inf, sum
+        self._last_flush = time.monotonic()
+
+    def _inc(self, name: str, labels: Labels, value: float = 1) -> None:
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def _observe(self, name: str, labels: Labels, value: float) -> None:
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            histogram = self._histograms[(name, labels)] = [0] * (len(self.buckets) + 2)
+        histogram[bisect.bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    def record(self, info: RenderInfo) -> None:
+        backend = (('backend', info.backend),)
+        server = backend + (('server', info.server or ''),)
+        with self._lock:
+            self._inc('mjml_renders_total', server + (('status', 'error' if info.error else 'ok'),))
+            self._inc('mjml_render_attempts_total', backend, info.attempts)
+            self._inc('mjml_render_timeouts_total', backend, info.timeouts)
+            if info.cache is not None:
+                self._inc('mjml_render_cache_total', backend + (('result', info.cache),))
+            if info.fallbacks:
+                self._inc('mjml_render_fallbacks_total', backend, info.fallbacks)
+            if info.coalesced:
+                self._inc('mjml_render_coalesced_total', backend)
+            self._inc('mjml_render_input_bytes_total', backend, info.input_size)
+            if info.output_size is not None:
+                self._inc('mjml_render_output_bytes_total', backend, info.output_size)
+            if info.duration is not None:
+                self._observe('mjml_render_duration_seconds', server, info.duration)
+            for phase, seconds in info.timings.items():
+                self._observe('mjml_render_phase_seconds', backend + (('phase', phase),), seconds)
+
+    def get_snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                'buckets': list(self.buckets),
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [
+                    [name, dict(labels), list(values)] for (name, labels), values in self._histograms.items()
+                ],
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return not self._counters
+
+    def flush(self, stats_dir: str) -> None:
+        """
+        Write the snapshot to <stats_dir>/<pid>.json, so stats of all processes can be read by other processes.
+        """
+        self._last_flush = time.monotonic()
+        if self.is_empty():
+            return
+        snapshot = self.get_snapshot()
+        os.makedirs(stats_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=stats_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, os.path.join(stats_dir, f'{os.getpid()}.json'))
+
+    def flush_if_needed(self, stats_dir: str, interval: float) -> None:
+        if time.monotonic() - self._last_flush >= interval:
+            self.flush(stats_dir)
+
+
+def merge_snapshots(snapshots: Iterable[Dict]) -> Dict:
+    counters: Dict[Tuple[str, Labels], float] = {}
+    histograms: Dict[Tuple[str, Labels], List[float]] = {}
+    buckets = list(DURATION_BUCKETS)
+    for snapshot in snapshots:
+        buckets = snapshot['buckets']
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+            else:
+                histograms[key] = list(values)
+    return {
+        'buckets': buckets,
+        'counters': [[name, dict(labels), value] for (name, labels), value in sorted(counters.items())],
+        'histograms': [[name, dict(labels), values] for (name, labels), values in sorted(histograms.items())],
+    }
+
+
+def _format_labels(labels: Dict[str, str], **extra: str) -> str:
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    items = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels.items()
+    )
+    return '{' + items + '}'
+
+
+def _format_number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def get_histogram_quantile(buckets: List[float], values: List[float], quantile: float) -> float:
+    """
+    Return estimated quantile (upper bound of the bucket), +Inf if it is in the last bucket.
+    """
+    counts = values[:-1]
+    total = sum(counts)
+    if not total:
+        return 0.0
+    cumulative = 0
+    for bound, count in zip(list(buckets) + [float('inf')], counts):
+        cumulative += count
+        if cumulative >= quantile * total:
+            return bound
+    return float('inf')
+
+
+def format_prometheus(snapshot: Dict) -> str:
+    """
+    Return the snapshot in Prometheus text exposition format.
+    """
+    lines = []
+    typed = set()
+    for name, labels, value in snapshot['counters']:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name}{_format_labels(labels)} {_format_number(value)}')
+    bounds = [_format_number(b) for b in snapshot['buckets']] + ['+Inf']
+    for name, labels, values in snapshot['histograms']:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} histogram')
+        cumulative = 0
+        for bound, count in zip(bounds, values):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} {_format_number(cumulative)}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {_format_number(values[-1])}')
+        lines.append(f'{name}_count{_format_labels(labels)} {_format_number(cumulative)}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_render_stats() -> RenderStats:
+    return _get_process_local('render_stats', _make_render_stats)
+
+
+def _make_render_stats() -> RenderStats:
+    stats = RenderStats()
+    if mjml_settings.MJML_STATS_DIR is not None:
+        atexit.register(stats.flush, mjml_settings.MJML_STATS_DIR)
+    return stats
+
+
+def record_render(sender, info: RenderInfo, **kwargs) -> None:
+    stats = get_render_stats()
+    stats.record(info)
+    if mjml_settings.MJML_STATS_DIR is not None:
+        try:
+            stats.flush_if_needed(mjml_settings.MJML_STATS_DIR, mjml_settings.MJML_STATS_FLUSH_INTERVAL)
+        except OSError:
+            pass  # stats must not break renders, the next flush will try again
+
+
+def enable_stats() -> None:
+    render_finished.connect(record_render, dispatch_uid='mjml_stats')
+
+
+def disable_stats() -> None:
+    render_finished.disconnect(dispatch_uid='mjml_stats')
+
+
+def get_stats_snapshot() -> Dict:
+    """
+    Return stats of this process or merged stats of all processes if settings.MJML_STATS_DIR is set.
+    """
+    stats_dir = mjml_settings.MJML_STATS_DIR
+    if stats_dir is None:
+        return get_render_stats().get_snapshot()
+    get_render_stats().flush(stats_dir)
+    snapshots = []
+    for filename in sorted(os.listdir(stats_dir)) if os.path.isdir(stats_dir) else []:
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(stats_dir, filename), encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # the process is writing the file right now or has been killed
+    return merge_snapshots(snapshots)
+
+
+def clear_stats() -> None:
+    get_render_stats().clear()
+    stats_dir = mjml_settings.MJML_STATS_DIR
+    if stats_dir is not None and os.path.isdir(stats_dir):
+        for filename in os.listdir(stats_dir):
+            if filename.endswith('.json'):
+                os.remove(os.path.join(stats_dir, filename))
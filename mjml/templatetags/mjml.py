@@ -1,19 +1,149 @@
+import hashlib
+import re
+from typing import List, Optional, Union
+
 from django import template
+from django.template.base import TextNode, VariableNode
+from django.template.defaulttags import CommentNode, LoadNode
+from django.template.loaders.cached import Loader as CachedLoader
 
-from mjml.tools import mjml_render
+from mjml.compiled import get_compiled_manifest
+from mjml.tools import BackendUnavailableError, mjml_render
 
 register = template.Library()
 
+# attributes which MJML copies to HTML as is, so a variable in them can be substituted after compiling
+PRECOMPILE_SAFE_ATTRS = {'href', 'src', 'alt', 'title', 'name', 'rel'}
+
+# nodes which render nothing
+EMPTY_NODES = (CommentNode, LoadNode)
+
+_tag_attr_re = re.compile(r'([\w-]+)\s*=\s*(["\'])[^"\']*$')
+
+
+def _is_substitutable(mjml_code_before: str) -> bool:
+    """
+    Check that a variable which follows mjml_code_before doesn't affect layout,
+    i.e. it is in text content or in the value of one of PRECOMPILE_SAFE_ATTRS.
+    """
+    tag_start = mjml_code_before.rfind('<')
+    if tag_start > mjml_code_before.rfind('>'):
+        m = _tag_attr_re.search(mjml_code_before, tag_start)
+        return m is not None and m.group(1).lower() in PRECOMPILE_SAFE_ATTRS
+    # css of mj-style is parsed and inlined by MJML
+    return mjml_code_before.rfind('<mj-style') <= mjml_code_before.rfind('</mj-style')
+
+
+def _mjml_render_static(mjml_source: str) -> str:
+    # HTML of code which doesn't depend on context could be compiled by mjml_compile command at deploy time
+    compiled_manifest = get_compiled_manifest()
+    if compiled_manifest is not None:
+        html = compiled_manifest.get(mjml_source)
+        if html is not None:
+            return html
+    return mjml_render(mjml_source)
+
 
 class MJMLRenderNode(template.Node):
-    def __init__(self, nodelist):
+    def __init__(self, nodelist, precompile: bool = False):
         self.nodelist = nodelist
+        # the block without variables and tags gives the same HTML on every render, so it is compiled only once
+        self.is_static = all(isinstance(node, (TextNode,) + EMPTY_NODES) for node in nodelist)
+        self._static_html: Optional[str] = None
+        self.precompile = precompile and not self.is_static
+        self._skeleton_source: Optional[str] = None
+        self._variable_nodes: List[VariableNode] = []
+        self._sentinel_re: Optional[re.Pattern] = None
+        self._skeleton: Union[None, bool, List[Union[str, int]]] = None  # False - can't be used
+        if self.precompile:
+            self._prepare_skeleton()
+
+    def _prepare_skeleton(self) -> None:
+        """
+        Replace variables by unique sentinels to compile MJML code once and substitute values into HTML on render.
+        Precompiling isn't used if the block contains tags or variables which affect layout.
+        """
+        # the token depends on the code only, so the skeleton is the same in all processes (see mjml_compile command)
+        token = hashlib.sha256(''.join(
+            node.s if isinstance(node, TextNode) else node.token.contents for node in self.nodelist
+            if not isinstance(node, EMPTY_NODES)
+        ).encode('utf-8')).hexdigest()[:32]
+        parts = []
+        for node in self.nodelist:
+            if isinstance(node, TextNode):
+                parts.append(node.s)
+            elif isinstance(node, VariableNode) and _is_substitutable(''.join(parts)):
+                parts.append(f'mjmlvar{token}n{len(self._variable_nodes)}e')
+                self._variable_nodes.append(node)
+            elif not isinstance(node, EMPTY_NODES):
+                self.precompile = False
+                self._variable_nodes = []
+                return
+        self._skeleton_source = ''.join(parts)
+        self._sentinel_re = re.compile(f'mjmlvar{token}n([0-9]+)e')
+
+    def get_static_source(self) -> str:
+        return self.nodelist.render(template.Context())
+
+    def get_compile_source(self) -> Optional[str]:
+        """
+        Return MJML code which can be compiled without context (the static block or the precompile skeleton).
+        """
+        if self.is_static:
+            return self.get_static_source()
+        if self.precompile:
+            return self._skeleton_source
+        return None
+
+    def compile_static(self) -> str:
+        if self._static_html is None:
+            self._static_html = _mjml_render_static(self.get_static_source())
+        return self._static_html
+
+    def compile_skeleton(self) -> Optional[List[Union[str, int]]]:
+        if self._skeleton is None:
+            try:
+                html = _mjml_render_static(self._skeleton_source)
+            except BackendUnavailableError:
+                return None  # the backend doesn't work now, the skeleton is compiled by the next render
+            except RuntimeError:
+                self._skeleton = False  # MJML has rejected the skeleton
+            else:
+                chunks = self._sentinel_re.split(html)
+                # odd chunks are indexes of variable nodes
+                skeleton = [int(c) if i % 2 else c for i, c in enumerate(chunks)]
+                # MJML could change or drop a sentinel
+                self._skeleton = skeleton if len(set(skeleton[1::2])) == len(self._variable_nodes) else False
+        return self._skeleton or None
+
+    def _render_precompiled(self, context) -> Optional[str]:
+        skeleton = self.compile_skeleton()
+        if skeleton is None:
+            return None
+        values = [node.render_annotated(context) for node in self._variable_nodes]
+        if any('<mj-' in value for value in values):
+            return None  # MJML components in a value must be compiled
+        return ''.join(values[c] if i % 2 else c for i, c in enumerate(skeleton))
 
     def render(self, context) -> str:
+        if self.is_static:
+            return self.compile_static()
+        if self.precompile:
+            html = self._render_precompiled(context)
+            if html is not None:
+                return html
         mjml_source = self.nodelist.render(context)
         return mjml_render(mjml_source)
 
 
+def _is_cached_template(parser) -> bool:
+    loader = getattr(getattr(parser, 'origin', None), 'loader', None)
+    engine = getattr(loader, 'engine', None)
+    if engine is None:
+        return False
+    return any(isinstance(tpl_loader, CachedLoader) for tpl_loader in engine.template_loaders)
+
+
 @register.tag
 def mjml(parser, token) -> MJMLRenderNode:
     """
@@ -23,10 +153,26 @@ def mjml(parser, token) -> MJMLRenderNode:
         {% mjml %}
             .. MJML template code ..
         {% endmjml %}
+
+    With "precompile" argument MJML code is compiled once with placeholders instead of variables
+    and values of variables are substituted into HTML on every render:
+        {% mjml precompile %}
+            .. MJML template code ..
+        {% endmjml %}
     """
     nodelist = parser.parse(('endmjml',))
     parser.delete_first_token()
     tokens = token.split_contents()
-    if len(tokens) != 1:
-        raise template.TemplateSyntaxError("'%r' tag doesn't receive any arguments." % tokens[0])
-    return MJMLRenderNode(nodelist)
+    if len(tokens) > 2 or (len(tokens) == 2 and tokens[1] != 'precompile'):
+        raise template.TemplateSyntaxError("'%r' tag receives only optional 'precompile' argument." % tokens[0])
+    node = MJMLRenderNode(nodelist, precompile=len(tokens) == 2)
+    if (node.is_static or node.precompile) and _is_cached_template(parser):
+        # the template is parsed once per process, so compile it now instead of on the first render
+        if node.precompile:
+            node.compile_skeleton()
+        else:
+            try:
+                node.compile_static()
+            except RuntimeError:
+                pass  # the error will be raised on render
+    return node
@@ -1,19 +1,121 @@
+import asyncio
+import atexit
+import codecs
+import concurrent.futures
+import contextlib
+import contextvars
 import copy
+import gzip
+import hashlib
+import inspect
 import json
-import random
+import os
+import re
 import socket
 import subprocess
 import tempfile
-from typing import Optional, Dict, List
+import threading
+import time
+import weakref
+from typing import Any, Awaitable, Callable, Iterable, Optional, Dict, List, Tuple, Union
 
 from django.utils.encoding import force_str, force_bytes
 
 from mjml import settings as mjml_settings
+from mjml.cache import RenderCache
+from mjml.health import ServerHealthRegistry
+from mjml.instrumentation import (
+    RenderInfo, get_render_info, is_enabled as is_instrumentation_enabled, measure, send_render_info, track_attempt,
+    track_render,
+)
+from mjml.pool import (
+    Address, AsyncMultiplexedTCPConnection, AsyncTCPConnectionPool, MultiplexedTCPConnection, TCPConnectionPool,
+)
+from mjml.singleflight import AsyncSingleFlight, SingleFlight
+from mjml.workers import WORKER_JS_PATH, NodeWorkerPool, WorkerDiedError, WorkerStartError
+
+CMD_READ_CHUNK_SIZE = 64 * 1024
+UNIX_SOCKET_PREFIX = 'unix://'
+# hello is a request of protocol 1 "<!-- mjml-tcpserver-protocol: 2; option; ... -->" which asks MJML TCP-Server
+# to switch the connection to protocol 2 (see MultiplexedTCPConnection), the server responds with accepted options
+# "mjml-tcpserver-protocol: 2; option; ...", old server compiles it as usual MJML and responds with something else
+TCPSERVER_PROTOCOL_2 = 'mjml-tcpserver-protocol: 2'
+TCPSERVER_COMPRESSION = 'compression: zlib'
+
+# concurrent renders per process which don't wait for a free thread of hedged requests or requests to MJML HTTP server
+# (see _get_request_executor) if MJML_BACKEND_MAX_CONCURRENCY isn't set
+REQUEST_EXECUTOR_MAX_RENDERS = 256
 
 _cache = {}
+_cache_lock = threading.Lock()
+# deadline of the current render (MJML_RENDER_TIMEOUT) for requests to servers
+_render_deadline: contextvars.ContextVar = contextvars.ContextVar('mjml_render_deadline', default=None)
 
 
-def _mjml_render_by_cmd(mjml_code: str) -> str:
+class BackendUnavailableError(RuntimeError):
+    """
+    The backend can't render now (no working server, the command or the worker can't be run),
+    so the render can be passed to the next backend of settings.MJML_FALLBACK_BACKEND_MODES.
+    """
+
+
+def _get_process_local(key, factory: Callable[[], Any]) -> Any:
+    """
+    Return an object (pool of connections or processes) stored in _cache, create it if it doesn't exist yet
+    or if it was created in another process (before fork).
+    """
+    item = _cache.get(key)
+    if item is None or item[0] != os.getpid():
+        with _cache_lock:
+            item = _cache.get(key)
+            if item is None or item[0] != os.getpid():
+                item = _cache[key] = (os.getpid(), factory())
+    return item[1]
+
+
+async def _close_on_loop_shutdown(objects: Dict, loop: asyncio.AbstractEventLoop, close: Callable[[Any], Any]):
+    try:
+        yield
+    finally:
+        item = objects.pop(loop, None)
+        if item is not None:
+            result = close(item[0])
+            if inspect.isawaitable(result):
+                await result
+
+
+def _get_loop_local(key, factory: Callable[[], Any], close: Callable[[Any], Any]) -> Any:
+    """
+    Return an object (asyncio pool of connections or client) which belongs to the running event loop,
+    create it if it doesn't exist yet. The object is closed by close(obj) (sync or async) when the loop shuts down
+    its async generators (asyncio.run, asgiref.sync.async_to_sync), objects of loops closed without it are closed
+    on the next creation, so objects of loops which aren't used anymore aren't kept.
+    """
+    objects = _get_process_local(key, dict)
+    loop = asyncio.get_running_loop()
+    item = objects.get(loop)
+    if item is not None:
+        return item[0]
+    for other_loop in [other_loop for other_loop in list(objects) if other_loop.is_closed()]:
+        other_item = objects.pop(other_loop, None)
+        if other_item is not None:
+            with contextlib.suppress(Exception):
+                result = close(other_item[0])
+                if inspect.iscoroutine(result):
+                    result.close()
+    # the running loop finalizes its async generators on shutdown, the started generator is registered in it
+    # (the loop keeps a weak reference, so the generator is kept with the object)
+    watcher = _close_on_loop_shutdown(objects, loop, close)
+    try:
+        watcher.asend(None).send(None)
+    except StopIteration:
+        pass
+    obj = factory()
+    objects[loop] = (obj, watcher)
+    return obj
+
+
+def _get_cmd_args() -> List[str]:
     if 'cmd_args' not in _cache:
         cmd_args = copy.copy(mjml_settings.MJML_EXEC_CMD)
         if not isinstance(cmd_args, list):
@@ -22,142 +124,1411 @@ def _mjml_render_by_cmd(mjml_code: str) -> str:
             if ca not in cmd_args:
                 cmd_args.append(ca)
         _cache['cmd_args'] = cmd_args
-    else:
-        cmd_args = _cache['cmd_args']
+    return _cache['cmd_args']
+
+
+def _get_cmd_batch_args() -> List[str]:
+    if 'cmd_batch_args' not in _cache:
+        cmd_args = copy.copy(mjml_settings.MJML_EXEC_CMD)
+        if not isinstance(cmd_args, list):
+            cmd_args = [cmd_args]
+        _cache['cmd_batch_args'] = [ca for ca in cmd_args if ca not in ('-i', '-s')]
+    return _cache['cmd_batch_args']
+
 
-    with tempfile.SpooledTemporaryFile(max_size=(5 * 1024 * 1024)) as stdout_tmp_f:
+def _get_cmd_file_path_args(cmd_args: List[str]) -> List[str]:
+    """
+    Return args which make mjml resolve relative paths of mj-include from the current directory (as for a source
+    from stdin) instead of the directory of the input file, unless MJML_EXEC_CMD sets filePath already.
+    """
+    if any(ca.startswith(('--config.filePath', '-c.filePath')) for ca in cmd_args):
+        return []
+    return [f'--config.filePath={os.getcwd()}']
+
+
+def _get_cmd_error(cmd_args: List[str], e: Exception) -> RuntimeError:
+    cmd_str = ' '.join(cmd_args)
+    return BackendUnavailableError(
+        f'Problem to run command "{cmd_str}"\n'
+        f'{e}\n'
+        'Check that mjml is installed and allow permissions to execute.\n'
+        'See https://github.com/mjmlio/mjml#installation'
+    )
+
+
+def _get_cmd_output_size_error(max_size: int) -> RuntimeError:
+    return RuntimeError(f'MJML output is larger than {max_size} bytes (settings.MJML_CMD_MAX_OUTPUT_SIZE).')
+
+
+def _write_and_close(stream, data: bytes) -> None:
+    try:
+        stream.write(data)
+    except (BrokenPipeError, ValueError):
+        pass  # the process has exited, its error will be reported via stderr
+    finally:
         try:
-            p = subprocess.Popen(cmd_args, stdin=subprocess.PIPE, stdout=stdout_tmp_f, stderr=subprocess.PIPE)
-            stderr = p.communicate(force_bytes(mjml_code))[1]
-        except (IOError, OSError) as e:
-            cmd_str = ' '.join(cmd_args)
-            raise RuntimeError(
-                f'Problem to run command "{cmd_str}"\n'
-                f'{e}\n'
-                'Check that mjml is installed and allow permissions to execute.\n'
-                'See https://github.com/mjmlio/mjml#installation'
-            ) from e
-        stdout_tmp_f.seek(0)
-        stdout = stdout_tmp_f.read()
+            stream.close()
+        except BrokenPipeError:
+            pass
 
+
+def _mjml_render_by_cmd(mjml_code: str) -> str:
+    cmd_args = _get_cmd_args()
+    max_size = mjml_settings.MJML_CMD_MAX_OUTPUT_SIZE
+
+    try:
+        p = subprocess.Popen(cmd_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (IOError, OSError) as e:
+        raise _get_cmd_error(cmd_args, e) from e
+
+    # stdin and stderr are handled in threads to read stdout at the same time without deadlocks
+    stderr_chunks = []
+    threads = [
+        threading.Thread(target=_write_and_close, args=(p.stdin, mjml_code.encode('utf-8')), daemon=True),
+        threading.Thread(target=lambda: stderr_chunks.append(p.stderr.read()), daemon=True),
+    ]
+    for t in threads:
+        t.start()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    html_chunks = []
+    size = 0
+    try:
+        while True:
+            chunk = p.stdout.read1(CMD_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_size and size > max_size:
+                p.kill()
+                raise _get_cmd_output_size_error(max_size)
+            html_chunks.append(decoder.decode(chunk))
+        html_chunks.append(decoder.decode(b'', final=True))
+    finally:
+        p.stdout.close()
+        p.wait()
+        for t in threads:
+            t.join()
+        p.stderr.close()
+
+    stderr = stderr_chunks[0] if stderr_chunks else b''
     if stderr:
         raise RuntimeError(f'MJML stderr is not empty: {force_str(stderr)}.')
 
-    return force_str(stdout)
+    return ''.join(html_chunks)
+
+
+async def _mjml_render_by_cmd_async(mjml_code: str) -> str:
+    cmd_args = _get_cmd_args()
+    max_size = mjml_settings.MJML_CMD_MAX_OUTPUT_SIZE
+
+    try:
+        p = await asyncio.create_subprocess_exec(
+            *cmd_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+    except (IOError, OSError) as e:
+        raise _get_cmd_error(cmd_args, e) from e
+
+    async def write_stdin() -> None:
+        try:
+            p.stdin.write(mjml_code.encode('utf-8'))
+            await p.stdin.drain()
+            p.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the process has exited, its error will be reported via stderr
+
+    async def read_stdout() -> str:
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        html_chunks = []
+        size = 0
+        while True:
+            chunk = await p.stdout.read(CMD_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_size and size > max_size:
+                p.kill()
+                raise _get_cmd_output_size_error(max_size)
+            html_chunks.append(decoder.decode(chunk))
+        html_chunks.append(decoder.decode(b'', final=True))
+        return ''.join(html_chunks)
+
+    try:
+        _, html, stderr = await asyncio.gather(write_stdin(), read_stdout(), p.stderr.read())
+    except BaseException:
+        with contextlib.suppress(ProcessLookupError):
+            p.kill()
+        raise
+    finally:
+        await p.wait()
+
+    if stderr:
+        raise RuntimeError(f'MJML stderr is not empty: {force_str(stderr)}.')
+
+    return html
+
+
+def _mjml_render_many_by_cmd(mjml_sources: List[str], processes: int) -> List[Union[str, Exception]]:
+    """
+    Compile many MJML sources by a few runs of mjml command (up to `processes` at the same time) instead of a run
+    per source. The sources are written to files, mjml writes HTML to an output directory and its errors refer
+    to the files, so an exception is returned in place of HTML of a failed source. Sources of a run with errors
+    which don't refer to a file are compiled one by one to find out which of them have failed.
+    """
+    _check_cmd_lazily()
+    cmd_args = _get_cmd_batch_args()
+    file_path_args = _get_cmd_file_path_args(cmd_args)
+    max_size = mjml_settings.MJML_CMD_MAX_OUTPUT_SIZE
+    results: List[Union[str, Exception]] = []
+
+    with tempfile.TemporaryDirectory(prefix='mjml-') as tmp_dir:
+        input_dir = os.path.join(tmp_dir, 'input')
+        output_dir = os.path.join(tmp_dir, 'output')
+        os.mkdir(input_dir)
+        os.mkdir(output_dir)
+        paths = []
+        for i, mjml_source in enumerate(mjml_sources):
+            path = os.path.join(input_dir, f'{i}.mjml')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(mjml_source)
+            paths.append(path)
+        path_re = re.compile(re.escape(input_dir + os.sep) + r'(\d+)\.mjml')
+
+        batches = [list(range(len(paths)))[i::processes] for i in range(processes)]
+        runs = []
+        errors = {}
+        unattributed_errors = {}
+        try:
+            for batch in batches:
+                batch_args = cmd_args + file_path_args + [paths[i] for i in batch] + ['-o', output_dir + os.sep]
+                try:
+                    p = subprocess.Popen(batch_args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.PIPE)
+                except (IOError, OSError) as e:
+                    raise _get_cmd_error(cmd_args, e) from e
+                runs.append((batch, p))
+            for batch, p in runs:
+                stderr = p.communicate()[1]
+                common_errors = []
+                for line in force_str(stderr).splitlines():
+                    if not line.strip():
+                        continue
+                    match = path_re.search(line)
+                    if match:
+                        errors.setdefault(int(match.group(1)), []).append(line)
+                    else:
+                        common_errors.append(line)
+                if common_errors:
+                    for i in batch:
+                        if len(batch) == 1 or i in errors:
+                            errors.setdefault(i, []).extend(common_errors)
+                        else:
+                            unattributed_errors[i] = common_errors
+        finally:
+            for _, p in runs:
+                if p.poll() is None:
+                    p.kill()
+                    p.communicate()
+
+        for i in range(len(paths)):
+            if i in errors:
+                error_str = '\n'.join(errors[i])
+                results.append(RuntimeError(f'MJML stderr is not empty: {error_str}.'))
+                continue
+            if i in unattributed_errors:
+                results.append(None)  # it is compiled below
+                continue
+            output_path = os.path.join(output_dir, f'{i}.html')
+            if not os.path.exists(output_path):
+                results.append(RuntimeError('MJML did not produce output.'))
+            elif max_size and os.path.getsize(output_path) > max_size:
+                results.append(_get_cmd_output_size_error(max_size))
+            else:
+                with open(output_path, encoding='utf-8') as f:
+                    results.append(f.read())
+
+    if unattributed_errors:
+        indexes = sorted(unattributed_errors)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as executor:
+            htmls = executor.map(_mjml_render_by_cmd_or_error, [mjml_sources[i] for i in indexes])
+            for i, result in zip(indexes, htmls):
+                results[i] = result
+    return results
+
+
+def _mjml_render_by_cmd_or_error(mjml_code: str) -> Union[str, Exception]:
+    try:
+        return _mjml_render_by_cmd(mjml_code)
+    except BackendUnavailableError:
+        raise
+    except RuntimeError as e:
+        return e
+
+
+def _make_worker_pool() -> NodeWorkerPool:
+    cmd_args = copy.copy(mjml_settings.MJML_WORKER_NODE_CMD)
+    if not isinstance(cmd_args, list):
+        cmd_args = [cmd_args]
+    cmd_args.append(WORKER_JS_PATH)
+    if mjml_settings.MJML_WORKER_MJML_OPTIONS:
+        cmd_args.append(json.dumps(mjml_settings.MJML_WORKER_MJML_OPTIONS))
+    env = None
+    if mjml_settings.MJML_WORKER_NODE_PATH:
+        env = os.environ.copy()
+        env['NODE_PATH'] = mjml_settings.MJML_WORKER_NODE_PATH
+    pool = NodeWorkerPool(
+        size=mjml_settings.MJML_WORKER_POOL_SIZE,
+        cmd_args=cmd_args,
+        env=env,
+        max_renders=mjml_settings.MJML_WORKER_MAX_RENDERS,
+    )
+    atexit.register(pool.close)
+    return pool
+
+
+def _get_worker_pool() -> NodeWorkerPool:
+    return _get_process_local('worker_pool', _make_worker_pool)
+
+
+def _mjml_render_by_worker(mjml_code: str) -> str:
+    try:
+        ok, result = _get_worker_pool().render(force_bytes(mjml_code), timeout=_get_timeouts(_get_deadline())[1])
+    except WorkerStartError as e:
+        raise BackendUnavailableError(str(e)) from e
+    except WorkerDiedError as e:
+        raise BackendUnavailableError(f'MJML compile error (via MJML worker): {e}') from e
+    if not ok:
+        raise RuntimeError(f'MJML compile error (via MJML worker): {force_str(result)}')
+    return force_str(result)
+
+
+async def _mjml_render_by_worker_async(mjml_code: str) -> str:
+    return await asyncio.to_thread(_mjml_render_by_worker, mjml_code)
+
+
+def _get_server_health() -> ServerHealthRegistry:
+    return _get_process_local('server_health', lambda: ServerHealthRegistry(
+        ewma_alpha=mjml_settings.MJML_SERVER_LATENCY_EWMA_ALPHA,
+        failure_threshold=mjml_settings.MJML_CIRCUIT_BREAKER_FAILURES,
+        recovery_timeout=mjml_settings.MJML_CIRCUIT_BREAKER_RECOVERY_TIMEOUT,
+    ))
+
+
+def _get_tcpserver_key(server) -> str:
+    if isinstance(server, str):
+        return server  # unix:///path/to.sock
+    host, port = server
+    return f'tcp://{host}:{port}'
+
+
+def _get_tcpserver_address(server) -> Address:
+    """
+    Return (host, port) or path of unix domain socket for an item of settings.MJML_TCPSERVERS.
+    """
+    if isinstance(server, str):
+        return server[len(UNIX_SOCKET_PREFIX):]
+    host, port = server
+    return host, port
+
+
+def _get_httpserver_key(server_conf: Dict) -> str:
+    return server_conf['URL']
 
 
-def socket_recvall(sock: socket.socket, n: int) -> Optional[bytes]:
-    data = b''
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
+def _get_no_working_server_error(via: str, servers_count: int, timeouts: int) -> RuntimeError:
+    return BackendUnavailableError(
+        f'MJML compile error (via {via}): no working server\n'
+        f'Number of servers: {servers_count}\n'
+        f'Timeouts: {timeouts}'
+    )
+
+
+def _get_deadline() -> Optional[float]:
+    if mjml_settings.MJML_RENDER_TIMEOUT is None:
+        return None
+    return time.monotonic() + mjml_settings.MJML_RENDER_TIMEOUT
+
+
+def _get_timeouts(deadline: Optional[float]) -> Optional[Tuple[float, float]]:
+    """
+    Return (connect timeout, read timeout) for the next attempt or None if the deadline is exceeded.
+    """
+    connect_timeout, read_timeout = mjml_settings.MJML_CONNECT_TIMEOUT, mjml_settings.MJML_READ_TIMEOUT
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        connect_timeout, read_timeout = min(connect_timeout, remaining), min(read_timeout, remaining)
+    return connect_timeout, read_timeout
+
+
+def _get_hedge_delay(server_key: str) -> Optional[float]:
+    if not mjml_settings.MJML_HEDGE_PERCENTILE:
+        return None
+    return _get_server_health().get_latency_percentile(server_key, mjml_settings.MJML_HEDGE_PERCENTILE)
+
+
+def _get_attempt_deadline(timeout: float) -> float:
+    """
+    Return the deadline of a step of the request which can take up to timeout, it isn't later than the deadline
+    of the render.
+    """
+    deadline = time.monotonic() + timeout
+    render_deadline = _render_deadline.get()
+    return deadline if render_deadline is None else min(deadline, render_deadline)
+
+
+def _get_request_executor(name: str, mode: str, servers_count: int) -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Return the pool of threads for attempts of requests to servers (hedged requests, requests to MJML HTTP server).
+    A render runs at most one attempt per server at the same time, so the pool is sized for all renders which
+    the backend mode allows (MJML_BACKEND_MAX_CONCURRENCY) not to queue them. Threads are started only when
+    all started ones are busy.
+    """
+    max_renders = mjml_settings.MJML_BACKEND_MAX_CONCURRENCY.get(mode, REQUEST_EXECUTOR_MAX_RENDERS)
+    return _get_process_local((f'{name}_executor', mode), lambda: concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_renders * servers_count, thread_name_prefix=f'mjml-{name}',
+    ))
+
+
+def _request_servers(via: str, mode: str, servers: Iterable, key: Callable[[Any], str], request: Callable[..., Any],
+                     errors: Tuple, timeout_errors: Tuple) -> Any:
+    """
+    Call request(server, connect_timeout, read_timeout) for servers one by one until it doesn't raise
+    one of errors (failover) and return its result. Whole time is limited by MJML_RENDER_TIMEOUT,
+    request can get the deadline of the render by _get_attempt_deadline.
+    If MJML_HEDGE_PERCENTILE is set and the server doesn't respond in time of this percentile of its latency,
+    the request to the next server is sent in parallel and the first response is used (hedged request).
+    """
+    deadline = _get_deadline()
+    token = _render_deadline.set(deadline)
+    try:
+        return _request_servers_until(deadline, via, mode, servers, key, request, errors, timeout_errors)
+    finally:
+        _render_deadline.reset(token)
+
+
+def _request_servers_until(deadline: Optional[float], via: str, mode: str, servers: Iterable,
+                           key: Callable[[Any], str], request: Callable[..., Any], errors: Tuple,
+                           timeout_errors: Tuple) -> Any:
+    server_health = _get_server_health()
+    servers = server_health.get_servers_order(servers, key=key)
+    timeouts = 0
+    if mjml_settings.MJML_HEDGE_PERCENTILE and len(servers) > 1:
+        executor = _get_request_executor('hedge', mode, len(servers))
+        servers_iter = iter(servers)
+        pending = {}
+        hedged = False
+        last_server_key = None
+
+        def call(server, connect_timeout: float, read_timeout: float) -> Any:
+            with server_health.track(key(server)), track_attempt(key(server), timeout_errors):
+                return request(server, connect_timeout, read_timeout)
+
+        def submit() -> None:
+            nonlocal last_server_key
+            server = next(servers_iter, None)
+            timeout = _get_timeouts(deadline)
+            if server is not None and timeout is not None:
+                last_server_key = key(server)
+                pending[executor.submit(contextvars.copy_context().run, call, server, *timeout)] = server
+
+        submit()
+        while pending:
+            wait_timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            hedge_delay = None if hedged else _get_hedge_delay(last_server_key)
+            if hedge_delay is not None and (wait_timeout is None or hedge_delay < wait_timeout):
+                wait_timeout = hedge_delay
+            else:
+                hedge_delay = None
+            done, _ = concurrent.futures.wait(
+                pending, timeout=wait_timeout, return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            if not done:
+                if hedge_delay is None:
+                    timeouts += len(pending)  # deadline is exceeded
+                    break
+                hedged = True
+                submit()
+                continue
+            for future in done:
+                del pending[future]
+                try:
+                    return future.result()
+                except timeout_errors:
+                    timeouts += 1
+                except errors:
+                    pass
+            if not pending:
+                submit()
+    else:
+        for server in servers:
+            timeout = _get_timeouts(deadline)
+            if timeout is None:
+                break
+            try:
+                with server_health.track(key(server)), track_attempt(key(server), timeout_errors):
+                    return request(server, *timeout)
+            except timeout_errors:
+                timeouts += 1
+            except errors:
+                pass
+    raise _get_no_working_server_error(via, len(servers), timeouts)
+
+
+async def _request_servers_async(via: str, servers: Iterable, key: Callable[[Any], str],
+                                 request: Callable[..., Awaitable[Any]], errors: Tuple, timeout_errors: Tuple) -> Any:
+    """
+    Async version of _request_servers.
+    """
+    server_health = _get_server_health()
+    servers = server_health.get_servers_order(servers, key=key)
+    deadline = _get_deadline()
+    timeouts = 0
+    servers_iter = iter(servers)
+    pending = {}
+    hedged = not mjml_settings.MJML_HEDGE_PERCENTILE or len(servers) < 2
+    last_server_key = None
+
+    async def call(server, connect_timeout: float, read_timeout: float) -> Any:
+        with server_health.track(key(server)), track_attempt(key(server), timeout_errors):
+            if deadline is None:
+                return await request(server, connect_timeout, read_timeout)
+            return await asyncio.wait_for(
+                request(server, connect_timeout, read_timeout), timeout=max(deadline - time.monotonic(), 0),
+            )
+
+    def submit() -> None:
+        nonlocal last_server_key
+        server = next(servers_iter, None)
+        timeout = _get_timeouts(deadline)
+        if server is not None and timeout is not None:
+            last_server_key = key(server)
+            pending[asyncio.ensure_future(call(server, *timeout))] = server
+
+    submit()
+    try:
+        while pending:
+            wait_timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            hedge_delay = None if hedged else _get_hedge_delay(last_server_key)
+            if hedge_delay is not None and (wait_timeout is None or hedge_delay < wait_timeout):
+                wait_timeout = hedge_delay
+            else:
+                hedge_delay = None
+            done, _ = await asyncio.wait(pending, timeout=wait_timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if hedge_delay is None:
+                    timeouts += len(pending)  # deadline is exceeded
+                    break
+                hedged = True
+                submit()
+                continue
+            for task in done:
+                del pending[task]
+                try:
+                    return task.result()
+                except timeout_errors:
+                    timeouts += 1
+                except errors:
+                    pass
+            if not pending:
+                submit()
+    finally:
+        for task in pending:
+            task.cancel()
+    raise _get_no_working_server_error(via, len(servers), timeouts)
+
+
+def _set_socket_deadline(sock: socket.socket, deadline: Optional[float]) -> None:
+    """
+    Limit the next operation on the socket by the time remaining to the deadline, so a server which sends
+    a response by small parts can't make the whole request longer than the timeout.
+    """
+    if deadline is None:
+        return
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout('timed out')
+    sock.settimeout(remaining)
+
+
+def socket_recvall(sock: socket.socket, n: int, deadline: Optional[float] = None) -> Optional[bytearray]:
+    # receive directly into preallocated buffer to avoid copying of large responses
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        _set_socket_deadline(sock, deadline)
+        size = sock.recv_into(view[received:], n - received)
+        if not size:
             return
-        data += packet
+        received += size
     return data
 
 
+def _get_tcpserver_pool(server) -> TCPConnectionPool:
+    address = _get_tcpserver_address(server)
+    return _get_process_local(('tcpserver_pool', address), lambda: TCPConnectionPool(
+        address=address,
+        max_size=mjml_settings.MJML_TCPSERVER_POOL_SIZE,
+        idle_timeout=mjml_settings.MJML_TCPSERVER_POOL_IDLE_TIMEOUT,
+    ))
+
+
+def _tcpserver_request(pool: TCPConnectionPool, data: Tuple[bytes, bytes], connect_timeout: float,
+                       read_timeout: float) -> Tuple[bool, str]:
+    while True:
+        with measure('connect'):
+            sock, reused = pool.acquire(connect_timeout)
+        header = None
+        deadline = _get_attempt_deadline(read_timeout)
+        try:
+            with measure('transfer'):
+                for chunk in data:
+                    _set_socket_deadline(sock, deadline)
+                    sock.sendall(chunk)
+                header = socket_recvall(sock, 10, deadline)
+                if header is None:
+                    raise ConnectionResetError('Connection closed by MJML TCP server')
+                result = socket_recvall(sock, int(header[1:]), deadline)
+                if result is None:
+                    raise ConnectionResetError('Connection closed by MJML TCP server')
+        except socket.timeout:
+            pool.discard(sock)
+            raise
+        except OSError:
+            pool.discard(sock)
+            if reused and header is None:
+                continue  # persistent connection has been closed by server, reconnect
+            raise
+        except ValueError as e:
+            pool.discard(sock)
+            raise ConnectionError(f'Wrong response from MJML TCP server: {e}') from e
+        pool.release(sock)
+        return header[:1] == b'0', result.decode('utf-8')
+
+
+def _get_tcpserver_request_data(mjml_code: str) -> Tuple[bytes, bytes]:
+    """
+    Return (header, body) of the request. They are sent separately to avoid copying of large body.
+    """
+    mjml_code_data = mjml_code.encode('utf-8')
+    return b'%09d' % len(mjml_code_data), mjml_code_data
+
+
+def _get_tcpserver_protocols() -> Dict[Address, int]:
+    """
+    Return negotiated protocols of servers by address, a server is asked once per process.
+    """
+    return _get_process_local('tcpserver_protocols', dict)
+
+
+def _get_tcpserver_hello() -> str:
+    options = [TCPSERVER_PROTOCOL_2]
+    if mjml_settings.MJML_COMPRESSION_MIN_SIZE is not None:
+        options.append(TCPSERVER_COMPRESSION)
+    return f'<!-- {"; ".join(options)} -->'
+
+
+def _parse_tcpserver_hello_response(header: bytes, result: bytes) -> Optional[List[str]]:
+    """
+    Return accepted options or None if the server doesn't support protocol 2.
+    """
+    if header[:1] != b'0':
+        return None
+    options = result.decode('utf-8', errors='replace').split('; ')
+    if options[0] != TCPSERVER_PROTOCOL_2:
+        return None
+    return options[1:]
+
+
+def _get_multiplexed_connection_kwargs(options: List[str]) -> Dict[str, Any]:
+    if TCPSERVER_COMPRESSION not in options:
+        return {}
+    return {
+        'compress_min_size': mjml_settings.MJML_COMPRESSION_MIN_SIZE,
+        'compress_level': mjml_settings.MJML_COMPRESSION_LEVEL,
+    }
+
+
+def _tcpserver_hello(sock: socket.socket, timeout: float) -> Optional[List[str]]:
+    """
+    Return options accepted by the server if it has switched the connection to protocol 2, otherwise None.
+    """
+    deadline = _get_attempt_deadline(timeout)
+    for chunk in _get_tcpserver_request_data(_get_tcpserver_hello()):
+        _set_socket_deadline(sock, deadline)
+        sock.sendall(chunk)
+    header = socket_recvall(sock, 10, deadline)
+    if header is None:
+        raise ConnectionResetError('Connection closed by MJML TCP server')
+    try:
+        result = socket_recvall(sock, int(header[1:]), deadline)
+    except ValueError as e:
+        raise ConnectionError(f'Wrong response from MJML TCP server: {e}') from e
+    if result is None:
+        raise ConnectionResetError('Connection closed by MJML TCP server')
+    return _parse_tcpserver_hello_response(header, result)
+
+
+def _get_tcpserver_connection(server, connect_timeout: float,
+                              read_timeout: float) -> Optional[MultiplexedTCPConnection]:
+    """
+    Return the connection of protocol 2 shared by all threads or None if the server supports only protocol 1,
+    then connections of _get_tcpserver_pool should be used.
+    """
+    address = _get_tcpserver_address(server)
+    protocols = _get_tcpserver_protocols()
+    if protocols.get(address) == 1:
+        return None
+    state = _get_process_local(('tcpserver_connection', address), lambda: {'lock': threading.Lock(), 'conn': None})
+    with state['lock']:
+        conn = state['conn']
+        if conn is not None and not conn.closed:
+            return conn
+        pool = _get_tcpserver_pool(server)
+        sock = pool.connect(connect_timeout)
+        try:
+            options = _tcpserver_hello(sock, read_timeout)
+        except BaseException:
+            sock.close()
+            raise
+        if options is None:
+            protocols[address] = 1
+            pool.release(sock)  # it's a usual connection of protocol 1
+            return None
+        protocols[address] = 2
+        conn = state['conn'] = MultiplexedTCPConnection(
+            sock, read_timeout, **_get_multiplexed_connection_kwargs(options),
+        )
+        return conn
+
+
 def _mjml_render_by_tcpserver(mjml_code: str) -> str:
-    if len(mjml_settings.MJML_TCPSERVERS) > 1:
-        servers = list(mjml_settings.MJML_TCPSERVERS)[:]
-        random.shuffle(servers)
+    mjml_code_data = _get_tcpserver_request_data(mjml_code)
+
+    def request(server, connect_timeout: float, read_timeout: float) -> Tuple[bool, str]:
+        if mjml_settings.MJML_TCPSERVER_PROTOCOL == 'auto':
+            with measure('connect'):
+                conn = _get_tcpserver_connection(server, connect_timeout, read_timeout)
+            if conn is not None:
+                with measure('transfer'):
+                    timeout = max(_get_attempt_deadline(read_timeout) - time.monotonic(), 0)
+                    return conn.request(mjml_code_data[1], timeout)
+        return _tcpserver_request(_get_tcpserver_pool(server), mjml_code_data, connect_timeout, read_timeout)
+
+    ok, result = _request_servers(
+        via='MJML TCP server',
+        mode='tcpserver',
+        servers=mjml_settings.MJML_TCPSERVERS,
+        key=_get_tcpserver_key,
+        request=request,
+        errors=(socket.error,),
+        timeout_errors=(socket.timeout,),
+    )
+    if ok:
+        return result
     else:
-        servers = mjml_settings.MJML_TCPSERVERS
-    mjml_code_data = force_bytes(mjml_code)
-    mjml_code_data = force_bytes('{:09d}'.format(len(mjml_code_data))) + mjml_code_data
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-    s.settimeout(25)
-    timeouts = 0
-    for host, port in servers:
+        raise RuntimeError(f'MJML compile error (via MJML TCP server): {result}')
+
+
+def _get_async_tcpserver_pool(server) -> AsyncTCPConnectionPool:
+    address = _get_tcpserver_address(server)
+    # asyncio connections belong to the event loop which has created them
+    return _get_loop_local(('async_tcpserver_pools', address), lambda: AsyncTCPConnectionPool(
+        address=address,
+        max_size=mjml_settings.MJML_TCPSERVER_POOL_SIZE,
+        idle_timeout=mjml_settings.MJML_TCPSERVER_POOL_IDLE_TIMEOUT,
+    ), AsyncTCPConnectionPool.close)
+
+
+async def _tcpserver_request_async(pool: AsyncTCPConnectionPool, data: Tuple[bytes, bytes],
+                                   connect_timeout: float, read_timeout: float) -> Tuple[bool, str]:
+    while True:
+        with measure('connect'):
+            conn, reused = await asyncio.wait_for(pool.acquire(), timeout=connect_timeout)
+        reader, writer = conn
+        header = None
         try:
-            s.connect((host, port))
-        except socket.timeout:
-            timeouts += 1
-            continue
-        except socket.error:
-            continue
+            with measure('transfer'):
+                writer.writelines(data)
+                await asyncio.wait_for(writer.drain(), timeout=read_timeout)
+                header = await asyncio.wait_for(reader.readexactly(10), timeout=read_timeout)
+                result = await asyncio.wait_for(reader.readexactly(int(header[1:])), timeout=read_timeout)
+        except asyncio.TimeoutError:
+            pool.discard(conn)
+            raise
+        except (OSError, asyncio.IncompleteReadError) as e:
+            pool.discard(conn)
+            if reused and header is None:
+                continue  # persistent connection has been closed by server, reconnect
+            if isinstance(e, asyncio.IncompleteReadError):
+                raise ConnectionResetError('Connection closed by MJML TCP server') from e
+            raise
+        except ValueError as e:
+            pool.discard(conn)
+            raise ConnectionError(f'Wrong response from MJML TCP server: {e}') from e
+        except BaseException:
+            pool.discard(conn)  # cancellation, response can't be read anymore
+            raise
+        pool.release(conn)
+        return header[:1] == b'0', result.decode('utf-8')
+
+
+async def _tcpserver_hello_async(conn: Tuple[asyncio.StreamReader, asyncio.StreamWriter],
+                                 timeout: float) -> Optional[List[str]]:
+    reader, writer = conn
+    try:
+        writer.writelines(_get_tcpserver_request_data(_get_tcpserver_hello()))
+        await asyncio.wait_for(writer.drain(), timeout=timeout)
+        header = await asyncio.wait_for(reader.readexactly(10), timeout=timeout)
+        result = await asyncio.wait_for(reader.readexactly(int(header[1:])), timeout=timeout)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionResetError('Connection closed by MJML TCP server') from e
+    except ValueError as e:
+        raise ConnectionError(f'Wrong response from MJML TCP server: {e}') from e
+    return _parse_tcpserver_hello_response(header, result)
+
+
+def _close_async_tcpserver_connection_state(state: Dict) -> None:
+    if state['conn'] is not None:
+        state['conn'].close()
+
+
+async def _get_async_tcpserver_connection(server, connect_timeout: float,
+                                          read_timeout: float) -> Optional[AsyncMultiplexedTCPConnection]:
+    """
+    Async version of _get_tcpserver_connection, the connection is shared by all tasks of the event loop.
+    """
+    address = _get_tcpserver_address(server)
+    protocols = _get_tcpserver_protocols()
+    if protocols.get(address) == 1:
+        return None
+    state = _get_loop_local(('async_tcpserver_connections', address), lambda: {'lock': asyncio.Lock(), 'conn': None},
+                            _close_async_tcpserver_connection_state)
+    async with state['lock']:
+        conn = state['conn']
+        if conn is not None and not conn.closed:
+            return conn
+        pool = _get_async_tcpserver_pool(server)
+        stream = await asyncio.wait_for(pool.connect(), timeout=connect_timeout)
         try:
-            s.sendall(mjml_code_data)
-            ok = force_str(socket_recvall(s, 1)) == '0'
-            a = force_str(socket_recvall(s, 9))
-            result_len = int(a)
-            result = force_str(socket_recvall(s, result_len))
-            if ok:
-                return result
-            else:
-                raise RuntimeError(f'MJML compile error (via MJML TCP server): {result}')
-        except socket.timeout:
-            timeouts += 1
-        finally:
-            s.close()
-    raise RuntimeError(
-        'MJML compile error (via MJML TCP server): no working server\n'
-        f'Number of servers: {len(servers)}\n'
-        f'Timeouts: {timeouts}'
+            options = await _tcpserver_hello_async(stream, read_timeout)
+        except BaseException:
+            pool.discard(stream)
+            raise
+        if options is None:
+            protocols[address] = 1
+            pool.release(stream)
+            return None
+        protocols[address] = 2
+        conn = state['conn'] = AsyncMultiplexedTCPConnection(stream, **_get_multiplexed_connection_kwargs(options))
+        return conn
+
+
+async def _mjml_render_by_tcpserver_async(mjml_code: str) -> str:
+    mjml_code_data = _get_tcpserver_request_data(mjml_code)
+
+    async def request(server, connect_timeout: float, read_timeout: float) -> Tuple[bool, str]:
+        if mjml_settings.MJML_TCPSERVER_PROTOCOL == 'auto':
+            with measure('connect'):
+                conn = await _get_async_tcpserver_connection(server, connect_timeout, read_timeout)
+            if conn is not None:
+                with measure('transfer'):
+                    return await conn.request(mjml_code_data[1], read_timeout)
+        return await _tcpserver_request_async(
+            _get_async_tcpserver_pool(server), mjml_code_data, connect_timeout, read_timeout,
+        )
+
+    ok, result = await _request_servers_async(
+        via='MJML TCP server',
+        servers=mjml_settings.MJML_TCPSERVERS,
+        key=_get_tcpserver_key,
+        request=request,
+        errors=(socket.error,),
+        timeout_errors=(asyncio.TimeoutError,),
     )
+    if ok:
+        return result
+    else:
+        raise RuntimeError(f'MJML compile error (via MJML TCP server): {result}')
 
 
-def _mjml_render_by_httpserver(mjml_code: str) -> str:
+def _make_http_session(server_conf: Dict):
+    import requests.adapters
     import requests.auth
+    from http.cookiejar import DefaultCookiePolicy
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    http_auth = server_conf.get('HTTP_AUTH')
+    if http_auth:
+        session.auth = requests.auth.HTTPBasicAuth(*http_auth)
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))  # don't share cookies between renders
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=mjml_settings.MJML_HTTPSERVER_POOL_SIZE,
+        max_retries=Retry(
+            total=mjml_settings.MJML_HTTPSERVER_MAX_RETRIES,
+            connect=mjml_settings.MJML_HTTPSERVER_MAX_RETRIES,
+            read=0,
+            status=0,
+            backoff_factor=0.1,
+        ),
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-    if len(mjml_settings.MJML_HTTPSERVERS) > 1:
-        servers = list(mjml_settings.MJML_HTTPSERVERS)[:]
-        random.shuffle(servers)
+
+def _get_http_session(server_conf: Dict):
+    http_auth = server_conf.get('HTTP_AUTH')
+    key = ('http_session', server_conf['URL'], tuple(http_auth) if http_auth else None)
+    return _get_process_local(key, lambda: _make_http_session(server_conf))
+
+
+class HTTPServerError(ConnectionError):
+    """
+    MJML HTTP server has responded 5xx (e.g. 502/503 of a proxy while the server restarts),
+    it is a failure of the server, so the request is sent to the next server.
+    """
+
+
+def _check_httpserver_status(status_code: int) -> None:
+    if status_code >= 500:
+        raise HTTPServerError(f'MJML HTTP server has responded {status_code}')
+
+
+def _get_httpserver_result(status_code: int, data: Dict) -> str:
+    if status_code == 200:
+        errors: Optional[List[Dict]] = data.get('errors')
+        if errors:
+            msg_lines = [
+                f'Line: {e.get("line")} Tag: {e.get("tagName")} Message: {e.get("message")}'
+                for e in errors
+            ]
+            msg_str = '\n'.join(msg_lines)
+            raise RuntimeError(f'MJML compile error (via MJML HTTP server): {msg_str}')
+
+        return force_str(data['html'])
     else:
-        servers = mjml_settings.MJML_HTTPSERVERS
+        msg = (
+            f"[code={status_code}, request_id={data.get('request_id', '')}] "
+            f"{data.get('message', 'Unknown error.')}"
+        )
+        raise RuntimeError(f'MJML compile error (via MJML HTTP server): {msg}')
 
-    timeouts = 0
-    for server_conf in servers:
-        http_auth = server_conf.get('HTTP_AUTH')
-        auth = requests.auth.HTTPBasicAuth(*http_auth) if http_auth else None
 
-        try:
-            response = requests.post(
+def _get_httpserver_compressed_data(data: bytes) -> Optional[bytes]:
+    """
+    Return gzipped body of the request if it should be compressed (for servers with enabled COMPRESSION).
+    Responses are compressed by the server if it supports it (Accept-Encoding is sent by HTTP client by default).
+    """
+    min_size = mjml_settings.MJML_COMPRESSION_MIN_SIZE
+    if min_size is None or len(data) < min_size:
+        return None
+    if not any(server_conf.get('COMPRESSION', False) for server_conf in mjml_settings.MJML_HTTPSERVERS):
+        return None
+    return gzip.compress(data, compresslevel=mjml_settings.MJML_COMPRESSION_LEVEL)
+
+
+def _get_httpserver_request_options(server_conf: Dict, data: bytes,
+                                    compressed_data: Optional[bytes]) -> Tuple[bytes, Dict]:
+    """
+    Return body and headers of the request. Compressed body is sent only to the server with enabled COMPRESSION
+    which hasn't rejected it before.
+    """
+    if (
+        compressed_data is None
+        or not server_conf.get('COMPRESSION', False)
+        or server_conf['URL'] in _get_process_local('httpserver_no_compression', set)
+    ):
+        return data, {'Content-Type': 'application/json'}
+    return compressed_data, {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+
+
+def _is_httpserver_compression_rejected(headers: Dict, status_code: int) -> bool:
+    # the server responds 415 Unsupported Media Type if it can't decode the request (RFC 7694),
+    # the stock mjml-http-server ignores Content-Encoding and responds 400 because the body isn't JSON
+    return 'Content-Encoding' in headers and status_code in (400, 415)
+
+
+def _set_httpserver_compression_rejected(server_conf: Dict, status_code: int, retry_status_code: int) -> None:
+    # 400 can be a response to wrong MJML too, then the request without compression gets it as well
+    if status_code == 415 or retry_status_code != 400:
+        _get_process_local('httpserver_no_compression', set).add(server_conf['URL'])
+
+
+def _close_late_http_response(future: concurrent.futures.Future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _mjml_render_by_httpserver(mjml_code: str) -> str:
+    import requests
+
+    mjml_code_data = force_bytes(json.dumps({'mjml': mjml_code}))
+    compressed_data = _get_httpserver_compressed_data(mjml_code_data)
+
+    def post(server_conf: Dict, data: bytes, headers: Dict, connect_timeout: float, read_timeout: float):
+        with measure('transfer'):
+            return _get_http_session(server_conf).post(
                 url=server_conf['URL'],
-                auth=auth,
-                data=force_bytes(json.dumps({'mjml': mjml_code})),
-                headers={'Content-Type': 'application/json'},
-                timeout=25,
+                data=data,
+                headers=headers,
+                timeout=(connect_timeout, read_timeout),
             )
-        except requests.exceptions.Timeout:
-            timeouts += 1
-            continue
 
-        try:
-            data = response.json()
-        except (TypeError, json.JSONDecodeError):
-            data = {}
-
-        if response.status_code == 200:
-            errors: Optional[List[Dict]] = data.get('errors')
-            if errors:
-                msg_lines = [
-                    f'Line: {e.get("line")} Tag: {e.get("tagName")} Message: {e.get("message")}'
-                    for e in errors
-                ]
-                msg_str = '\n'.join(msg_lines)
-                raise RuntimeError(f'MJML compile error (via MJML HTTP server): {msg_str}')
-
-            return force_str(data['html'])
+    def send(server_conf: Dict, connect_timeout: float, read_timeout: float):
+        data, headers = _get_httpserver_request_options(server_conf, mjml_code_data, compressed_data)
+        response = post(server_conf, data, headers, connect_timeout, read_timeout)
+        if _is_httpserver_compression_rejected(headers, response.status_code):
+            retry_response = post(server_conf, mjml_code_data, {'Content-Type': 'application/json'},
+                                  connect_timeout, read_timeout)
+            _set_httpserver_compression_rejected(server_conf, response.status_code, retry_response.status_code)
+            response = retry_response
+        return response
+
+    def request(server_conf: Dict, connect_timeout: float, read_timeout: float):
+        render_deadline = _render_deadline.get()
+        if render_deadline is None:
+            response = send(server_conf, connect_timeout, read_timeout)
         else:
-            msg = (
-                f"[code={response.status_code}, request_id={data.get('request_id', '')}] "
-                f"{data.get('message', 'Unknown error.')}"
+            # requests limits each read of the socket (and each connection retry), so a server which sends
+            # the response slowly could keep the render beyond MJML_RENDER_TIMEOUT: the request is sent from
+            # a thread and the render waits for it up to the deadline
+            executor = _get_request_executor('httpserver', 'httpserver', len(mjml_settings.MJML_HTTPSERVERS))
+            future = executor.submit(contextvars.copy_context().run, send, server_conf, connect_timeout, read_timeout)
+            try:
+                response = future.result(max(render_deadline - time.monotonic(), 0))
+            except concurrent.futures.TimeoutError:
+                future.add_done_callback(_close_late_http_response)
+                raise requests.exceptions.Timeout('MJML HTTP server has not responded in time') from None
+        _check_httpserver_status(response.status_code)
+        return response
+
+    response = _request_servers(
+        via='MJML HTTP server',
+        mode='httpserver',
+        servers=mjml_settings.MJML_HTTPSERVERS,
+        key=_get_httpserver_key,
+        request=request,
+        errors=(requests.exceptions.ConnectionError, HTTPServerError),
+        timeout_errors=(requests.exceptions.Timeout,),
+    )
+
+    try:
+        data = response.json()
+    except (TypeError, json.JSONDecodeError):
+        data = {}
+
+    return _get_httpserver_result(response.status_code, data)
+
+
+def _make_async_http_client(server_conf: Dict):
+    import httpx
+
+    http_auth = server_conf.get('HTTP_AUTH')
+    return httpx.AsyncClient(
+        auth=tuple(http_auth) if http_auth else None,
+        limits=httpx.Limits(max_keepalive_connections=mjml_settings.MJML_HTTPSERVER_POOL_SIZE),
+        transport=httpx.AsyncHTTPTransport(retries=mjml_settings.MJML_HTTPSERVER_MAX_RETRIES),
+    )
+
+
+def _get_async_http_client(server_conf: Dict):
+    # asyncio connections belong to the event loop which has created them
+    http_auth = server_conf.get('HTTP_AUTH')
+    key = ('async_http_clients', server_conf['URL'], tuple(http_auth) if http_auth else None)
+    return _get_loop_local(key, lambda: _make_async_http_client(server_conf), lambda client: client.aclose())
+
+
+async def _mjml_render_by_httpserver_async(mjml_code: str) -> str:
+    try:
+        import httpx
+    except ImportError:
+        return await asyncio.to_thread(_mjml_render_by_httpserver, mjml_code)
+
+    mjml_code_data = force_bytes(json.dumps({'mjml': mjml_code}))
+    compressed_data = _get_httpserver_compressed_data(mjml_code_data)
+
+    async def post(server_conf: Dict, data: bytes, headers: Dict, connect_timeout: float, read_timeout: float):
+        with measure('transfer'):
+            return await _get_async_http_client(server_conf).post(
+                url=server_conf['URL'],
+                content=data,
+                headers=headers,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
             )
-            raise RuntimeError(f'MJML compile error (via MJML HTTP server): {msg}')
 
-    raise RuntimeError(
-        'MJML compile error (via MJML HTTP server): no working server\n'
-        f'Number of servers: {len(servers)}\n'
-        f'Timeouts: {timeouts}'
+    async def request(server_conf: Dict, connect_timeout: float, read_timeout: float):
+        data, headers = _get_httpserver_request_options(server_conf, mjml_code_data, compressed_data)
+        response = await post(server_conf, data, headers, connect_timeout, read_timeout)
+        if _is_httpserver_compression_rejected(headers, response.status_code):
+            retry_response = await post(server_conf, mjml_code_data, {'Content-Type': 'application/json'},
+                                        connect_timeout, read_timeout)
+            _set_httpserver_compression_rejected(server_conf, response.status_code, retry_response.status_code)
+            response = retry_response
+        _check_httpserver_status(response.status_code)
+        return response
+
+    response = await _request_servers_async(
+        via='MJML HTTP server',
+        servers=mjml_settings.MJML_HTTPSERVERS,
+        key=_get_httpserver_key,
+        request=request,
+        errors=(httpx.TransportError, HTTPServerError),
+        timeout_errors=(httpx.TimeoutException, asyncio.TimeoutError),
+    )
+
+    try:
+        data = response.json()
+    except (TypeError, json.JSONDecodeError):
+        data = {}
+
+    return _get_httpserver_result(response.status_code, data)
+
+
+def get_render_cache() -> Optional[RenderCache]:
+    if mjml_settings.MJML_CACHE is None:
+        return None
+    if 'render_cache' not in _cache:
+        _cache['render_cache'] = RenderCache(mjml_settings.MJML_CACHE)
+    return _cache['render_cache']
+
+
+def _check_cmd_lazily() -> None:
+    if mjml_settings.MJML_CHECK_CMD_ON_STARTUP in ('lazy', 'background'):
+        from mjml.checks import check_mjml_command_once
+        check_mjml_command_once()
+
+
+def _get_backend(mode: str):
+    from mjml.backends import get_backend
+    return get_backend(mode)
+
+
+def _get_backend_modes() -> List[str]:
+    return [mjml_settings.MJML_BACKEND_MODE] + list(mjml_settings.MJML_FALLBACK_BACKEND_MODES)
+
+
+def _get_backend_limiter(mode: str) -> Optional[threading.BoundedSemaphore]:
+    max_concurrency = mjml_settings.MJML_BACKEND_MAX_CONCURRENCY.get(mode)
+    if max_concurrency is None:
+        return None
+    return _get_process_local(('backend_limiter', mode), lambda: threading.BoundedSemaphore(max_concurrency))
+
+
+def _get_backends_busy_error() -> BackendUnavailableError:
+    return BackendUnavailableError(
+        'MJML compile error: all backends are busy (settings.MJML_BACKEND_MAX_CONCURRENCY)'
     )
 
 
+def _set_render_info_backend(mode: str, is_fallback: bool) -> None:
+    info = get_render_info()
+    if info is not None:
+        info.backend = mode
+        if is_fallback:
+            info.fallbacks += 1
+
+
+def _mjml_render(mjml_source: str, modes: Optional[List[str]] = None) -> str:
+    """
+    Render by MJML_BACKEND_MODE or by the next backend of MJML_FALLBACK_BACKEND_MODES if the backend is unavailable,
+    its circuit is open or it renders MJML_BACKEND_MAX_CONCURRENCY sources already. The last backend is always tried,
+    it waits for a free slot up to MJML_RENDER_TIMEOUT. Backend modes can be given instead of the settings.
+    """
+    if modes is None:
+        modes = _get_backend_modes()
+    for i, mode in enumerate(modes):
+        is_last = i == len(modes) - 1
+        backend = _get_backend(mode)
+        if not is_last and backend.is_circuit_open():
+            continue
+        limiter = _get_backend_limiter(mode)
+        if limiter is not None:
+            if is_last:
+                acquired = limiter.acquire(timeout=mjml_settings.MJML_RENDER_TIMEOUT)
+            else:
+                acquired = limiter.acquire(blocking=False)
+            if not acquired:
+                if is_last:
+                    raise _get_backends_busy_error()
+                continue
+        try:
+            _set_render_info_backend(mode, is_fallback=mode != mjml_settings.MJML_BACKEND_MODE)
+            return backend.render(mjml_source)
+        except BackendUnavailableError:
+            if is_last:
+                raise
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+
+def _mjml_render_or_error(mjml_source: str, modes: List[str]) -> Union[str, Exception]:
+    try:
+        return _mjml_render(mjml_source, modes)
+    except Exception as e:
+        return e
+
+
+def _mjml_render_many(mjml_sources: List[str], max_workers: int) -> List[Union[str, Exception]]:
+    """
+    Render sources by render_many() of MJML_BACKEND_MODE, it takes one slot of MJML_BACKEND_MAX_CONCURRENCY.
+    Like _mjml_render(), the sources are passed to the backends of MJML_FALLBACK_BACKEND_MODES (one by one)
+    if the backend is unavailable, its circuit is open or it's busy.
+    """
+    mode, *fallback_modes = _get_backend_modes()
+    backend = _get_backend(mode)
+    htmls: Optional[List[Union[str, Exception]]] = None
+    if not fallback_modes or not backend.is_circuit_open():
+        limiter = _get_backend_limiter(mode)
+        if limiter is not None:
+            if fallback_modes:
+                acquired = limiter.acquire(blocking=False)
+            else:
+                acquired = limiter.acquire(timeout=mjml_settings.MJML_RENDER_TIMEOUT)
+            if not acquired and not fallback_modes:
+                raise _get_backends_busy_error()
+        if limiter is None or acquired:
+            try:
+                htmls = backend.render_many(mjml_sources, max_workers)
+            except BackendUnavailableError:
+                if not fallback_modes:
+                    raise
+            finally:
+                if limiter is not None:
+                    limiter.release()
+    if not fallback_modes:
+        return htmls
+    if htmls is None:
+        htmls = [None] * len(mjml_sources)
+        indexes = list(range(len(mjml_sources)))
+    else:
+        htmls = list(htmls)
+        indexes = [i for i, html in enumerate(htmls) if isinstance(html, BackendUnavailableError)]
+    if indexes:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(max_workers, len(indexes)), 1)) as executor:
+            results = executor.map(_mjml_render_or_error, [mjml_sources[i] for i in indexes],
+                                   [fallback_modes] * len(indexes))
+            for i, html in zip(indexes, results):
+                htmls[i] = html
+    return htmls
+
+
+def _get_single_flight_key(mjml_source: str) -> str:
+    return hashlib.sha256(force_bytes(mjml_source)).hexdigest()
+
+
+def _set_render_info_before_backend() -> None:
+    info = get_render_info()
+    if info is not None:
+        if info.cache is not None:
+            info.cache = 'miss'
+        info.coalesced = mjml_settings.MJML_COALESCE_RENDERS  # until the render calls the backend itself
+
+
+def _mjml_render_leader(mjml_source: str) -> str:
+    info = get_render_info()
+    if info is not None:
+        info.coalesced = False
+    return _mjml_render(mjml_source)
+
+
+def _mjml_render_coalesced(mjml_source: str) -> str:
+    # concurrent renders of the same source wait for one request to the backend
+    _set_render_info_before_backend()
+    if not mjml_settings.MJML_COALESCE_RENDERS:
+        return _mjml_render(mjml_source)
+    single_flight = _get_process_local('single_flight', SingleFlight)
+    return single_flight.do(_get_single_flight_key(mjml_source), _mjml_render_leader, mjml_source)
+
+
+def _get_render_cache_for_render() -> Optional[RenderCache]:
+    render_cache = get_render_cache()
+    info = get_render_info()
+    if render_cache is not None and info is not None:
+        info.cache = 'hit'  # until the render function is called
+    return render_cache
+
+
+def _mjml_render_cached(mjml_source: str) -> str:
+    render_cache = _get_render_cache_for_render()
+    if render_cache is not None:
+        return render_cache.get_or_render(mjml_source, _mjml_render_coalesced)
+    return _mjml_render_coalesced(mjml_source)
+
+
 def mjml_render(mjml_source: str) -> str:
-    if mjml_settings.MJML_BACKEND_MODE == 'cmd':
-        return _mjml_render_by_cmd(mjml_source)
-    elif mjml_settings.MJML_BACKEND_MODE == 'tcpserver':
-        return _mjml_render_by_tcpserver(mjml_source)
-    elif mjml_settings.MJML_BACKEND_MODE == 'httpserver':
-        return _mjml_render_by_httpserver(mjml_source)
-    raise RuntimeError(f'Invalid settings.MJML_BACKEND_MODE "{mjml_settings.MJML_BACKEND_MODE}"')
+    if not is_instrumentation_enabled():
+        return _mjml_render_cached(mjml_source)
+    with track_render(mjml_settings.MJML_BACKEND_MODE, mjml_source) as info:
+        html = _mjml_render_cached(mjml_source)
+        info.output_size = len(html.encode('utf-8'))
+    return html
+
+
+async def _acquire_backend_limiter_async(limiter: threading.BoundedSemaphore) -> bool:
+    # the limiter is shared with threads, so it is polled instead of blocking the event loop
+    deadline = _get_deadline()
+    while not limiter.acquire(blocking=False):
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.005)
+    return True
+
+
+async def _mjml_render_async(mjml_source: str) -> str:
+    """
+    Async version of _mjml_render.
+    """
+    modes = _get_backend_modes()
+    for i, mode in enumerate(modes):
+        is_last = i == len(modes) - 1
+        backend = _get_backend(mode)
+        if not is_last and backend.is_circuit_open():
+            continue
+        limiter = _get_backend_limiter(mode)
+        if limiter is not None:
+            acquired = await _acquire_backend_limiter_async(limiter) if is_last else limiter.acquire(blocking=False)
+            if not acquired:
+                if is_last:
+                    raise _get_backends_busy_error()
+                continue
+        try:
+            _set_render_info_backend(mode, is_fallback=i > 0)
+            return await backend.render_async(mjml_source)
+        except BackendUnavailableError:
+            if is_last:
+                raise
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+
+def _get_async_single_flight() -> AsyncSingleFlight:
+    single_flights = _get_process_local('async_single_flights', weakref.WeakKeyDictionary)
+    loop = asyncio.get_running_loop()
+    single_flight = single_flights.get(loop)
+    if single_flight is None:
+        single_flight = single_flights[loop] = AsyncSingleFlight()
+    return single_flight
+
+
+async def _mjml_render_leader_async(mjml_source: str) -> str:
+    info = get_render_info()
+    if info is not None:
+        info.coalesced = False
+    return await _mjml_render_async(mjml_source)
+
+
+async def _mjml_render_coalesced_async(mjml_source: str) -> str:
+    _set_render_info_before_backend()
+    if not mjml_settings.MJML_COALESCE_RENDERS:
+        return await _mjml_render_async(mjml_source)
+    return await _get_async_single_flight().do(
+        _get_single_flight_key(mjml_source), _mjml_render_leader_async, mjml_source,
+    )
+
+
+async def _mjml_render_cached_async(mjml_source: str) -> str:
+    render_cache = _get_render_cache_for_render()
+    if render_cache is not None:
+        return await render_cache.get_or_render_async(mjml_source, _mjml_render_coalesced_async)
+    return await _mjml_render_coalesced_async(mjml_source)
+
+
+async def mjml_render_async(mjml_source: str) -> str:
+    if not is_instrumentation_enabled():
+        return await _mjml_render_cached_async(mjml_source)
+    with track_render(mjml_settings.MJML_BACKEND_MODE, mjml_source) as info:
+        html = await _mjml_render_cached_async(mjml_source)
+        info.output_size = len(html.encode('utf-8'))
+    return html
+
+
+def _get_default_max_workers() -> int:
+    return _get_backend(mjml_settings.MJML_BACKEND_MODE).get_max_workers()
+
+
+def _send_render_many_info(mjml_sources: List[str], htmls: List[Union[str, Exception]], rendered: set,
+                           cache_enabled: bool, duration: float) -> None:
+    for mjml_source, html in zip(mjml_sources, htmls):
+        info = RenderInfo(mjml_settings.MJML_BACKEND_MODE, len(mjml_source.encode('utf-8')))
+        if cache_enabled:
+            info.cache = 'miss' if mjml_source in rendered else 'hit'
+        if mjml_source in rendered:
+            info.batch_size = len(rendered)
+            info.add_timing('compile', duration)
+        info.duration = duration
+        if isinstance(html, Exception):
+            info.error = html
+        else:
+            info.output_size = len(html.encode('utf-8'))
+        send_render_info(info)
+
+
+def mjml_render_many(mjml_sources: Iterable[str], max_workers: Optional[int] = None,
+                     return_exceptions: bool = False) -> List[Union[str, Exception]]:
+    """
+    Render several MJML sources concurrently and return list of HTML in the same order.
+    Identical sources are rendered once. If the backend supports batch render, the sources are compiled together
+    (in cmd mode by a few runs of mjml command, see settings.MJML_CMD_BATCH).
+    If return_exceptions is True then an exception is returned in place of HTML of the failed source,
+    otherwise the first exception is raised.
+    """
+    mjml_sources = list(mjml_sources)
+    unique_sources = list(dict.fromkeys(mjml_sources))
+    backend = _get_backend(mjml_settings.MJML_BACKEND_MODE)
+    if max_workers is None:
+        max_workers = _get_default_max_workers()
+    max_workers = max(min(max_workers, len(unique_sources)), 1)
+
+    if backend.batch_render and len(unique_sources) > 1:
+        rendered = set()
+
+        def render_many(sources: List[str]) -> List[Union[str, Exception]]:
+            rendered.update(sources)
+            return _mjml_render_many(sources, max(min(max_workers, len(sources)), 1))
+
+        start = time.perf_counter()
+        render_cache = get_render_cache()
+        try:
+            if render_cache is not None:
+                htmls = render_cache.get_or_render_many(unique_sources, render_many)
+            else:
+                htmls = render_many(unique_sources)
+        except Exception as e:
+            htmls = [e] * len(unique_sources)
+        if is_instrumentation_enabled():
+            _send_render_many_info(
+                unique_sources, htmls, rendered, render_cache is not None, time.perf_counter() - start,
+            )
+        if not return_exceptions:
+            for html in htmls:
+                if isinstance(html, Exception):
+                    raise html
+        results = dict(zip(unique_sources, htmls))
+        return [results[mjml_source] for mjml_source in mjml_sources]
+
+    def render(mjml_source: str) -> Union[str, Exception]:
+        try:
+            return mjml_render(mjml_source)
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            return e
+
+    if max_workers == 1:
+        results = {mjml_source: render(mjml_source) for mjml_source in unique_sources}
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {mjml_source: executor.submit(render, mjml_source) for mjml_source in unique_sources}
+            try:
+                results = {mjml_source: future.result() for mjml_source, future in futures.items()}
+            except Exception:
+                for future in futures.values():
+                    future.cancel()
+                raise
+    return [results[mjml_source] for mjml_source in mjml_sources]
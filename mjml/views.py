@@ -0,0 +1,11 @@
+from django.http import HttpResponse
+
+from mjml.stats import format_prometheus, get_stats_snapshot
+
+
+def metrics(request) -> HttpResponse:
+    """
+    Stats of renders in Prometheus text format (settings.MJML_STATS must be True).
+    Add it to urls behind authentication or an internal-only host.
+    """
+    return HttpResponse(format_prometheus(get_stats_snapshot()), content_type='text/plain; version=0.0.4; charset=utf-8')
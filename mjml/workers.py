@@ -0,0 +1,163 @@
+import os
+import queue
+import select
+import subprocess
+import time
+from typing import Dict, List, Optional, Tuple
+
+from mjml.instrumentation import measure
+
+WORKER_JS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'node', 'worker.js')
+
+
+class WorkerDiedError(Exception):
+    pass
+
+
+class WorkerTimeoutError(WorkerDiedError):
+    pass
+
+
+class WorkerStartError(RuntimeError):
+    pass
+
+
+class NodeWorker:
+    """
+    Long-lived Node.js process that renders MJML using mjml/node/worker.js.
+    """
+
+    def __init__(self, cmd_args: List[str], env: Optional[Dict[str, str]], max_renders: int) -> None:
+        self.cmd_args = cmd_args
+        self.env = env
+        self.max_renders = max_renders
+        self.renders = 0
+        self._process: Optional[subprocess.Popen] = None
+
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def start(self) -> None:
+        try:
+            self._process = subprocess.Popen(
+                self.cmd_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=self.env,
+            )
+            os.set_blocking(self._process.stdin.fileno(), False)
+        except (IOError, OSError) as e:
+            cmd_str = ' '.join(self.cmd_args)
+            raise WorkerStartError(
+                f'Problem to run command "{cmd_str}"\n'
+                f'{e}\n'
+                'Check that node is installed and allow permissions to execute.'
+            ) from e
+        self.renders = 0
+
+    def stop(self) -> None:
+        p, self._process = self._process, None
+        if p is None:
+            return
+        for f in (p.stdin, p.stdout):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        try:
+            p.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+
+    def kill(self) -> None:
+        if self._process is not None:
+            self._process.kill()
+        self.stop()
+
+    def _wait(self, fd: int, for_write: bool, deadline: Optional[float]) -> None:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        fds = ([], [fd]) if for_write else ([fd], [])
+        if (remaining is not None and remaining <= 0) or not any(select.select(fds[0], fds[1], [], remaining)[:2]):
+            raise WorkerTimeoutError('MJML worker process has not responded in time')
+
+    def _write(self, data: bytes, deadline: Optional[float]) -> None:
+        fd = self._process.stdin.fileno()
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(fd, view):]
+            except BlockingIOError:
+                self._wait(fd, True, deadline)
+
+    def _read(self, size: int, deadline: Optional[float]) -> bytes:
+        fd = self._process.stdout.fileno()
+        result = bytearray()
+        while len(result) < size:
+            self._wait(fd, False, deadline)
+            chunk = os.read(fd, size - len(result))
+            if not chunk:
+                raise WorkerDiedError(f'MJML worker process died unexpectedly (exit code {self._process.poll()})')
+            result += chunk
+        return bytes(result)
+
+    def render(self, data: bytes, deadline: Optional[float] = None) -> Tuple[bool, bytes]:
+        """
+        Render data in the worker process. If the worker doesn't respond before the deadline
+        (time.monotonic() based), it is killed and WorkerTimeoutError is raised.
+        """
+        if not self.is_alive():
+            self.stop()
+            self.start()
+        try:
+            self._write(b'%09d' % len(data) + data, deadline)
+            header = self._read(10, deadline)
+            result = self._read(int(header[1:]), deadline)
+        except WorkerTimeoutError:
+            self.kill()
+            raise
+        except (IOError, OSError, ValueError) as e:
+            self.stop()
+            raise WorkerDiedError(f'MJML worker process died unexpectedly: {e}') from e
+        except WorkerDiedError:
+            self.stop()
+            raise
+        self.renders += 1
+        if self.max_renders and self.renders >= self.max_renders:
+            self.stop()
+        return header[:1] == b'0', result
+
+
+class NodeWorkerPool:
+    """
+    Thread-safe pool of NodeWorker processes. Workers are started lazily on first use.
+    """
+
+    def __init__(self, size: int, cmd_args: List[str], env: Optional[Dict[str, str]], max_renders: int) -> None:
+        self.workers = [NodeWorker(cmd_args, env, max_renders) for _ in range(size)]
+        self._idle = queue.LifoQueue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def render(self, data: bytes, timeout: Optional[float] = None) -> Tuple[bool, bytes]:
+        """
+        Render data in an idle worker. Waiting for the worker and rendering are limited by timeout (seconds).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with measure('queue'):
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise WorkerTimeoutError('All MJML worker processes are busy') from None
+        try:
+            with measure('compile'):
+                try:
+                    return worker.render(data, deadline)
+                except WorkerTimeoutError:
+                    raise
+                except WorkerDiedError:
+                    # crash recovery: retry once in a fresh process
+                    return worker.render(data, deadline)
+        finally:
+            self._idle.put(worker)
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.stop()
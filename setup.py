@@ -24,6 +24,9 @@ setup(
         'requests': [
             'requests >=2.24',
         ],
+        'httpx': [
+            'httpx >=0.23',
+        ],
     },
     keywords=[
         'django', 'mjml', 'django-mjml', 'email', 'layout', 'template', 'templatetag',
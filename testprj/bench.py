@@ -0,0 +1,251 @@
+"""
+Benchmark of backend modes: throughput and latency for different template sizes, concurrency levels and cache states.
+
+    python tools.py bench --output bench.json
+    python tools.py bench --mode tcpserver --size simple --concurrency 8 --compare bench.json
+
+Servers of tcpserver and httpserver modes are started locally as in tests (see testprj.tools.MJMLServers),
+with --fake they are replaced by pure-Python stand-ins (see testprj.fakeserver) to measure the client side only.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import django
+
+from mjml import settings as mjml_settings
+from mjml import tools
+from mjml.tools import mjml_render
+from testprj.fakeserver import FakeMJMLHTTPServer, FakeMJMLTCPServer
+from testprj.tools import MJMLFixtures, MJMLServers, get_mjml_version, safe_change_mjml_settings
+
+MODES = ('cmd', 'worker', 'tcpserver', 'httpserver')
+SIZES = ('small', 'simple', 'large')
+CACHE_STATES = ('off', 'cold', 'warm')
+CONCURRENCY_LEVELS = (1, 4, 16)
+
+# default number of renders per case (at least the concurrency level)
+SIZE_REQUESTS = {
+    'small': 100,
+    'simple': 100,
+    'large': 4,
+}
+
+# the same payload as in test_large_tpl tests (~8 MB)
+LARGE_TEXT = '[START]' + ('1 2 3 4 5 6 7 8 9 0 ' * 410 * 1024) + '[END]'
+
+
+def _get_fixture_source(name: str) -> str:
+    source = MJMLFixtures.TPLS[name].replace('{% mjml %}', '').replace('{% endmjml %}', '')
+    if get_mjml_version() >= 4:
+        source = source.replace('<mj-container>', '').replace('</mj-container>', '')
+    return source
+
+
+def get_source_factory(size: str) -> Callable[[int], str]:
+    """
+    Return a function which makes the unique MJML source of the given size by its number.
+    """
+    if size == 'small':
+        source = _get_fixture_source('with_text_context')
+        return lambda n: source.replace('{{ text }}', f'Hello {n}')
+    if size == 'simple':
+        source = _get_fixture_source('simple')
+        return lambda n: source.replace('Test title', f'Test title {n}')
+    if size == 'large':
+        source = _get_fixture_source('with_text_context')
+        return lambda n: source.replace('{{ text }}', f'{n} {LARGE_TEXT}')
+    raise ValueError(f'Unknown size: {size}')
+
+
+def get_percentile(sorted_values: List[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(percentile / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_case(size: str, concurrency: int, cache: str, requests: int) -> Dict:
+    """
+    Render the sources in the current backend mode and return throughput and latency.
+    Every render gets a unique source, except the warm cache state where the cached source is rendered.
+    """
+    mjml_settings.MJML_CACHE = None if cache == 'off' else {}
+    tools._cache.pop('render_cache', None)
+    make_source = get_source_factory(size)
+    if cache == 'warm':
+        warm_source = make_source(0)
+        mjml_render(warm_source)
+
+    def render(n: int) -> Optional[float]:
+        mjml_source = warm_source if cache == 'warm' else make_source(n + 1)
+        started = time.perf_counter()
+        try:
+            mjml_render(mjml_source)
+        except RuntimeError:
+            return None
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(render, range(requests)))
+    total_time = time.perf_counter() - started
+    latencies = sorted(r for r in results if r is not None)
+    return {
+        'size': size,
+        'concurrency': concurrency,
+        'cache': cache,
+        'requests': requests,
+        'errors': requests - len(latencies),
+        'total_time': total_time,
+        'throughput': len(latencies) / total_time if total_time else 0.0,
+        'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50': get_percentile(latencies, 50),
+        'p95': get_percentile(latencies, 95),
+        'p99': get_percentile(latencies, 99),
+        'max': latencies[-1] if latencies else 0.0,
+    }
+
+
+def _start_fake_servers(mode: str, latency: float) -> List:
+    if mode == 'tcpserver':
+        servers = [FakeMJMLTCPServer(latency=latency).start() for _ in mjml_settings.MJML_TCPSERVERS]
+        mjml_settings.MJML_TCPSERVERS = [server.address for server in servers]
+    else:
+        servers = [FakeMJMLHTTPServer(latency=latency).start() for _ in mjml_settings.MJML_HTTPSERVERS]
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': server.url} for server in servers]
+    return servers
+
+
+def run_mode(mode: str, sizes, concurrency_levels, cache_states, requests: Optional[int],
+             fake_latency: Optional[float] = None) -> List[Dict]:
+    results = []
+    fake_servers = []
+    with safe_change_mjml_settings():
+        mjml_settings.MJML_BACKEND_MODE = mode
+        if mode in ('tcpserver', 'httpserver') and fake_latency is not None:
+            fake_servers = _start_fake_servers(mode, fake_latency)
+        elif mode == 'tcpserver':
+            MJMLServers._start_tcp_servers()
+        elif mode == 'httpserver':
+            MJMLServers._start_http_servers()
+        try:
+            # start processes and open connections before measuring
+            mjml_render(get_source_factory('small')(0))
+            for size in sizes:
+                for concurrency in concurrency_levels:
+                    for cache in cache_states:
+                        case_requests = requests or max(SIZE_REQUESTS[size], concurrency)
+                        result = dict(mode=mode, fake=bool(fake_servers),
+                                      **run_case(size, concurrency, cache, case_requests))
+                        print(format_result(result), file=sys.stderr)
+                        results.append(result)
+        finally:
+            for server in fake_servers:
+                server.stop()
+            MJMLServers._terminate_processes()
+    return results
+
+
+def format_result(result: Dict) -> str:
+    return (
+        f'{result["mode"]:<11} {result["size"]:<7} c={result["concurrency"]:<3} cache={result["cache"]:<5} '
+        f'{result["throughput"]:9.1f} r/s  p50={result["p50"] * 1000:8.1f}ms  p95={result["p95"] * 1000:8.1f}ms  '
+        f'p99={result["p99"] * 1000:8.1f}ms  errors={result["errors"]}'
+    )
+
+
+def _get_case_key(result: Dict):
+    return result['mode'], result['size'], result['concurrency'], result['cache'], result.get('fake', False)
+
+
+def compare_results(results: List[Dict], baseline: List[Dict], threshold: float) -> List[str]:
+    """
+    Return descriptions of cases whose throughput has dropped or p95 latency has grown more than threshold (0.1 = 10%).
+    """
+    baseline_by_key = {_get_case_key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_by_key.get(_get_case_key(result))
+        if base is None:
+            continue
+        case = '{} {} c={} cache={}{}'.format(*_get_case_key(result)[:4], ' (fake)' if result.get('fake') else '')
+        if base['throughput'] and result['throughput'] < base['throughput'] * (1 - threshold):
+            regressions.append(f'{case}: throughput {base["throughput"]:.1f} -> {result["throughput"]:.1f} r/s')
+        if base['p95'] and result['p95'] > base['p95'] * (1 + threshold):
+            regressions.append(f'{case}: p95 {base["p95"] * 1000:.1f} -> {result["p95"] * 1000:.1f} ms')
+    return regressions
+
+
+def _get_list_arg(choices):
+    def parse(value: str):
+        values = value.split(',')
+        for v in values:
+            if v not in choices:
+                raise argparse.ArgumentTypeError(f'invalid choice: {v} (choose from {", ".join(choices)})')
+        return values
+    return parse
+
+
+def _get_int_list_arg(value: str) -> List[int]:
+    try:
+        return [int(v) for v in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid list of numbers: {value}')
+
+
+def main(*args) -> int:
+    parser = argparse.ArgumentParser(prog='tools.py bench', description='Benchmark of MJML backend modes.')
+    parser.add_argument('--mode', type=_get_list_arg(MODES), default=list(MODES),
+                        help='Comma-separated backend modes (default: all).')
+    parser.add_argument('--size', type=_get_list_arg(SIZES), default=list(SIZES),
+                        help='Comma-separated template sizes (default: all).')
+    parser.add_argument('--concurrency', type=_get_int_list_arg, default=list(CONCURRENCY_LEVELS),
+                        help='Comma-separated concurrency levels (default: 1,4,16).')
+    parser.add_argument('--cache', type=_get_list_arg(CACHE_STATES), default=list(CACHE_STATES),
+                        help='Comma-separated cache states: off, cold (every render is a miss), warm (default: all).')
+    parser.add_argument('--requests', type=int, default=None,
+                        help='Renders per case (default: depends on the size).')
+    parser.add_argument('--fake', type=float, nargs='?', const=0.0, default=None, metavar='LATENCY',
+                        help='Use fake servers with the given latency in seconds (default: 0) '
+                             'in tcpserver and httpserver modes.')
+    parser.add_argument('-o', '--output', help='Write results as JSON to the file (default: stdout).')
+    parser.add_argument('--compare', help='JSON file with results of a previous run to compare with.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed regression against --compare results (default: 0.2 = 20%%).')
+    options = parser.parse_args(args)
+
+    results = []
+    for mode in options.mode:
+        results.extend(run_mode(mode, options.size, options.concurrency, options.cache, options.requests,
+                                options.fake))
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'mjml_version': get_mjml_version(),
+        },
+        'results': results,
+    }
+    report_json = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            f.write(report_json + '\n')
+    else:
+        print(report_json)
+
+    if options.compare:
+        with open(options.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare_results(results, baseline, options.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
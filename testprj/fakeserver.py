@@ -0,0 +1,502 @@
+"""
+Pure-Python stand-ins for MJML TCP server (https://github.com/liminspace/mjml-tcpserver) and MJML HTTP server
+(``/v1/render`` API) to test failover, pooling and timeouts without Node.js.
+
+HTML isn't compiled from MJML, the server wraps the source into a fake HTML document (see fake_render).
+Latency, errors, timeouts and throughput are configurable:
+
+    with FakeMJMLTCPServer(latency=(0.01, 0.05), error_rate=0.1, timeout_rate=0.01) as server:
+        mjml_settings.MJML_TCPSERVERS = [server.address]
+        ...
+
+Standalone server (prints "READY <host>:<port>" when it accepts connections):
+
+    python -m testprj.fakeserver tcp --port 28101 --latency 0.02
+    python -m testprj.fakeserver tcp --unix /tmp/mjml.sock
+"""
+import argparse
+import base64
+import functools
+import gzip
+import json
+import os
+import random
+import socket
+import socketserver
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+FAKE_MJML_VERSION = '4.0.0-fake'
+# hello request which switches the connection to protocol 2 (see mjml.tools.TCPSERVER_PROTOCOL_2)
+TCPSERVER_PROTOCOL_2 = 'mjml-tcpserver-protocol: 2'
+TCPSERVER_COMPRESSION = 'compression: zlib'
+
+
+def fake_render(mjml_source: str) -> Tuple[bool, str]:
+    """
+    Return (ok, html or error message). The source is put into the body as is, so texts of MJML are found in HTML.
+    """
+    if '<mjml' not in mjml_source:
+        return False, 'Line 1 (mjml) — Malformed MJML. Check that your structure is correct and enclosed in <mjml> tags.'
+    return True, (
+        '<!doctype html><html xmlns="http://www.w3.org/1999/xhtml"><head><title></title></head>'
+        f'<body>{mjml_source}</body></html>'
+    )
+
+
+def _recvall(sock: socket.socket, size: int) -> Optional[bytes]:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 65536))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+class FakeServerTimeout(Exception):
+    pass
+
+
+class FakeMJMLServer:
+    """
+    Base class of fake servers.
+
+    latency: seconds or (min, max) of random delay of every render
+    error_rate: part of renders (0..1) which return MJML compile error
+    timeout_rate: part of renders (0..1) which don't get a response, the connection is closed after hang_time
+    max_concurrency: max number of renders processed at the same time, the others wait
+    max_rps: max number of renders per second, the others wait
+    max_protocol: 2 - TCP server accepts multiplexed protocol 2 (see mjml.pool.MultiplexedTCPConnection), 1 - old server
+    compression: server accepts compressed requests and compresses responses of compress_min_size bytes and larger
+    """
+    server_class = NotImplemented
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: Union[float, Tuple[float, float]] = 0.0,
+                 error_rate: float = 0.0, timeout_rate: float = 0.0, hang_time: float = 60.0,
+                 max_concurrency: Optional[int] = None, max_rps: Optional[float] = None,
+                 render: Callable[[str], Tuple[bool, str]] = fake_render, seed: Optional[int] = None,
+                 max_protocol: int = 2, compression: bool = True, compress_min_size: int = 1024) -> None:
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang_time = hang_time
+        self.render = render
+        self.max_protocol = max_protocol
+        self.compression = compression
+        self.compress_min_size = compress_min_size
+        self.ready = threading.Event()
+        self.stats: Dict[str, int] = {
+            'connections': 0, 'requests': 0, 'errors': 0, 'timeouts': 0, 'multiplexed': 0, 'compressed': 0,
+        }
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._semaphore = threading.Semaphore(max_concurrency) if max_concurrency else None
+        self._interval = 1 / max_rps if max_rps else None
+        self._next_time = 0.0
+        self._connections: Set[socket.socket] = set()
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.host, self.port
+
+    def start(self) -> 'FakeMJMLServer':
+        """
+        Bind the socket and serve in a background thread. The server accepts connections when the method returns.
+        """
+        self._stopped.clear()
+        self._server = self._bind()
+        self._server.daemon_threads = True
+        self._server.block_on_close = False
+        self._server.fake_server = self
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05},
+                                        name=f'fake-mjml-server-{self.address}', daemon=True)
+        self._thread.start()
+        self.ready.set()
+        return self
+
+    def _bind(self):
+        server = self.server_class((self.host, self.port), self._get_handler_class())
+        self.port = server.server_address[1]
+        return server
+
+    def stop(self) -> None:
+        if self._server is None:
+            return
+        self.ready.clear()
+        self._stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+        self.close_connections()
+        self._thread.join()
+        self._server = self._thread = None
+
+    def close_connections(self) -> None:
+        """
+        Close all open connections (as the server does on restart).
+        """
+        with self._lock:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self) -> 'FakeMJMLServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _incr(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def _add_connection(self, conn: socket.socket) -> None:
+        with self._lock:
+            self._connections.add(conn)
+            self.stats['connections'] += 1
+
+    def _remove_connection(self, conn: socket.socket) -> None:
+        with self._lock:
+            self._connections.discard(conn)
+
+    def _wait_throughput(self) -> None:
+        if self._interval is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start_time = max(self._next_time, now)
+            self._next_time = start_time + self._interval
+        self._stopped.wait(start_time - now)
+
+    def process(self, mjml_source: str) -> Tuple[bool, str]:
+        """
+        Return (ok, html or error message) with configured delays and failures or raise FakeServerTimeout.
+        """
+        self._incr('requests')
+        with self._lock:
+            latency = self._random.uniform(*self.latency) if isinstance(self.latency, tuple) else self.latency
+            roll = self._random.random()
+        if roll < self.timeout_rate:
+            self._incr('timeouts')
+            self._stopped.wait(self.hang_time)
+            raise FakeServerTimeout()
+        self._wait_throughput()
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+        try:
+            if latency:
+                self._stopped.wait(latency)
+            if roll < self.timeout_rate + self.error_rate:
+                self._incr('errors')
+                return False, 'Line 1 (mj-body) — Fake error.'
+            return self.render(mjml_source)
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def _get_handler_class(self):
+        raise NotImplementedError
+
+    def _get_hello_options(self, data: bytes) -> Optional[List[str]]:
+        """
+        Return options of protocol 2 accepted by the server if data is the hello request, otherwise None.
+        """
+        if self.max_protocol < 2 or not (data.startswith(b'<!-- ') and data.endswith(b' -->')):
+            return None
+        options = data[5:-4].decode('utf-8', errors='replace').split('; ')
+        if options[0] != TCPSERVER_PROTOCOL_2:
+            return None
+        return [TCPSERVER_PROTOCOL_2] + [o for o in options[1:] if o == TCPSERVER_COMPRESSION and self.compression]
+
+    def _compress(self, data: bytes, compress: Callable[[bytes], bytes]) -> Optional[bytes]:
+        """
+        Return compressed data if it's large enough to be compressed.
+        """
+        return compress(data) if len(data) >= self.compress_min_size else None
+
+
+class _TCPHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        fake_server: FakeMJMLServer = self.server.fake_server
+        fake_server._add_connection(self.request)
+        try:
+            while True:
+                header = _recvall(self.request, 9)
+                if header is None:
+                    return
+                data = _recvall(self.request, int(header))
+                if data is None:
+                    return
+                options = fake_server._get_hello_options(data)
+                if options is not None:
+                    ack = '; '.join(options).encode('utf-8')
+                    self.request.sendall(b'0%09d' % len(ack) + ack)
+                    self.handle_multiplexed(compression=TCPSERVER_COMPRESSION in options)
+                    return
+                try:
+                    ok, result = fake_server.process(data.decode('utf-8'))
+                except FakeServerTimeout:
+                    return
+                result_data = result.encode('utf-8')
+                self.request.sendall(b'%d%09d' % (0 if ok else 1, len(result_data)) + result_data)
+        except (OSError, ValueError):
+            return
+        finally:
+            fake_server._remove_connection(self.request)
+
+    def handle_multiplexed(self, compression: bool) -> None:
+        """
+        Protocol 2: every request is processed in its own thread, responses are sent as soon as they are ready.
+        """
+        fake_server: FakeMJMLServer = self.server.fake_server
+        send_lock = threading.Lock()
+
+        def process(request_id: bytes, mjml_source: str) -> None:
+            try:
+                ok, result = fake_server.process(mjml_source)
+            except FakeServerTimeout:
+                return  # no response, other requests of the connection aren't affected
+            result_data, encoding = result.encode('utf-8'), b''
+            if compression:
+                compressed = fake_server._compress(result_data, zlib.compress)
+                result_data, encoding = (result_data, b'0') if compressed is None else (compressed, b'z')
+            try:
+                with send_lock:
+                    self.request.sendall(
+                        b'%d%s%s%09d' % (0 if ok else 1, request_id, encoding, len(result_data)) + result_data
+                    )
+            except OSError:
+                pass
+
+        while True:
+            header = _recvall(self.request, 18 if compression else 17)
+            if header is None:
+                return
+            data = _recvall(self.request, int(header[-9:]))
+            if data is None:
+                return
+            fake_server._incr('multiplexed')
+            if header[8:-9] == b'z':
+                fake_server._incr('compressed')
+                data = zlib.decompress(data)
+            threading.Thread(target=process, args=(header[:8], data.decode('utf-8')), daemon=True).start()
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+class FakeMJMLTCPServer(FakeMJMLServer):
+    """
+    The protocol of mjml-tcpserver: request is 9 digits of length and MJML code,
+    response is "0" (ok) or "1" (error), 9 digits of length and HTML or error message.
+    """
+    server_class = _ThreadingTCPServer
+
+    def _get_handler_class(self):
+        return _TCPHandler
+
+
+class FakeMJMLUnixServer(FakeMJMLTCPServer):
+    """
+    The protocol of mjml-tcpserver over unix domain socket, use server.address in settings.MJML_TCPSERVERS.
+    """
+    server_class = socketserver.ThreadingUnixStreamServer
+
+    def __init__(self, path: str, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.path = path
+
+    @property
+    def address(self) -> str:
+        return f'unix://{self.path}'
+
+    def _bind(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left by a killed server
+        return self.server_class(self.path, self._get_handler_class())
+
+    def stop(self) -> None:
+        super().stop()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # headers and body are written separately, don't delay the body
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.fake_server._add_connection(self.connection)
+
+    def finish(self) -> None:
+        try:
+            super().finish()
+        finally:
+            self.server.fake_server._remove_connection(self.connection)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send_json(self, status: int, data: Dict) -> None:
+        fake_server: FakeMJMLServer = self.server.fake_server
+        body = json.dumps(data).encode('utf-8')
+        compressed = None
+        if fake_server.compression and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressed = fake_server._compress(body, gzip.compress)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if compressed is not None:
+            body = compressed
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _is_authorized(self, http_auth: Optional[Tuple[str, str]]) -> bool:
+        if http_auth is None:
+            return True
+        credentials = base64.b64encode(':'.join(http_auth).encode('utf-8')).decode('ascii')
+        return self.headers.get('Authorization') == f'Basic {credentials}'
+
+    def do_POST(self) -> None:
+        fake_server: FakeMJMLHTTPServer = self.server.fake_server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path != '/v1/render':
+            self._send_json(404, {'message': 'Not found.'})
+            return
+        if not self._is_authorized(fake_server.http_auth):
+            self._send_json(401, {'message': 'Unauthorized.'})
+            return
+        if fake_server.error_status is not None:
+            fake_server._incr('errors')
+            self._send_json(fake_server.error_status, {'message': 'Service Unavailable.'})
+            return
+        content_encoding = self.headers.get('Content-Encoding')
+        if content_encoding:
+            if content_encoding != 'gzip' or not fake_server.compression:
+                self._send_json(415, {'message': 'Unsupported Content-Encoding.'})
+                return
+            fake_server._incr('compressed')
+            body = gzip.decompress(body)
+        try:
+            mjml_source = json.loads(body)['mjml']
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {'message': 'Wrong request.'})
+            return
+        try:
+            ok, result = fake_server.process(mjml_source)
+        except FakeServerTimeout:
+            self.close_connection = True
+            return
+        errors = [] if ok else [{'line': 1, 'message': result, 'tagName': 'mjml', 'formattedMessage': result}]
+        self._send_json(200, {
+            'html': result if ok else '',
+            'mjml': mjml_source,
+            'mjml_version': FAKE_MJML_VERSION,
+            'errors': errors,
+        })
+
+
+class FakeMJMLHTTPServer(FakeMJMLServer):
+    """
+    The API of MJML HTTP server: POST /v1/render with JSON {"mjml": "..."},
+    response is JSON with "html" and "errors". HTTP basic auth is checked if http_auth is set.
+    If error_status is set (e.g. 503 of a proxy), render requests are responded with it.
+    """
+    server_class = ThreadingHTTPServer
+
+    def __init__(self, *args, http_auth: Optional[Tuple[str, str]] = None, error_status: Optional[int] = None,
+                 **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.http_auth = http_auth
+        self.error_status = error_status
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}/v1/render'
+
+    def _get_handler_class(self):
+        return _HTTPHandler
+
+
+def wait_for_server(host: str, port: int, timeout: float = 30.0, process=None) -> None:
+    """
+    Wait until the server accepts connections. Raise RuntimeError if it doesn't happen in time
+    or if the process of the server has exited.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            pass
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'Server {host}:{port} has exited with code {process.returncode}')
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f'Server {host}:{port} is not ready in {timeout} seconds')
+        time.sleep(0.05)
+
+
+def main(*args) -> None:
+    parser = argparse.ArgumentParser(prog='python -m testprj.fakeserver', description='Fake MJML server.')
+    parser.add_argument('type', choices=('tcp', 'http'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--unix', metavar='PATH', help='Path of unix domain socket instead of host and port (tcp).')
+    parser.add_argument('--latency', type=float, nargs='+', default=[0.0], help='Seconds or min and max seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    parser.add_argument('--hang-time', type=float, default=60.0)
+    parser.add_argument('--max-concurrency', type=int, default=None)
+    parser.add_argument('--max-rps', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--max-protocol', type=int, choices=(1, 2), default=2)
+    parser.add_argument('--no-compression', dest='compression', action='store_false')
+    parser.add_argument('--compress-min-size', type=int, default=1024)
+    options = parser.parse_args(args)
+    if options.unix and options.type != 'tcp':
+        parser.error('--unix is supported only by tcp server')
+    server_class = FakeMJMLTCPServer if options.type == 'tcp' else FakeMJMLHTTPServer
+    if options.unix:
+        server_class = functools.partial(FakeMJMLUnixServer, options.unix)
+    server = server_class(
+        host=options.host,
+        port=options.port,
+        latency=options.latency[0] if len(options.latency) == 1 else tuple(options.latency[:2]),
+        error_rate=options.error_rate,
+        timeout_rate=options.timeout_rate,
+        hang_time=options.hang_time,
+        max_concurrency=options.max_concurrency,
+        max_rps=options.max_rps,
+        seed=options.seed,
+        max_protocol=options.max_protocol,
+        compression=options.compression,
+        compress_min_size=options.compress_min_size,
+    )
+    with server:
+        address = server.address if options.unix else f'{server.host}:{server.port}'
+        print(f'READY {address}', flush=True)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -1,10 +1,19 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.core.checks import run_checks
 from django.core.exceptions import ImproperlyConfigured
-from django.template import TemplateSyntaxError
+from django.template import Context, Engine, Template, TemplateSyntaxError
 from django.test import TestCase
+from django.utils.safestring import mark_safe
 
+from mjml import checks, tools
 from mjml import settings as mjml_settings
 from mjml.apps import check_mjml_command
-from testprj.tools import safe_change_mjml_settings, render_tpl, MJMLFixtures
+from mjml.templatetags.mjml import MJMLRenderNode
+from mjml.tools import mjml_render
+from testprj.tools import safe_change_mjml_settings, render_tpl, MJMLFixtures, get_mjml_version
 
 
 class TestMJMLApps(TestCase):
@@ -18,6 +27,71 @@ class TestMJMLApps(TestCase):
             with self.assertRaises(ImproperlyConfigured):
                 check_mjml_command()
 
+    def test_check_mjml_command_cache(self) -> None:
+        with safe_change_mjml_settings(), tempfile.TemporaryDirectory() as tmp_dir:
+            mjml_settings.MJML_CHECK_CMD_CACHE_FILE = os.path.join(tmp_dir, 'check.json')
+            self.assertEqual(check_mjml_command(), get_mjml_version())
+            with mock.patch('mjml.checks._mjml_render_by_cmd', side_effect=RuntimeError) as render_mock:
+                self.assertEqual(check_mjml_command(), get_mjml_version())
+                self.assertEqual(render_mock.call_count, 0)
+
+                # other command is checked again
+                mjml_settings.MJML_EXEC_CMD = [mjml_settings.MJML_EXEC_CMD, '--config.minify', 'false']
+                tools._cache.clear()
+                with self.assertRaises(ImproperlyConfigured):
+                    check_mjml_command()
+
+                mjml_settings.MJML_CHECK_CMD_CACHE_FILE = None
+                tools._cache.clear()
+                with self.assertRaises(ImproperlyConfigured):
+                    check_mjml_command()
+
+    def test_mjml_command_version(self) -> None:
+        with safe_change_mjml_settings(), tempfile.TemporaryDirectory() as tmp_dir:
+            mjml_settings.MJML_CHECK_CMD_CACHE_FILE = os.path.join(tmp_dir, 'check.json')
+            version = checks.get_mjml_command_version()
+            self.assertIn('mjml-core', version)
+            tools._cache.clear()
+            with mock.patch('mjml.checks._run_mjml_version_command') as run_mock:
+                self.assertEqual(checks.get_mjml_command_version(), version)  # from the cache file
+                self.assertEqual(run_mock.call_count, 0)
+
+            mjml_settings.MJML_EXEC_CMD = '/no_mjml_exec_test'
+            tools._cache.clear()
+            self.assertEqual(checks.get_mjml_command_version(), '')
+
+    def test_lazy_check(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CHECK_CMD_ON_STARTUP = 'lazy'
+            mjml_settings.MJML_CHECK_CMD_CACHE_FILE = None
+            with mock.patch('mjml.checks.check_mjml_command', wraps=checks.check_mjml_command) as check_mock:
+                self.assertIn('<html ', mjml_render('<mjml><mj-body></mj-body></mjml>'))
+                self.assertIn('<html ', mjml_render('<mjml><mj-body><mj-raw>1</mj-raw></mj-body></mjml>'))
+                self.assertEqual(check_mock.call_count, 1)
+
+            mjml_settings.MJML_EXEC_CMD = ['python', '-c', 'print("wrong result for testing")', '-']
+            tools._cache.clear()
+            for _ in range(2):
+                with self.assertRaises(ImproperlyConfigured):
+                    mjml_render('<mjml><mj-body></mj-body></mjml>')
+
+    def test_background_check(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CHECK_CMD_ON_STARTUP = 'background'
+            mjml_settings.MJML_EXEC_CMD = '/no_mjml_exec_test'
+            with self.assertLogs('mjml', 'ERROR'):
+                checks.start_background_check().join(10)
+            with self.assertRaises(ImproperlyConfigured):
+                mjml_render('<mjml><mj-body></mj-body></mjml>')
+
+    def test_system_check(self) -> None:
+        self.assertEqual(run_checks(tags=['mjml'], include_deployment_checks=True), [])
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_EXEC_CMD = '/no_mjml_exec_test'
+            errors = run_checks(tags=['mjml'], include_deployment_checks=True)
+            self.assertEqual([e.id for e in errors], ['mjml.E001'])
+            self.assertEqual(run_checks(tags=['mjml']), [])
+
 
 class TestMJMLTemplatetag(MJMLFixtures, TestCase):
     def test_simple(self) -> None:
@@ -105,6 +179,13 @@ class TestMJMLTemplatetag(MJMLFixtures, TestCase):
                 {% endmjml %}
             """)
 
+        with self.assertRaises(TemplateSyntaxError):
+            render_tpl("""
+                {% mjml precompile var %}
+                    <mjml><mj-body><mj-container></mj-container></mj-body></mjml>
+                {% endmjml %}
+            """)
+
         with self.assertRaises(TemplateSyntaxError):
             render_tpl("""
                 {% mjml var %}
@@ -121,3 +202,125 @@ class TestMJMLTemplatetag(MJMLFixtures, TestCase):
         self.assertIn('Український текст', html)
         self.assertIn(self.TEXTS['unicode'], html)
         self.assertIn('©', html)
+
+    def _get_tpl(self, name: str) -> str:
+        tpl = self.TPLS[name]
+        if get_mjml_version() >= 4:
+            tpl = tpl.replace('<mj-container>', '').replace('</mj-container>', '')
+        return tpl
+
+    def test_static_block(self) -> None:
+        tpl = Template('{% load mjml %}' + self._get_tpl('simple').replace(
+            '<mj-section>', '{% comment %}comment{% endcomment %}<mj-section>', 1,
+        ))
+        with mock.patch('mjml.templatetags.mjml.mjml_render', wraps=mjml_render) as render_mock:
+            html1 = tpl.render(Context())
+            html2 = tpl.render(Context({'title': 'test'}))
+        self.assertEqual(render_mock.call_count, 1)
+        self.assertEqual(html1, html2)
+        self.assertIn('Test title', html1)
+
+        tpl = Template('{% load mjml %}' + self._get_tpl('with_text_context'))
+        with mock.patch('mjml.templatetags.mjml.mjml_render', wraps=mjml_render) as render_mock:
+            html1 = tpl.render(Context({'text': 'one'}))
+            html2 = tpl.render(Context({'text': 'two'}))
+        self.assertEqual(render_mock.call_count, 2)
+        self.assertIn('one', html1)
+        self.assertIn('two', html2)
+
+    def test_static_block_cached_loader(self) -> None:
+        engine = Engine(
+            loaders=[('django.template.loaders.cached.Loader', [
+                ('django.template.loaders.locmem.Loader', {
+                    'static.html': '{% load mjml %}' + self._get_tpl('simple'),
+                    'error.html': '{% load mjml %}{% mjml %}123{% endmjml %}',
+                }),
+            ])],
+            libraries={'mjml': 'mjml.templatetags.mjml'},
+        )
+        with mock.patch('mjml.templatetags.mjml.mjml_render', wraps=mjml_render) as render_mock:
+            tpl = engine.get_template('static.html')
+            self.assertEqual(render_mock.call_count, 1)  # compiled on load
+            html = tpl.render(Context())
+            html = engine.get_template('static.html').render(Context())
+            self.assertEqual(render_mock.call_count, 1)
+        self.assertIn('Test title', html)
+
+        tpl = engine.get_template('error.html')
+        with self.assertRaises(RuntimeError):
+            tpl.render(Context())
+
+    def test_precompile(self) -> None:
+        tpl_code = '{% load mjml %}' + self._get_tpl('with_text_context').replace(
+            '<mj-column>', '<mj-column>{# comment #}<mj-button href="{{ url }}">Button</mj-button>', 1,
+        )
+        tpl = Template(tpl_code.replace('{% mjml %}', '{% mjml precompile %}'))
+        self.assertTrue(tpl.nodelist.get_nodes_by_type(MJMLRenderNode)[0].precompile)
+        with mock.patch('mjml.templatetags.mjml.mjml_render', wraps=mjml_render) as render_mock:
+            html1 = tpl.render(Context({'text': 'one & two', 'url': 'https://example.com/?a=1&b=2'}))
+            html2 = tpl.render(Context({'text': 'three', 'url': 'https://example.com/'}))
+            html3 = tpl.render(Context({'text': '<mj-button>Button</mj-button>', 'url': '/'}))
+            html4 = tpl.render(Context({'text': mark_safe('<mj-button>Button</mj-button>'), 'url': '/'}))
+        self.assertEqual(render_mock.call_count, 2)  # skeleton and html4
+        self.assertIn('one &amp; two', html1)
+        self.assertIn('https://example.com/?a=1&amp;b=2', html1)
+        self.assertIn('three', html2)
+        self.assertNotIn('one', html2)
+        self.assertIn('&lt;mj-button&gt;', html3)
+        self.assertNotIn('mjmlvar', html4)
+
+        html = Template(tpl_code).render(Context({'text': 'three', 'url': 'https://example.com/'}))
+        self.assertEqual(html, html2)
+
+    def test_precompile_fallback(self) -> None:
+        for tpl_code, context in (
+            ('<mj-text font-size="{{ size }}">text</mj-text>', {'size': '20px'}),
+            ('<mj-text {{ attrs }}>text</mj-text>', {'attrs': 'font-size="20px"'}),
+            ('{% if size %}<mj-text>{{ size }}</mj-text>{% endif %}', {'size': '20px'}),
+            ('<mj-text>text</mj-text></mj-column></mj-section><mj-style>.a { color: {{ size }}; }</mj-style>'
+             '<mj-section><mj-column>', {'size': 'red'}),
+        ):
+            tpl = Template(
+                '{% load mjml %}{% mjml precompile %}'
+                '<mjml><mj-body><mj-section><mj-column>' + tpl_code + '</mj-column></mj-section></mj-body></mjml>'
+                '{% endmjml %}'
+            )
+            self.assertFalse(tpl.nodelist.get_nodes_by_type(MJMLRenderNode)[0].precompile)
+            with mock.patch('mjml.templatetags.mjml.mjml_render', wraps=mjml_render) as render_mock:
+                tpl.render(Context(context))
+                tpl.render(Context(context))
+            self.assertEqual(render_mock.call_count, 2)
+
+    def test_precompile_backend_unavailable(self) -> None:
+        tpl_code = self._get_tpl('with_text_context').replace('{% mjml %}', '{% mjml precompile %}')
+        tpl = Template('{% load mjml %}' + tpl_code)
+        node = tpl.nodelist.get_nodes_by_type(MJMLRenderNode)[0]
+        with mock.patch('mjml.templatetags.mjml.mjml_render', side_effect=tools.BackendUnavailableError('no server')):
+            self.assertIsNone(node.compile_skeleton())
+            with self.assertRaises(tools.BackendUnavailableError):
+                tpl.render(Context({'text': 'test text'}))
+        # the skeleton isn't marked as unusable, the next render compiles it
+        self.assertIsNone(node._skeleton)
+        with mock.patch('mjml.templatetags.mjml.mjml_render', wraps=mjml_render) as render_mock:
+            self.assertIn('one', tpl.render(Context({'text': 'one'})))
+            self.assertIn('two', tpl.render(Context({'text': 'two'})))
+        self.assertEqual(render_mock.call_count, 1)
+        self.assertTrue(node._skeleton)
+
+    def test_precompile_cached_loader(self) -> None:
+        engine = Engine(
+            loaders=[('django.template.loaders.cached.Loader', [
+                ('django.template.loaders.locmem.Loader', {
+                    'precompile.html': '{% load mjml %}' + self._get_tpl('with_text_context').replace(
+                        '{% mjml %}', '{% mjml precompile %}',
+                    ),
+                }),
+            ])],
+            libraries={'mjml': 'mjml.templatetags.mjml'},
+        )
+        with mock.patch('mjml.templatetags.mjml.mjml_render', wraps=mjml_render) as render_mock:
+            tpl = engine.get_template('precompile.html')
+            self.assertEqual(render_mock.call_count, 1)  # compiled on load
+            html = tpl.render(Context({'text': 'test text'}))
+            self.assertEqual(render_mock.call_count, 1)
+        self.assertIn('test text', html)
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+from typing import List, Union
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from mjml import settings as mjml_settings
+from mjml.backends import (
+    BaseMJMLBackend, CMDBackend, HTTPServerBackend, TCPServerBackend, WorkerBackend, _registry, get_backend,
+    get_backend_class, register_backend,
+)
+from mjml.cache import get_backend_identity
+from mjml.signals import render_finished
+from mjml.tools import BackendUnavailableError, mjml_render, mjml_render_async, mjml_render_many
+from testprj.tools import MJMLSettingsMixin, get_mjml_version
+
+
+class EchoBackend(BaseMJMLBackend):
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.sources = []
+        self.threads = set()
+
+    def render(self, mjml_source: str) -> str:
+        self.sources.append(mjml_source)
+        self.threads.add(threading.get_ident())
+        if '<mjml>' not in mjml_source:
+            raise RuntimeError('MJML compile error (via echo): no <mjml>')
+        return f'<html ><body>{mjml_source}</body></html>'
+
+    def get_identity(self):
+        return 'echo-v1'
+
+
+class BatchEchoBackend(EchoBackend):
+    batch_render = True
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.batches = []
+
+    def render_many(self, mjml_sources: List[str], max_workers: int) -> List[Union[str, Exception]]:
+        self.batches.append(mjml_sources)
+        return super().render_many(mjml_sources, max_workers)
+
+
+class UnavailableBackend(BaseMJMLBackend):
+    def render(self, mjml_source: str) -> str:
+        raise BackendUnavailableError('sidecar is down')
+
+
+class NotBackend:
+    pass
+
+
+class TestBackends(MJMLSettingsMixin, TestCase):
+    ECHO_PATH = 'testprj.tests_backends.EchoBackend'
+
+    @staticmethod
+    def _get_source(text: str) -> str:
+        if get_mjml_version() >= 4:
+            return f'<mjml><mj-body><mj-section><mj-column><mj-text>{text}</mj-text></mj-column></mj-section></mj-body></mjml>'
+        return f'<mjml><mj-body><mj-container><mj-text>{text}</mj-text></mj-container></mj-body></mjml>'
+
+    def test_builtin_backends(self) -> None:
+        for name, backend_class in (('cmd', CMDBackend), ('worker', WorkerBackend), ('tcpserver', TCPServerBackend),
+                                    ('httpserver', HTTPServerBackend)):
+            backend = get_backend(name)
+            self.assertIsInstance(backend, backend_class)
+            self.assertEqual(backend.name, name)
+            self.assertIs(get_backend(name), backend)
+        self.assertIn('[cmd]', mjml_render(self._get_source('[cmd]')))
+
+    def test_dotted_path(self) -> None:
+        mjml_settings.MJML_BACKEND_MODE = self.ECHO_PATH
+        infos = []
+
+        def receiver(sender, info, **kwargs):
+            infos.append(info)
+
+        render_finished.connect(receiver)
+        self.addCleanup(render_finished.disconnect, receiver)
+        self.assertEqual(mjml_render('<mjml>1</mjml>'), '<html ><body><mjml>1</mjml></body></html>')
+        self.assertEqual(asyncio.run(mjml_render_async('<mjml>2</mjml>')), '<html ><body><mjml>2</mjml></body></html>')
+        with self.assertRaises(RuntimeError):
+            mjml_render('broken')
+        backend = get_backend(self.ECHO_PATH)
+        self.assertEqual(backend.sources, ['<mjml>1</mjml>', '<mjml>2</mjml>', 'broken'])
+        self.assertEqual(len(backend.threads), 2)  # render_async runs render() in a thread by default
+        self.assertEqual([info.backend for info in infos], [self.ECHO_PATH] * 3)
+        self.assertEqual(get_backend_identity(), f"{self.ECHO_PATH}|'echo-v1'")
+
+    def test_cache(self) -> None:
+        mjml_settings.MJML_BACKEND_MODE = self.ECHO_PATH
+        mjml_settings.MJML_CACHE = {}
+        for _ in range(3):
+            mjml_render('<mjml>cached</mjml>')
+        self.assertEqual(get_backend(self.ECHO_PATH).sources, ['<mjml>cached</mjml>'])
+
+    def test_render_many(self) -> None:
+        mjml_settings.MJML_BACKEND_MODE = self.ECHO_PATH
+        htmls = mjml_render_many(['<mjml>1</mjml>', '<mjml>2</mjml>', '<mjml>1</mjml>'])
+        self.assertEqual(htmls[0], htmls[2])
+        self.assertEqual(sorted(get_backend(self.ECHO_PATH).sources), ['<mjml>1</mjml>', '<mjml>2</mjml>'])
+
+        batch_path = 'testprj.tests_backends.BatchEchoBackend'
+        mjml_settings.MJML_BACKEND_MODE = batch_path
+        htmls = mjml_render_many(['<mjml>1</mjml>', 'broken', '<mjml>1</mjml>'], return_exceptions=True)
+        self.assertIn('<mjml>1</mjml>', htmls[0])
+        self.assertIsInstance(htmls[1], RuntimeError)
+        self.assertEqual(get_backend(batch_path).batches, [['<mjml>1</mjml>', 'broken']])
+
+    def test_fallback(self) -> None:
+        mjml_settings.MJML_BACKEND_MODE = 'testprj.tests_backends.UnavailableBackend'
+        mjml_settings.MJML_FALLBACK_BACKEND_MODES = [self.ECHO_PATH]
+        self.assertIn('fallback', mjml_render('<mjml>fallback</mjml>'))
+
+    def test_register_backend(self) -> None:
+        register_backend('echo', self.ECHO_PATH)
+        self.addCleanup(_registry.pop, 'echo')
+        mjml_settings.MJML_BACKEND_MODE = 'echo'
+        self.assertIn('registered', mjml_render('<mjml>registered</mjml>'))
+        self.assertIsInstance(get_backend('echo'), EchoBackend)
+
+    def test_wrong_backend(self) -> None:
+        with self.assertRaisesMessage(ImproperlyConfigured, 'Unknown MJML backend "wrong". Use one of cmd, '):
+            get_backend_class('wrong')
+        with self.assertRaisesMessage(ImproperlyConfigured, 'Can\'t import MJML backend "testprj.wrong.Backend"'):
+            get_backend_class('testprj.wrong.Backend')
+        with self.assertRaisesMessage(ImproperlyConfigured, 'is not a subclass of mjml.backends.BaseMJMLBackend'):
+            get_backend_class('testprj.tests_backends.NotBackend')
+        mjml_settings.MJML_FALLBACK_BACKEND_MODES = ['wrong']
+        with self.assertRaises(ImproperlyConfigured):
+            apps.get_app_config('mjml').ready()
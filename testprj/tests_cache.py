@@ -0,0 +1,131 @@
+import asyncio
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import TestCase
+
+from mjml import settings as mjml_settings
+from mjml import tools
+from mjml.cache import LRUCache, get_cache_key
+from testprj.tools import safe_change_mjml_settings, render_tpl, MJMLFixtures
+
+
+class TestLRUCache(TestCase):
+    def test_max_entries(self) -> None:
+        cache = LRUCache(max_entries=2, max_bytes=1024)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        self.assertEqual(cache.get('a'), 'A')
+        cache.set('c', 'C')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('c'), 'C')
+
+    def test_max_bytes(self) -> None:
+        cache = LRUCache(max_entries=100, max_bytes=10)
+        cache.set('a', '12345')
+        cache.set('b', '12345')
+        self.assertEqual(cache.size, 10)
+        cache.set('c', '☺')  # 3 bytes in utf-8
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 8)
+        cache.set('d', '12345678901')
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.size, 8)
+
+
+class TestMJMLRenderCache(MJMLFixtures, TestCase):
+    def test_cache_key(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CACHE = {}
+            key = get_cache_key('<mjml></mjml>')
+            self.assertEqual(key, get_cache_key('  <mjml></mjml>\r\n'))
+            self.assertNotEqual(key, get_cache_key('<mjml> </mjml>'))
+            mjml_settings.MJML_CACHE = {'VERSION': '4.17.2'}
+            self.assertNotEqual(key, get_cache_key('<mjml></mjml>'))
+            mjml_settings.MJML_CACHE = {}
+            mjml_settings.MJML_BACKEND_MODE = 'tcpserver'
+            self.assertNotEqual(key, get_cache_key('<mjml></mjml>'))
+            # the version of MJML is a part of the key in cmd mode
+            mjml_settings.MJML_BACKEND_MODE = 'cmd'
+            mjml_settings.MJML_CHECK_CMD_CACHE_FILE = None
+            self.assertEqual(key, get_cache_key('<mjml></mjml>'))
+            tools._cache.clear()
+            with mock.patch('mjml.checks._run_mjml_version_command', return_value='mjml-core: 99.0.0'):
+                self.assertNotEqual(key, get_cache_key('<mjml></mjml>'))
+
+    def test_disabled(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CACHE = None
+            self.assertIsNone(tools.get_render_cache())
+            with mock.patch('mjml.tools._mjml_render', return_value='<html ></html>') as render_mock:
+                render_tpl(self.TPLS['simple'])
+                render_tpl(self.TPLS['simple'])
+            self.assertEqual(render_mock.call_count, 2)
+
+    def test_local_cache(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CACHE = {}
+            with mock.patch('mjml.tools._mjml_render_by_cmd', wraps=tools._mjml_render_by_cmd) as render_mock:
+                html1 = render_tpl(self.TPLS['with_text_context'], {'text': 'one'})
+                html2 = render_tpl(self.TPLS['with_text_context'], {'text': 'one'})
+                html3 = render_tpl(self.TPLS['with_text_context'], {'text': 'two'})
+            self.assertEqual(render_mock.call_count, 2)
+            self.assertEqual(html1, html2)
+            self.assertIn('two', html3)
+            stats = tools.get_render_cache().get_stats()
+            self.assertEqual(stats['hits'], 1)
+            self.assertEqual(stats['local_hits'], 1)
+            self.assertEqual(stats['misses'], 2)
+            self.assertEqual(stats['entries'], 2)
+
+    def test_errors_are_not_cached(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CACHE = {}
+            with mock.patch('mjml.tools._mjml_render', side_effect=RuntimeError('error')) as render_mock:
+                for _ in range(2):
+                    with self.assertRaises(RuntimeError):
+                        render_tpl(self.TPLS['simple'])
+            self.assertEqual(render_mock.call_count, 2)
+            self.assertEqual(tools.get_render_cache().get_stats()['entries'], 0)
+
+    def test_shared_cache(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CACHE = {'BACKEND': 'default', 'KEY_PREFIX': 'test-mjml'}
+            caches['default'].clear()
+            with mock.patch('mjml.tools._mjml_render', return_value='<html >shared</html>') as render_mock:
+                render_tpl(self.TPLS['simple'])
+                tools.get_render_cache().local.clear()
+                html = render_tpl(self.TPLS['simple'])
+            self.assertEqual(render_mock.call_count, 1)
+            self.assertIn('shared', html)
+            stats = tools.get_render_cache().get_stats()
+            self.assertEqual(stats['shared_hits'], 1)
+            self.assertEqual(stats['entries'], 1)
+            caches['default'].clear()
+
+    def test_shared_cache_errors(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CACHE = {'BACKEND': 'default'}
+            shared = caches['default']
+            with mock.patch.object(shared, 'get', side_effect=ConnectionError('cache is down')), \
+                    mock.patch.object(shared, 'set', side_effect=ConnectionError('cache is down')), \
+                    mock.patch('mjml.tools._mjml_render', return_value='<html >rendered</html>') as render_mock, \
+                    self.assertLogs('mjml', 'WARNING') as logs:
+                html1 = render_tpl(self.TPLS['simple'])
+                html2 = render_tpl(self.TPLS['simple'])
+            self.assertEqual(html1, html2)
+            self.assertEqual(render_mock.call_count, 1)  # the local tier still works
+            self.assertEqual(tools.get_render_cache().get_stats()['shared_errors'], 2)
+            self.assertIn('MJML render cache: set in Django cache "default" failed', logs.output[1])
+
+    def test_async(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CACHE = {}
+            with mock.patch('mjml.tools._mjml_render_async', return_value='<html >async</html>') as render_mock:
+                html1 = asyncio.run(tools.mjml_render_async('<mjml></mjml>'))
+                html2 = asyncio.run(tools.mjml_render_async('<mjml></mjml>'))
+            self.assertEqual(render_mock.call_count, 1)
+            self.assertEqual(html1, html2)
+            self.assertEqual(tools.get_render_cache().get_stats()['hits'], 1)
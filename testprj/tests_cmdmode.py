@@ -1,6 +1,15 @@
+import asyncio
+import os
+import sys
+import tempfile
+from unittest import mock
+
 from django.test import TestCase
 
-from testprj.tools import render_tpl, MJMLFixtures
+from mjml import settings as mjml_settings
+from mjml import tools
+from mjml.tools import mjml_render_async, mjml_render_many
+from testprj.tools import safe_change_mjml_settings, render_tpl, MJMLFixtures, get_mjml_version
 
 
 class TestMJMLCMDMode(MJMLFixtures, TestCase):
@@ -15,6 +24,28 @@ class TestMJMLCMDMode(MJMLFixtures, TestCase):
         self.assertIn('</body>', html)
         self.assertIn('</html>', html)
 
+    def test_big_unicode_email(self) -> None:
+        # multibyte symbols are split between chunks of output
+        big_text = '[START]' + (self.TEXTS['unicode'] + 'Український текст ' * 3) * 100 * 1024 + '[END]'
+        html = render_tpl(self.TPLS['with_text_context'], {'text': big_text})
+        self.assertIn(big_text, html)
+        self.assertIn('</html>', html)
+
+    def test_max_output_size(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_EXEC_CMD = ['python', '-c', 'print("x" * 1000000)', '-']
+            mjml_settings.MJML_CMD_MAX_OUTPUT_SIZE = 1000
+            with self.assertRaises(RuntimeError) as cm:
+                render_tpl(self.TPLS['simple'])
+            self.assertIn('MJML output is larger than 1000 bytes', str(cm.exception))
+            with self.assertRaises(RuntimeError) as cm:
+                asyncio.run(mjml_render_async('<mjml></mjml>'))
+            self.assertIn('MJML output is larger than 1000 bytes', str(cm.exception))
+
+            mjml_settings.MJML_CMD_MAX_OUTPUT_SIZE = None
+            html = render_tpl(self.TPLS['simple'])
+            self.assertEqual(len(html.strip()), 1000000)
+
     def test_unicode(self) -> None:
         smile = '\u263a'
         checkmark = '\u2713'
@@ -25,3 +56,111 @@ class TestMJMLCMDMode(MJMLFixtures, TestCase):
         self.assertIn('<body', html)
         self.assertIn(unicode_text, html)
         self.assertIn('©', html)
+
+    def test_async(self) -> None:
+        mjml_source = '<mjml><mj-body><mj-container><mj-text>{}</mj-text></mj-container></mj-body></mjml>'
+        if get_mjml_version() >= 4:
+            mjml_source = mjml_source.replace('<mj-container>', '').replace('</mj-container>', '')
+
+        async def render_all():
+            return await asyncio.gather(*(mjml_render_async(mjml_source.format(f'text {i}')) for i in range(3)))
+
+        results = asyncio.run(render_all())
+        for i, html in enumerate(results):
+            self.assertIn('<html ', html)
+            self.assertIn(f'text {i}', html)
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(mjml_render_async('123'))
+
+    def _get_source(self, text: str) -> str:
+        mjml_source = '<mjml><mj-body><mj-container><mj-text>{}</mj-text></mj-container></mj-body></mjml>'
+        if get_mjml_version() >= 4:
+            mjml_source = mjml_source.replace('<mj-container>', '').replace('</mj-container>', '')
+        return mjml_source.format(text)
+
+    def test_render_many_batch(self) -> None:
+        sources = [self._get_source(f'[text {i}]') for i in range(7)] + [self._get_source('[text 0]')]
+        with mock.patch('subprocess.Popen', wraps=tools.subprocess.Popen) as popen_mock:
+            results = mjml_render_many(sources, max_workers=2)
+        self.assertEqual(popen_mock.call_count, 2)
+        self.assertEqual(len(results), 8)
+        for i, html in enumerate(results):
+            self.assertIn('<html ', html)
+            self.assertIn(f'[text {i % 7}]', html)
+            self.assertEqual(html.strip(), tools.mjml_render(sources[i]).strip())
+
+    def test_render_many_batch_file_path(self) -> None:
+        sources = [self._get_source('one'), self._get_source('two')]
+        with mock.patch('subprocess.Popen', wraps=tools.subprocess.Popen) as popen_mock:
+            mjml_render_many(sources, max_workers=1)
+        self.assertIn(f'--config.filePath={os.getcwd()}', popen_mock.call_args[0][0])
+
+        with safe_change_mjml_settings(), \
+                mock.patch('subprocess.Popen', wraps=tools.subprocess.Popen) as popen_mock:
+            mjml_settings.MJML_EXEC_CMD = [mjml_settings.MJML_EXEC_CMD, '--config.filePath=/tmp']
+            results = mjml_render_many(sources, max_workers=1)
+            self.assertIn('two', results[1])
+            args = popen_mock.call_args[0][0]
+            self.assertIn('--config.filePath=/tmp', args)
+            self.assertEqual(len([arg for arg in args if 'filePath' in arg]), 1)
+
+    def test_render_many_batch_errors(self) -> None:
+        sources = [self._get_source('one'), '<mj-wrong></mj-wrong>', self._get_source('two')]
+        with self.assertRaises(RuntimeError):
+            mjml_render_many(sources, max_workers=1)
+
+        results = mjml_render_many(sources, max_workers=1, return_exceptions=True)
+        self.assertIn('one', results[0])
+        self.assertIsInstance(results[1], RuntimeError)
+        self.assertIn('MJML stderr is not empty', str(results[1]))
+        self.assertIn('two', results[2])
+
+    def test_render_many_batch_unattributed_errors(self) -> None:
+        # the wrapper of mjml writes an error which doesn't refer to a file if a source contains "[unattributed]"
+        wrapper_code = (
+            'import subprocess, sys\n'
+            'args = sys.argv[2:]\n'
+            'sources = [sys.stdin.read()] if "-i" in args else [open(a).read() for a in args if a.endswith(".mjml")]\n'
+            'if any("[unattributed]" in s for s in sources):\n'
+            '    sys.stderr.write("Error: something went wrong\\n")\n'
+            'stdin = sources[0].encode() if "-i" in args else None\n'
+            'sys.exit(subprocess.run([sys.argv[1]] + args, input=stdin).returncode)\n'
+        )
+        sources = [self._get_source('one'), self._get_source('[unattributed]'), self._get_source('two')]
+        with tempfile.TemporaryDirectory() as tmp_dir, safe_change_mjml_settings():
+            wrapper_path = os.path.join(tmp_dir, 'mjml_wrapper.py')
+            with open(wrapper_path, 'w') as f:
+                f.write(wrapper_code)
+            mjml_settings.MJML_EXEC_CMD = [sys.executable, wrapper_path, mjml_settings.MJML_EXEC_CMD]
+            with mock.patch('mjml.tools._mjml_render_by_cmd', wraps=tools._mjml_render_by_cmd) as render_mock:
+                results = mjml_render_many(sources, max_workers=1, return_exceptions=True)
+            # the sources of the run are compiled one by one to find the failed one
+            self.assertEqual(render_mock.call_count, 3)
+        self.assertIn('one', results[0])
+        self.assertIsInstance(results[1], RuntimeError)
+        self.assertIn('something went wrong', str(results[1]))
+        self.assertIn('two', results[2])
+
+    def test_render_many_batch_wrong_cmd(self) -> None:
+        sources = [self._get_source('one'), self._get_source('two')]
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_EXEC_CMD = 'mjml-wrong-cmd'
+            with self.assertRaises(RuntimeError) as cm:
+                mjml_render_many(sources)
+            self.assertIn('Problem to run command "mjml-wrong-cmd"', str(cm.exception))
+
+            results = mjml_render_many(sources, return_exceptions=True)
+            self.assertIsInstance(results[0], RuntimeError)
+            self.assertIs(results[0], results[1])
+
+    def test_render_many_batch_cache(self) -> None:
+        sources = [self._get_source('one'), self._get_source('two'), self._get_source('three')]
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CACHE = {'MAX_ENTRIES': 10}
+            tools.mjml_render(sources[0])
+            with mock.patch('mjml.tools._mjml_render_many_by_cmd', wraps=tools._mjml_render_many_by_cmd) as batch_mock:
+                results = mjml_render_many(sources)
+                self.assertEqual(batch_mock.call_args[0][0], sources[1:])
+                self.assertEqual(mjml_render_many(sources), results)
+                self.assertEqual(batch_mock.call_count, 1)
@@ -0,0 +1,122 @@
+import io
+import json
+import os
+import tempfile
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.template import Context, engines
+from django.template.loaders.cached import Loader as CachedLoader
+from django.test import TestCase, override_settings
+
+from mjml import settings as mjml_settings
+from mjml.compiled import MANIFEST_FILENAME, get_compiled_key
+from testprj.tools import safe_change_mjml_settings, get_mjml_version
+
+
+class TestMJMLCompileCommand(TestCase):
+    @staticmethod
+    def _get_source(text: str) -> str:
+        if get_mjml_version() >= 4:
+            return f'<mjml><mj-body><mj-section><mj-column><mj-text>{text}</mj-text></mj-column></mj-section></mj-body></mjml>'
+        return f'<mjml><mj-body><mj-container><mj-text>{text}</mj-text></mj-container></mj-body></mjml>'
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.templates_dir = os.path.join(tmp_dir.name, 'templates')
+        self.output_dir = os.path.join(tmp_dir.name, 'build')
+        self.templates = {
+            'emails/static.html': '{% load mjml %}{% mjml %}' + self._get_source('[static]') + '{% endmjml %}',
+            'emails/precompile.html': (
+                '{% load mjml %}{% mjml precompile %}' + self._get_source('[hello {{ name }}]') + '{% endmjml %}'
+            ),
+            'emails/dynamic.html': '{% load mjml %}{% mjml %}' + self._get_source('{{ text }}') + '{% endmjml %}',
+            'emails/file.mjml': self._get_source('[file]'),
+            'emails/dynamic_file.mjml': self._get_source('{{ text }}'),
+            'emails/wrong.html': '{% load mjml %}{% mjml %}',
+            'emails/other.css': '{% mjml %}',
+        }
+        for name, content in self.templates.items():
+            path = os.path.join(self.templates_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+        templates_settings = override_settings(TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [self.templates_dir],
+        }])
+        templates_settings.enable()
+        self.addCleanup(templates_settings.disable)
+
+    def _compile(self, **options) -> dict:
+        options.setdefault('stderr', io.StringIO())
+        call_command('mjml_compile', output=self.output_dir, verbosity=0, **options)
+        with open(os.path.join(self.output_dir, MANIFEST_FILENAME), encoding='utf-8') as f:
+            return json.load(f)['entries']
+
+    def test_compile(self) -> None:
+        entries = self._compile()
+        self.assertEqual(sorted(entries.values()), [
+            ['emails/dynamic_file.mjml'], ['emails/file.mjml'], ['emails/precompile.html'], ['emails/static.html'],
+        ])
+        key = get_compiled_key(self._get_source('[file]'))
+        with open(os.path.join(self.output_dir, f'{key}.html'), encoding='utf-8') as f:
+            self.assertIn('[file]', f.read())
+
+        # the compiled HTML is used instead of the backend
+        with safe_change_mjml_settings(), \
+                mock.patch('mjml.templatetags.mjml.mjml_render', side_effect=RuntimeError('no backend')):
+            mjml_settings.MJML_COMPILED_DIR = self.output_dir
+            html = engines['django'].get_template('emails/static.html').render()
+            self.assertIn('[static]', html)
+            html = engines['django'].get_template('emails/precompile.html').render({'name': 'Bob'})
+            self.assertIn('[hello Bob]', html)
+
+    def test_remove_old_files(self) -> None:
+        self._compile()
+        os.remove(os.path.join(self.templates_dir, 'emails/file.mjml'))
+        entries = self._compile()
+        self.assertEqual(len(entries), 3)
+        html_files = [f for f in os.listdir(self.output_dir) if f.endswith('.html')]
+        self.assertEqual(sorted(html_files), sorted(f'{key}.html' for key in entries))
+
+    def test_errors(self) -> None:
+        with open(os.path.join(self.templates_dir, 'emails/broken.mjml'), 'w', encoding='utf-8') as f:
+            f.write('<mj-wrong></mj-wrong>')
+        stderr = io.StringIO()
+        with self.assertRaises(CommandError):
+            self._compile(stderr=stderr)
+        self.assertIn('Error in emails/broken.mjml', stderr.getvalue())
+        with open(os.path.join(self.output_dir, MANIFEST_FILENAME), encoding='utf-8') as f:
+            self.assertEqual(len(json.load(f)['entries']), 4)
+
+    def test_loader_without_get_dirs(self) -> None:
+        # the cached loader of Django < 3.2 and mjml.loaders.Loader based on it don't have get_dirs()
+        get_dirs = CachedLoader.get_dirs
+        del CachedLoader.get_dirs
+        self.addCleanup(setattr, CachedLoader, 'get_dirs', get_dirs)
+        with override_settings(TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [self.templates_dir],
+            'OPTIONS': {'loaders': [('mjml.loaders.Loader', ['django.template.loaders.filesystem.Loader'])]},
+        }]):
+            entries = self._compile()
+        self.assertEqual(len(entries), 4)
+
+    def test_no_template_dirs(self) -> None:
+        with override_settings(TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates'}]):
+            with self.assertRaises(CommandError) as cm:
+                self._compile()
+        self.assertIn('Template directories are not found', str(cm.exception))
+
+    def test_no_output(self) -> None:
+        with self.assertRaises(CommandError):
+            call_command('mjml_compile', verbosity=0)
+
+    def test_precompile_skeleton_is_stable(self) -> None:
+        tpl = self.templates['emails/precompile.html']
+        node1 = engines['django'].from_string(tpl).template.nodelist[1]
+        node2 = engines['django'].from_string(tpl).template.nodelist[1]
+        self.assertEqual(node1.get_compile_source(), node2.get_compile_source())
+        self.assertIn('[hello Bob]', node1.render(Context({'name': 'Bob'})))
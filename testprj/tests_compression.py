@@ -0,0 +1,120 @@
+import asyncio
+import gzip
+import zlib
+from unittest import mock
+
+from django.test import TestCase
+
+from mjml import settings as mjml_settings
+from mjml import pool, tools
+from mjml.tools import mjml_render, mjml_render_async
+from testprj.fakeserver import FakeMJMLHTTPServer, FakeMJMLTCPServer
+from testprj.tools import MJMLSettingsMixin
+
+SOURCE = '<mjml><mj-body><mj-section><mj-column><mj-text>{}</mj-text></mj-column></mj-section></mj-body></mjml>'
+LARGE_TEXT = '[START]' + ('1 2 3 4 5 6 7 8 9 0 ' * 1000) + '[END]'
+
+
+class CompressionTestMixin(MJMLSettingsMixin):
+    def setUp(self) -> None:
+        super().setUp()
+        mjml_settings.MJML_COMPRESSION_MIN_SIZE = 1024
+        mjml_settings.MJML_COALESCE_RENDERS = False
+
+
+class TestTCPServerCompression(CompressionTestMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        mjml_settings.MJML_BACKEND_MODE = 'tcpserver'
+        mjml_settings.MJML_TCPSERVER_PROTOCOL = 'auto'
+
+    def _start_tcp(self, **kwargs) -> FakeMJMLTCPServer:
+        server = self._start_server(FakeMJMLTCPServer(**kwargs))
+        mjml_settings.MJML_TCPSERVERS = [server.address]
+        return server
+
+    def test_compression(self) -> None:
+        server = self._start_tcp()
+        with mock.patch.object(pool.zlib, 'decompress', wraps=zlib.decompress) as decompress_mock:
+            html = mjml_render(SOURCE.format(LARGE_TEXT))
+        self.assertIn(LARGE_TEXT, html)
+        self.assertEqual(server.stats['compressed'], 1)
+        self.assertEqual(decompress_mock.call_count, 2)  # the request by the server and the response by the client
+        self.assertEqual(tools._get_tcpserver_connection(server.address, 1, 1).compress_min_size, 1024)
+
+        self.assertIn('[small]', mjml_render(SOURCE.format('[small]')))
+        self.assertEqual(server.stats['compressed'], 1)
+        self.assertEqual(server.stats['connections'], 1)
+
+    def test_compression_async(self) -> None:
+        server = self._start_tcp()
+
+        async def render_all():
+            return await asyncio.gather(
+                mjml_render_async(SOURCE.format(LARGE_TEXT)),
+                mjml_render_async(SOURCE.format('[small]')),
+            )
+
+        large_html, small_html = asyncio.run(render_all())
+        self.assertIn(LARGE_TEXT, large_html)
+        self.assertIn('[small]', small_html)
+        self.assertEqual(server.stats['compressed'], 1)
+
+    def test_server_without_compression(self) -> None:
+        server = self._start_tcp(compression=False)
+        self.assertIn(LARGE_TEXT, mjml_render(SOURCE.format(LARGE_TEXT)))
+        self.assertEqual(server.stats['multiplexed'], 1)
+        self.assertEqual(server.stats['compressed'], 0)
+        self.assertIsNone(tools._get_tcpserver_connection(server.address, 1, 1).compress_min_size)
+
+    def test_disabled(self) -> None:
+        mjml_settings.MJML_COMPRESSION_MIN_SIZE = None
+        server = self._start_tcp(compress_min_size=0)
+        self.assertIn(LARGE_TEXT, mjml_render(SOURCE.format(LARGE_TEXT)))
+        self.assertEqual(server.stats['compressed'], 0)
+        self.assertIsNone(tools._get_tcpserver_connection(server.address, 1, 1).compress_min_size)
+
+    def test_wrong_encoding(self) -> None:
+        with self.assertRaisesMessage(ConnectionError, 'unknown encoding'):
+            pool.decode_response(b'0', b'x', b'')
+        with self.assertRaisesMessage(ConnectionError, 'Wrong response from MJML TCP server'):
+            pool.decode_response(b'0', b'z', b'not zlib')
+
+
+class TestHTTPServerCompression(CompressionTestMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        mjml_settings.MJML_BACKEND_MODE = 'httpserver'
+
+    def _start_http(self, **kwargs) -> FakeMJMLHTTPServer:
+        server = self._start_server(FakeMJMLHTTPServer(**kwargs))
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': server.url, 'COMPRESSION': True}]
+        return server
+
+    def test_compression(self) -> None:
+        server = self._start_http()
+        self.assertIn(LARGE_TEXT, mjml_render(SOURCE.format(LARGE_TEXT)))
+        self.assertIn(LARGE_TEXT, asyncio.run(mjml_render_async(SOURCE.format(LARGE_TEXT + '[async]'))))
+        self.assertEqual(server.stats['compressed'], 2)
+        self.assertIn('[small]', mjml_render(SOURCE.format('[small]')))
+        self.assertEqual(server.stats['compressed'], 2)
+
+    def test_rejected(self) -> None:
+        server = self._start_http(compression=False)
+        with mock.patch.object(tools, '_is_httpserver_compression_rejected',
+                               wraps=tools._is_httpserver_compression_rejected) as rejected_mock:
+            for i in range(2):
+                self.assertIn(LARGE_TEXT, mjml_render(SOURCE.format(f'{LARGE_TEXT} {i}')))
+        # the server responded 415 once, then requests are sent without compression
+        self.assertEqual(rejected_mock.call_count, 2)
+        self.assertEqual(server.stats['requests'], 2)
+        self.assertEqual(server.stats['compressed'], 0)
+        self.assertIn(server.url, tools._get_process_local('httpserver_no_compression', set))
+
+    def test_not_enabled(self) -> None:
+        server = self._start_http()
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': server.url}]
+        with mock.patch.object(tools.gzip, 'compress', wraps=gzip.compress) as compress_mock:
+            self.assertIn(LARGE_TEXT, mjml_render(SOURCE.format(LARGE_TEXT)))
+        self.assertEqual(compress_mock.call_count, 1)  # only the response by the server
+        self.assertEqual(server.stats['compressed'], 0)
@@ -0,0 +1,317 @@
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.test import TestCase
+
+from mjml import settings as mjml_settings
+from mjml import tools
+from mjml.backends import get_backend
+from mjml.tools import mjml_render, mjml_render_async, mjml_render_many
+from testprj.fakeserver import FakeMJMLHTTPServer, FakeMJMLTCPServer, FakeMJMLUnixServer, wait_for_server
+from testprj.tools import MJMLSettingsMixin
+
+SOURCE = '<mjml><mj-body><mj-section><mj-column><mj-text>{}</mj-text></mj-column></mj-section></mj-body></mjml>'
+
+
+class TestFakeMJMLTCPServer(MJMLSettingsMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        mjml_settings.MJML_BACKEND_MODE = 'tcpserver'
+        mjml_settings.MJML_COALESCE_RENDERS = False
+
+    def _start(self, **kwargs) -> FakeMJMLTCPServer:
+        return self._start_server(FakeMJMLTCPServer(**kwargs))
+
+    def _use_servers_in_order(self) -> None:
+        server_health = tools._get_server_health()
+        patcher = mock.patch.object(server_health, 'get_servers_order', side_effect=lambda servers, key: servers)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_render(self) -> None:
+        server = self._start()
+        self.assertTrue(server.ready.is_set())
+        mjml_settings.MJML_TCPSERVERS = [server.address]
+        html = mjml_render(SOURCE.format('[tcp]'))
+        self.assertIn('<html ', html)
+        self.assertIn('[tcp]', html)
+        self.assertIn('[async]', asyncio.run(mjml_render_async(SOURCE.format('[async]'))))
+        with self.assertRaises(RuntimeError) as cm:
+            mjml_render('123')
+        self.assertIn('Malformed MJML', str(cm.exception))
+        self.assertEqual(server.stats['requests'], 3)
+
+    def test_pool_reuse(self) -> None:
+        server = self._start()
+        mjml_settings.MJML_TCPSERVERS = [server.address]
+        for i in range(5):
+            mjml_render(SOURCE.format(i))
+        self.assertEqual(server.stats['connections'], 1)
+        # the server has been restarted, the idle connection is closed and the render reconnects
+        server.close_connections()
+        self.assertIn('[restart]', mjml_render(SOURCE.format('[restart]')))
+        self.assertEqual(server.stats['connections'], 2)
+
+    def test_error_rate(self) -> None:
+        server = self._start(error_rate=0.5, seed=1)
+        mjml_settings.MJML_TCPSERVERS = [server.address]
+        errors = 0
+        for i in range(20):
+            try:
+                mjml_render(SOURCE.format(i))
+            except RuntimeError as e:
+                self.assertIn('Fake error', str(e))
+                errors += 1
+        self.assertEqual(errors, server.stats['errors'])
+        self.assertTrue(0 < errors < 20)
+
+    def test_failover_on_timeout(self) -> None:
+        hanging_server = self._start(timeout_rate=1)
+        server = self._start()
+        mjml_settings.MJML_TCPSERVERS = [hanging_server.address, server.address]
+        mjml_settings.MJML_READ_TIMEOUT = 0.2
+        self._use_servers_in_order()
+        self.assertIn('[failover]', mjml_render(SOURCE.format('[failover]')))
+        self.assertEqual(hanging_server.stats['timeouts'], 1)
+        self.assertEqual(server.stats['requests'], 1)
+
+    def test_failover_on_stopped_server(self) -> None:
+        stopped_server = self._start()
+        stopped_server.stop()
+        server = self._start()
+        mjml_settings.MJML_TCPSERVERS = [stopped_server.address, server.address]
+        self._use_servers_in_order()
+        self.assertIn('[failover]', mjml_render(SOURCE.format('[failover]')))
+
+    def test_render_timeout(self) -> None:
+        servers = [self._start(timeout_rate=1), self._start(timeout_rate=1)]
+        mjml_settings.MJML_TCPSERVERS = [server.address for server in servers]
+        mjml_settings.MJML_RENDER_TIMEOUT = 0.3
+        started = time.monotonic()
+        with self.assertRaises(RuntimeError) as cm:
+            mjml_render(SOURCE.format('[timeout]'))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertIn('no working server', str(cm.exception))
+
+    def test_max_concurrency(self) -> None:
+        server = self._start(latency=0.1, max_concurrency=1)
+        mjml_settings.MJML_TCPSERVERS = [server.address]
+        started = time.monotonic()
+        htmls = mjml_render_many([SOURCE.format(i) for i in range(4)], max_workers=4)
+        self.assertGreaterEqual(time.monotonic() - started, 0.4)
+        self.assertEqual(len(htmls), 4)
+        self.assertEqual(server.stats['connections'], 4)
+
+    def test_hedged_concurrent_renders(self) -> None:
+        servers = [self._start(latency=0.2), self._start(latency=0.2)]
+        mjml_settings.MJML_TCPSERVERS = [server.address for server in servers]
+        mjml_settings.MJML_HEDGE_PERCENTILE = 95
+        # renders aren't queued by the pool of threads for hedged requests
+        started = time.monotonic()
+        htmls = mjml_render_many([SOURCE.format(f'[hedged {i}]') for i in range(64)], max_workers=64)
+        self.assertLess(time.monotonic() - started, 1)
+        for i, html in enumerate(htmls):
+            self.assertIn(f'[hedged {i}]', html)
+
+    def test_hedged_loser_isnt_failure(self) -> None:
+        slow_server, server = self._start(latency=1), self._start()
+        mjml_settings.MJML_TCPSERVERS = [slow_server.address, server.address]
+        mjml_settings.MJML_HEDGE_PERCENTILE = 95
+        self._use_servers_in_order()
+        server_health = tools._get_server_health()
+        slow_key = tools._get_tcpserver_key(slow_server.address)
+        for _ in range(10):
+            server_health.record_success(slow_key, 0.1)
+        for i in range(3):
+            self.assertIn(f'[async {i}]', asyncio.run(mjml_render_async(SOURCE.format(f'[async {i}]'))))
+        # the requests to the slow server have been cancelled, its circuit isn't opened
+        stats = server_health.get_stats()[slow_key]
+        self.assertEqual(stats['failures'], 0)
+        self.assertEqual(stats['state'], 'closed')
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_max_rps(self) -> None:
+        server = self._start(max_rps=20)
+        mjml_settings.MJML_TCPSERVERS = [server.address]
+        started = time.monotonic()
+        mjml_render_many([SOURCE.format(i) for i in range(5)], max_workers=5)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+
+class TestFakeMJMLUnixServer(MJMLSettingsMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        mjml_settings.MJML_BACKEND_MODE = 'tcpserver'
+        mjml_settings.MJML_COALESCE_RENDERS = False
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'mjml.sock')
+        self.server = self._start_server(FakeMJMLUnixServer(self.path))
+
+    def test_render(self) -> None:
+        self.assertEqual(self.server.address, f'unix://{self.path}')
+        mjml_settings.MJML_TCPSERVERS = [self.server.address]
+        for i in range(3):
+            self.assertIn(f'[unix {i}]', mjml_render(SOURCE.format(f'[unix {i}]')))
+        self.assertEqual(self.server.stats['connections'], 1)
+        pool = tools._get_tcpserver_pool(self.server.address)
+        self.assertEqual(pool.address, self.path)
+        self.assertEqual(pool._idle[-1][0].family, socket.AF_UNIX)
+        with self.assertRaises(RuntimeError) as cm:
+            mjml_render('123')
+        self.assertIn('Malformed MJML', str(cm.exception))
+
+    def test_render_async(self) -> None:
+        mjml_settings.MJML_TCPSERVERS = [self.server.address]
+
+        async def render_all():
+            return await asyncio.gather(*(mjml_render_async(SOURCE.format(f'[async {i}]')) for i in range(3)))
+
+        for i, html in enumerate(asyncio.run(render_all())):
+            self.assertIn(f'[async {i}]', html)
+        self.assertEqual(self.server.stats['requests'], 3)
+
+    def test_failover(self) -> None:
+        tcp_server = self._start_server(FakeMJMLTCPServer())
+        self.server.stop()
+        mjml_settings.MJML_TCPSERVERS = [self.server.address, tcp_server.address]
+        with mock.patch.object(tools._get_server_health(), 'get_servers_order',
+                               side_effect=lambda servers, key: servers):
+            self.assertIn('[failover]', mjml_render(SOURCE.format('[failover]')))
+        self.assertEqual(tcp_server.stats['requests'], 1)
+        health = tools._get_server_health().get_stats()
+        self.assertEqual(health[self.server.address]['failures'], 1)
+
+    def test_identity(self) -> None:
+        mjml_settings.MJML_TCPSERVERS = [self.server.address, ('127.0.0.1', 28101)]
+        self.assertEqual(get_backend('tcpserver').get_identity(), ['tcp://127.0.0.1:28101', f'unix://{self.path}'])
+
+class TestFakeMJMLHTTPServer(MJMLSettingsMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        mjml_settings.MJML_BACKEND_MODE = 'httpserver'
+
+    def _start(self, **kwargs) -> FakeMJMLHTTPServer:
+        return self._start_server(FakeMJMLHTTPServer(**kwargs))
+
+    def test_render(self) -> None:
+        server = self._start()
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': server.url}]
+        for i in range(3):
+            self.assertIn(f'[http {i}]', mjml_render(SOURCE.format(f'[http {i}]')))
+        self.assertIn('[async]', asyncio.run(mjml_render_async(SOURCE.format('[async]'))))
+        self.assertEqual(server.stats['connections'], 2)  # keep-alive connection of sync and async clients
+        with self.assertRaises(RuntimeError) as cm:
+            mjml_render('123')
+        self.assertIn('Tag: mjml Message: Line 1 (mjml) — Malformed MJML.', str(cm.exception))
+
+    def test_async_client_closed_with_event_loop(self) -> None:
+        server = self._start()
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': server.url}]
+        for i in range(5):
+            self.assertIn(f'[loop {i}]', asyncio.run(mjml_render_async(SOURCE.format(f'[loop {i}]'))))
+        deadline = time.monotonic() + 5
+        while server._connections and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(server._connections, set())
+        self.assertEqual(tools._get_process_local(('async_http_clients', server.url, None), dict), {})
+
+    def test_keep_alive_latency(self) -> None:
+        server = self._start()
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': server.url}]
+        mjml_render(SOURCE.format('[warm up]'))
+        started = time.monotonic()
+        for i in range(20):
+            mjml_render(SOURCE.format(f'[http {i}]'))
+        # responses aren't delayed by Nagle's algorithm and delayed ACK (~40ms each)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(server.stats['connections'], 1)
+
+    def test_failover_on_server_error(self) -> None:
+        broken_server = self._start(error_status=503)
+        server = self._start()
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': broken_server.url}, {'URL': server.url}]
+        with mock.patch.object(tools._get_server_health(), 'get_servers_order',
+                               side_effect=lambda servers, key: servers):
+            self.assertIn('[failover]', mjml_render(SOURCE.format('[failover]')))
+            self.assertIn('[async]', asyncio.run(mjml_render_async(SOURCE.format('[async]'))))
+        self.assertEqual(broken_server.stats['errors'], 2)
+        self.assertEqual(server.stats['requests'], 2)
+        health = tools._get_server_health().get_stats()
+        self.assertEqual(health[broken_server.url]['failures'], 2)
+        self.assertEqual(health[server.url]['failures'], 0)
+
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': broken_server.url}]
+        with self.assertRaises(tools.BackendUnavailableError) as cm:
+            mjml_render(SOURCE.format('[broken]'))
+        self.assertIn('no working server', str(cm.exception))
+
+    def test_render_timeout_of_slow_response(self) -> None:
+        # the server sends the response by a byte every 0.3s, each read is fast but the whole response isn't
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+        body = b'{"html": "<html></html>", "errors": []}'
+        response = b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' % (
+            len(body), body,
+        )
+
+        def serve() -> None:
+            conn, _ = listener.accept()
+            with conn:
+                conn.recv(65536)
+                for i in range(len(response)):
+                    if stop.wait(0.3):
+                        break
+                    conn.sendall(response[i:i + 1])
+
+        threading.Thread(target=serve, daemon=True).start()
+        host, port = listener.getsockname()
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': f'http://{host}:{port}/v1/render'}]
+        mjml_settings.MJML_RENDER_TIMEOUT = 1
+        started = time.monotonic()
+        with self.assertRaises(tools.BackendUnavailableError) as cm:
+            mjml_render(SOURCE.format('[slow]'))
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertIn('Timeouts: 1', str(cm.exception))
+
+    def test_http_auth(self) -> None:
+        server = self._start(http_auth=('user', 'password'))
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': server.url}]
+        with self.assertRaises(RuntimeError) as cm:
+            mjml_render(SOURCE.format('[auth]'))
+        self.assertIn('[code=401, request_id=] Unauthorized.', str(cm.exception))
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': server.url, 'HTTP_AUTH': ('user', 'password')}]
+        self.assertIn('[auth]', mjml_render(SOURCE.format('[auth]')))
+
+    def test_failover_on_timeout(self) -> None:
+        hanging_server = self._start(timeout_rate=1)
+        server = self._start()
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': hanging_server.url}, {'URL': server.url}]
+        mjml_settings.MJML_READ_TIMEOUT = 0.2
+        with mock.patch.object(tools._get_server_health(), 'get_servers_order',
+                               side_effect=lambda servers, key: servers):
+            self.assertIn('[failover]', mjml_render(SOURCE.format('[failover]')))
+        self.assertEqual(hanging_server.stats['timeouts'], 1)
+
+
+class TestWaitForServer(TestCase):
+    def test_wait(self) -> None:
+        with FakeMJMLTCPServer() as server:
+            wait_for_server(server.host, server.port, timeout=1)
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        with self.assertRaises(RuntimeError) as cm:
+            wait_for_server('127.0.0.1', port, timeout=0.2)
+        self.assertIn('is not ready', str(cm.exception))
+        process = mock.Mock(returncode=1, **{'poll.return_value': 1})
+        with self.assertRaises(RuntimeError) as cm:
+            wait_for_server('127.0.0.1', port, timeout=5, process=process)
+        self.assertIn('has exited with code 1', str(cm.exception))
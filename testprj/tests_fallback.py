@@ -0,0 +1,162 @@
+import asyncio
+from unittest import mock
+
+from django.test import TestCase
+
+from mjml import settings as mjml_settings
+from mjml import tools
+from mjml.backends import get_backend
+from mjml.signals import render_finished
+from mjml.tools import BackendUnavailableError, mjml_render, mjml_render_async, mjml_render_many
+from testprj.fakeserver import FakeMJMLHTTPServer, FakeMJMLTCPServer
+from testprj.tools import MJMLSettingsMixin
+
+SOURCE = '<mjml><mj-body><mj-section><mj-column><mj-text>{}</mj-text></mj-column></mj-section></mj-body></mjml>'
+
+
+class TestBackendFallback(MJMLSettingsMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        mjml_settings.MJML_BACKEND_MODE = 'tcpserver'
+        mjml_settings.MJML_FALLBACK_BACKEND_MODES = ['httpserver', 'cmd']
+        mjml_settings.MJML_COALESCE_RENDERS = False
+        self.tcp_server = self._start_server(FakeMJMLTCPServer())
+        self.http_server = self._start_server(FakeMJMLHTTPServer())
+        mjml_settings.MJML_TCPSERVERS = [self.tcp_server.address]
+        mjml_settings.MJML_HTTPSERVERS = [{'URL': self.http_server.url}]
+        self.infos = []
+        render_finished.connect(self.receiver)
+        self.addCleanup(render_finished.disconnect, self.receiver)
+
+    def receiver(self, sender, info, **kwargs) -> None:
+        self.infos.append(info)
+
+    def test_primary(self) -> None:
+        self.assertIn('[primary]', mjml_render(SOURCE.format('[primary]')))
+        self.assertEqual(self.tcp_server.stats['requests'], 1)
+        self.assertEqual(self.http_server.stats['requests'], 0)
+        self.assertEqual(self.infos[0].backend, 'tcpserver')
+        self.assertEqual(self.infos[0].fallbacks, 0)
+
+    def test_fallback(self) -> None:
+        self.tcp_server.stop()
+        self.assertIn('[http]', mjml_render(SOURCE.format('[http]')))
+        self.assertEqual(self.http_server.stats['requests'], 1)
+        self.assertEqual((self.infos[0].backend, self.infos[0].fallbacks), ('httpserver', 1))
+
+        self.http_server.stop()
+        html = mjml_render(SOURCE.format('[cmd]'))
+        self.assertIn('[cmd]', html)
+        self.assertEqual((self.infos[1].backend, self.infos[1].fallbacks), ('cmd', 2))
+
+        self.assertIn('[async]', asyncio.run(mjml_render_async(SOURCE.format('[async]'))))
+        self.assertEqual(self.infos[2].backend, 'cmd')
+
+    def test_last_backend_error(self) -> None:
+        self.tcp_server.stop()
+        self.http_server.stop()
+        mjml_settings.MJML_EXEC_CMD = 'mjml-wrong-cmd'
+        with self.assertRaises(BackendUnavailableError) as cm:
+            mjml_render(SOURCE.format('[error]'))
+        self.assertIn('Problem to run command "mjml-wrong-cmd', str(cm.exception))
+
+    def test_compile_error_is_not_passed(self) -> None:
+        self.tcp_server.error_rate = 1
+        with self.assertRaises(RuntimeError) as cm:
+            mjml_render(SOURCE.format('[error]'))
+        self.assertNotIsInstance(cm.exception, BackendUnavailableError)
+        self.assertIn('Fake error', str(cm.exception))
+        self.assertEqual(self.http_server.stats['requests'], 0)
+
+    def test_circuit_open(self) -> None:
+        mjml_settings.MJML_CIRCUIT_BREAKER_FAILURES = 1
+        self.tcp_server.stop()
+        mjml_render(SOURCE.format('[first]'))
+        self.assertEqual(self.infos[0].attempts, 2)
+        self.assertTrue(get_backend('tcpserver').is_circuit_open())
+        # the broken tier is skipped without connecting
+        mjml_render(SOURCE.format('[second]'))
+        self.assertEqual((self.infos[1].backend, self.infos[1].attempts), ('httpserver', 1))
+        self.assertEqual(self.http_server.stats['requests'], 2)
+
+    def test_overflow(self) -> None:
+        self.tcp_server.latency = 0.3
+        mjml_settings.MJML_BACKEND_MAX_CONCURRENCY = {'tcpserver': 1}
+        htmls = mjml_render_many([SOURCE.format(i) for i in range(2)], max_workers=2)
+        self.assertEqual(len(htmls), 2)
+        self.assertEqual(self.tcp_server.stats['requests'], 1)
+        self.assertEqual(self.http_server.stats['requests'], 1)
+
+    def test_overflow_async(self) -> None:
+        self.tcp_server.latency = 0.3
+        mjml_settings.MJML_BACKEND_MAX_CONCURRENCY = {'tcpserver': 1}
+
+        async def render():
+            return await asyncio.gather(*(mjml_render_async(SOURCE.format(i)) for i in range(2)))
+
+        self.assertEqual(len(asyncio.run(render())), 2)
+        self.assertEqual(self.tcp_server.stats['requests'], 1)
+        self.assertEqual(self.http_server.stats['requests'], 1)
+
+    def test_all_busy(self) -> None:
+        mjml_settings.MJML_FALLBACK_BACKEND_MODES = []
+        mjml_settings.MJML_BACKEND_MAX_CONCURRENCY = {'tcpserver': 1}
+        mjml_settings.MJML_RENDER_TIMEOUT = 0.1
+        limiter = tools._get_backend_limiter('tcpserver')
+        limiter.acquire()
+        try:
+            with self.assertRaises(BackendUnavailableError) as cm:
+                mjml_render(SOURCE.format('[busy]'))
+            self.assertIn('all backends are busy', str(cm.exception))
+            with self.assertRaises(BackendUnavailableError):
+                asyncio.run(mjml_render_async(SOURCE.format('[busy async]')))
+        finally:
+            limiter.release()
+        self.assertIn('[free]', mjml_render(SOURCE.format('[free]')))
+        self.assertEqual(self.tcp_server.stats['requests'], 1)
+
+    def test_last_backend_waits(self) -> None:
+        mjml_settings.MJML_FALLBACK_BACKEND_MODES = []
+        mjml_settings.MJML_BACKEND_MAX_CONCURRENCY = {'tcpserver': 1}
+        self.tcp_server.latency = 0.1
+        with mock.patch.object(tools, '_mjml_render_by_httpserver') as http_mock:
+            htmls = mjml_render_many([SOURCE.format(i) for i in range(3)], max_workers=3)
+        self.assertEqual(len(htmls), 3)
+        self.assertFalse(http_mock.called)
+        self.assertEqual(self.tcp_server.stats['requests'], 3)
+
+    def test_render_many_batch_fallback(self) -> None:
+        mjml_settings.MJML_BACKEND_MODE = 'cmd'
+        mjml_settings.MJML_FALLBACK_BACKEND_MODES = ['tcpserver']
+        mjml_settings.MJML_CMD_BATCH = True
+        mjml_settings.MJML_EXEC_CMD = 'mjml-missing'
+        htmls = mjml_render_many([SOURCE.format(f'[batch {i}]') for i in range(3)], max_workers=2)
+        for i, html in enumerate(htmls):
+            self.assertIn(f'[batch {i}]', html)
+        self.assertEqual(self.tcp_server.stats['requests'], 3)
+
+    def test_render_many_batch_overflow(self) -> None:
+        mjml_settings.MJML_BACKEND_MODE = 'cmd'
+        mjml_settings.MJML_FALLBACK_BACKEND_MODES = ['tcpserver']
+        mjml_settings.MJML_CMD_BATCH = True
+        mjml_settings.MJML_BACKEND_MAX_CONCURRENCY = {'cmd': 1}
+        limiter = tools._get_backend_limiter('cmd')
+        limiter.acquire()
+        try:
+            with mock.patch.object(tools, '_mjml_render_many_by_cmd') as batch_mock:
+                htmls = mjml_render_many([SOURCE.format(f'[busy {i}]') for i in range(2)])
+        finally:
+            limiter.release()
+        self.assertFalse(batch_mock.called)
+        self.assertIn('[busy 1]', htmls[1])
+        self.assertEqual(self.tcp_server.stats['requests'], 2)
+
+        mjml_settings.MJML_FALLBACK_BACKEND_MODES = []
+        mjml_settings.MJML_RENDER_TIMEOUT = 0.1
+        limiter.acquire()
+        try:
+            with self.assertRaises(BackendUnavailableError) as cm:
+                mjml_render_many([SOURCE.format(f'[busy {i}]') for i in range(2)])
+            self.assertIn('all backends are busy', str(cm.exception))
+        finally:
+            limiter.release()
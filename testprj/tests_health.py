@@ -0,0 +1,112 @@
+import asyncio
+from unittest import mock
+
+from django.test import TestCase
+
+from mjml.health import CLOSED, HALF_OPEN, OPEN, ServerHealthRegistry
+
+
+class TestServerHealthRegistry(TestCase):
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.registry = ServerHealthRegistry(
+            ewma_alpha=0.5, failure_threshold=2, recovery_timeout=10, clock=lambda: self.now,
+        )
+
+    def _get_order(self, servers):
+        return self.registry.get_servers_order(servers, key=lambda s: s)
+
+    def test_ewma_latency(self) -> None:
+        self.registry.begin('a')
+        self.registry.record_success('a', 1.0)
+        self.registry.begin('a')
+        self.registry.record_success('a', 3.0)
+        stats = self.registry.get_stats()['a']
+        self.assertEqual(stats['latency'], 2.0)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_prefer_fast_server(self) -> None:
+        self.registry.record_success('slow', 2.0)
+        self.registry.record_success('fast', 0.1)
+        for _ in range(10):
+            self.assertEqual(self._get_order(['slow', 'fast']), ['fast', 'slow'])
+
+        # servers in progress are less attractive
+        for _ in range(30):
+            self.registry.begin('fast')
+        self.assertEqual(self._get_order(['slow', 'fast']), ['slow', 'fast'])
+
+    def test_power_of_two_choices(self) -> None:
+        for i, key in enumerate('abcd'):
+            self.registry.record_success(key, i + 1.0)
+        with mock.patch('random.sample', return_value=[3, 2]):
+            self.assertEqual(self._get_order(['a', 'b', 'c', 'd']), ['c', 'a', 'b', 'd'])
+
+    def test_circuit_breaker(self) -> None:
+        for _ in range(2):
+            with self.assertRaises(OSError):
+                with self.registry.track('a'):
+                    raise OSError('test')
+        self.assertEqual(self.registry.get_stats()['a']['state'], OPEN)
+        self.assertEqual(self._get_order(['a', 'b']), ['b'])
+        self.assertEqual(self._get_order(['a']), ['a'])  # all servers are broken, so try them anyway
+
+        # half-open: only one probe request
+        self.now = 10.0
+        self.assertEqual(sorted(self._get_order(['a', 'b'])), ['a', 'b'])
+        self.registry.begin('a')
+        self.assertEqual(self.registry.get_stats()['a']['state'], HALF_OPEN)
+        self.assertEqual(self._get_order(['a', 'b']), ['b'])
+
+        # failed probe opens circuit again
+        self.registry.record_failure('a')
+        self.assertEqual(self.registry.get_stats()['a']['state'], OPEN)
+        self.now = 15.0
+        self.assertEqual(self._get_order(['a', 'b']), ['b'])
+
+        # successful probe closes circuit
+        self.now = 20.0
+        with self.registry.track('a'):
+            pass
+        self.assertEqual(self.registry.get_stats()['a']['state'], CLOSED)
+        self.assertEqual(sorted(self._get_order(['a', 'b'])), ['a', 'b'])
+
+    def test_cancelled(self) -> None:
+        # the loser of a hedged request is cancelled, it isn't a failure of the server
+        for _ in range(3):
+            with self.assertRaises(asyncio.CancelledError):
+                with self.registry.track('a'):
+                    raise asyncio.CancelledError()
+        stats = self.registry.get_stats()['a']
+        self.assertEqual(stats['state'], CLOSED)
+        self.assertEqual(stats['failures'], 0)
+        self.assertEqual(stats['in_flight'], 0)
+
+        # a cancelled probe allows the next one
+        self.registry.record_failure('a')
+        self.registry.record_failure('a')
+        self.now = 10.0
+        self._get_order(['a'])
+        self.registry.begin('a')
+        self.assertEqual(self._get_order(['a', 'b']), ['b'])
+        self.registry.record_cancel('a')
+        self.assertEqual(sorted(self._get_order(['a', 'b'])), ['a', 'b'])
+
+    def test_is_open(self) -> None:
+        self.assertFalse(self.registry.is_open(['a', 'b']))
+        self.assertFalse(self.registry.is_open([]))
+        for key in ('a', 'b'):
+            for _ in range(2):
+                self.registry.begin(key)
+                self.registry.record_failure(key)
+        self.assertTrue(self.registry.is_open(['a', 'b']))
+        self.assertFalse(self.registry.is_open(['a', 'b', 'c']))
+
+        # recovery timeout has passed, a probe request is allowed
+        self.now = 10.0
+        self.assertFalse(self.registry.is_open(['a', 'b']))
+        self._get_order(['a'])
+        self.registry.begin('a')
+        self._get_order(['b'])
+        self.registry.begin('b')
+        self.assertTrue(self.registry.is_open(['a', 'b']))
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import unittest
 from unittest import mock
@@ -7,7 +8,9 @@ from django.test import TestCase
 from django.utils.encoding import force_bytes
 
 from mjml import settings as mjml_settings
-from testprj.tools import safe_change_mjml_settings, MJMLServers, MJMLFixtures, render_tpl
+from mjml import tools
+from mjml.tools import mjml_render_async
+from testprj.tools import safe_change_mjml_settings, MJMLServers, MJMLFixtures, render_tpl, get_mjml_version
 
 
 class TestMJMLHTTPServer(MJMLFixtures, MJMLServers, TestCase):
@@ -66,7 +69,23 @@ class TestMJMLHTTPServer(MJMLFixtures, MJMLServers, TestCase):
             """)
         self.assertIn(' Tag: mj-button Message: mj-button ', str(cm.exception))
 
-    @mock.patch('requests.post')
+    def test_compression_rejected(self) -> None:
+        # mjml-http-server doesn't decode gzipped requests and responds 400
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_COMPRESSION_MIN_SIZE = 0
+            mjml_settings.MJML_COALESCE_RENDERS = False
+            for server_conf in mjml_settings.MJML_HTTPSERVERS:
+                server_conf['COMPRESSION'] = True
+            html = render_tpl(self.TPLS['simple'])
+            self.assertIn('Test button', html)
+            no_compression = tools._get_process_local('httpserver_no_compression', set)
+            self.assertEqual(len(no_compression), 1)  # the first working server has rendered it
+            urls = [server_conf['URL'] for server_conf in mjml_settings.MJML_HTTPSERVERS]
+            self.assertIn(list(no_compression)[0], urls)
+            html = asyncio.run(mjml_render_async('<mjml><mj-body><mj-text>[async]</mj-text></mj-body></mjml>'))
+            self.assertIn('[async]', html)
+
+    @mock.patch('requests.Session.post')
     def test_http_auth(self, post_mock) -> None:
         with safe_change_mjml_settings():
             for server_conf in mjml_settings.MJML_HTTPSERVERS:
@@ -88,10 +107,31 @@ class TestMJMLHTTPServer(MJMLFixtures, MJMLServers, TestCase):
             render_tpl(self.TPLS['simple'])
 
             self.assertTrue(post_mock.called)
-            self.assertIn('auth', post_mock.call_args[1])
-            self.assertIsInstance(post_mock.call_args[1]['auth'], requests.auth.HTTPBasicAuth)
-            self.assertEqual(post_mock.call_args[1]['auth'].username, 'testuser')
-            self.assertEqual(post_mock.call_args[1]['auth'].password, 'testpassword')
+            for server_conf in mjml_settings.MJML_HTTPSERVERS:
+                auth = tools._get_http_session(server_conf).auth
+                self.assertIsInstance(auth, requests.auth.HTTPBasicAuth)
+                self.assertEqual(auth.username, 'testuser')
+                self.assertEqual(auth.password, 'testpassword')
+
+    def test_session_reuse(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_HTTPSERVERS = mjml_settings.MJML_HTTPSERVERS[:1]
+            session = tools._get_http_session(mjml_settings.MJML_HTTPSERVERS[0])
+            self.assertIsNone(session.auth)
+            for i in range(3):
+                html = render_tpl(self.TPLS['with_text_context'], {'text': f'text {i}'})
+                self.assertIn(f'text {i}', html)
+            self.assertIs(tools._get_http_session(mjml_settings.MJML_HTTPSERVERS[0]), session)
+            adapter = session.get_adapter(mjml_settings.MJML_HTTPSERVERS[0]['URL'])
+            pool = next(iter(adapter.poolmanager.pools._container.values()))
+            self.assertEqual(pool.num_connections, 1)  # all renders used one keep-alive connection
+
+    def test_async_without_httpx(self) -> None:
+        with mock.patch.dict('sys.modules', {'httpx': None}):
+            html = asyncio.run(mjml_render_async(
+                '<mjml><mj-body><mj-section><mj-column><mj-text>no httpx</mj-text></mj-column></mj-section></mj-body></mjml>'
+            ))
+        self.assertIn('no httpx', html)
 
     @unittest.skip('to run locally')
     def test_public_api(self) -> None:
@@ -124,3 +164,19 @@ class TestMJMLHTTPServer(MJMLFixtures, MJMLServers, TestCase):
                     {% endmjml %}
                 """)
             self.assertIn(' Tag: mj-button Message: mj-button ', str(cm.exception))
+
+    def test_async(self) -> None:
+        mjml_source = '<mjml><mj-body><mj-container><mj-text>{}</mj-text></mj-container></mj-body></mjml>'
+        if get_mjml_version() >= 4:
+            mjml_source = mjml_source.replace('<mj-container>', '').replace('</mj-container>', '')
+
+        async def render_all():
+            return await asyncio.gather(*(mjml_render_async(mjml_source.format(f'text {i}')) for i in range(10)))
+
+        results = asyncio.run(render_all())
+        for i, html in enumerate(results):
+            self.assertIn('<html ', html)
+            self.assertIn(f'text {i}', html)
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(mjml_render_async('<mjml><mj-body><mj-button></mj-body></mjml>'))
@@ -0,0 +1,104 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.template import TemplateDoesNotExist, engines
+from django.test import TestCase, override_settings
+
+from mjml import tools
+from mjml.loaders import Loader as MJMLLoader
+from testprj.tools import get_mjml_version
+
+
+class TestMJMLLoader(TestCase):
+    @staticmethod
+    def _get_source(text: str) -> str:
+        if get_mjml_version() >= 4:
+            return f'<mjml><mj-body><mj-section><mj-column><mj-text>{text}</mj-text></mj-column></mj-section></mj-body></mjml>'
+        return f'<mjml><mj-body><mj-container><mj-text>{text}</mj-text></mj-container></mj-body></mjml>'
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.templates_dir = tmp_dir.name
+        self._write('static.mjml', self._get_source('[static]'))
+        self._write('hello.mjml', '{% load i18n %}' + self._get_source('[hello {{ name }}]'))
+        self._write('list.mjml', self._get_source('{% for item in items %}[{{ item }}]{% endfor %}'))
+        self._write('page.html', '<p>{{ name }}</p>')
+
+    def _write(self, name: str, content: str, mtime=None) -> None:
+        path = os.path.join(self.templates_dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def _get_engine(self, debug: bool = False):
+        loaders = [('mjml.loaders.Loader', ['django.template.loaders.filesystem.Loader'])]
+        templates_settings = override_settings(TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [self.templates_dir],
+            'OPTIONS': {'loaders': loaders, 'debug': debug},
+        }])
+        templates_settings.enable()
+        self.addCleanup(templates_settings.disable)
+        return engines['django']
+
+    def test_render(self) -> None:
+        engine = self._get_engine()
+        with mock.patch('mjml.templatetags.mjml.mjml_render', wraps=tools.mjml_render) as render_mock:
+            self.assertIsInstance(engine.engine.template_loaders[0], MJMLLoader)
+            html = engine.get_template('static.mjml').render()
+            self.assertIn('<html ', html)
+            self.assertIn('[static]', html)
+
+            tpl = engine.get_template('hello.mjml')
+            for name in ('Bob', 'Alice'):
+                html = tpl.render({'name': name})
+                self.assertIn(f'[hello {name}]', html)
+
+            tpl = engine.get_template('list.mjml')
+            html = tpl.render({'items': [1, 2]})
+            self.assertIn('[1][2]', html)
+            tpl.render({'items': [3]})
+
+            # the static template and skeleton are compiled once, the template with tags on every render
+            self.assertEqual(render_mock.call_count, 4)
+            for _ in range(3):
+                engine.get_template('static.mjml').render()
+                engine.get_template('hello.mjml').render({'name': 'Bob'})
+            self.assertEqual(render_mock.call_count, 4)
+
+        self.assertEqual(engine.get_template('page.html').render({'name': 'Bob'}), '<p>Bob</p>')
+        with self.assertRaises(TemplateDoesNotExist):
+            engine.get_template('missed.mjml')
+
+    def test_debug_mtime(self) -> None:
+        engine = self._get_engine(debug=True)
+        self.assertIn('[static]', engine.get_template('static.mjml').render())
+        with mock.patch('mjml.templatetags.mjml.mjml_render', wraps=tools.mjml_render) as render_mock:
+            self.assertIn('[static]', engine.get_template('static.mjml').render())
+            self.assertEqual(render_mock.call_count, 0)
+
+            self._write('static.mjml', self._get_source('[changed]'), mtime=os.path.getmtime(
+                os.path.join(self.templates_dir, 'static.mjml')) + 10)
+            self.assertIn('[changed]', engine.get_template('static.mjml').render())
+            self.assertEqual(render_mock.call_count, 1)
+
+    def test_no_reload_without_debug(self) -> None:
+        engine = self._get_engine()
+        self.assertIn('[static]', engine.get_template('static.mjml').render())
+        self._write('static.mjml', self._get_source('[changed]'), mtime=os.path.getmtime(
+            os.path.join(self.templates_dir, 'static.mjml')) + 10)
+        self.assertIn('[static]', engine.get_template('static.mjml').render())
+
+        engine.engine.template_loaders[0].reset()
+        self.assertIn('[changed]', engine.get_template('static.mjml').render())
+
+    def test_extends(self) -> None:
+        self._write('base.mjml', self._get_source('{% block content %}{% endblock %}'))
+        self._write('child.mjml', '{% extends "base.mjml" %}{% block content %}[child {{ name }}]{% endblock %}')
+        engine = self._get_engine()
+        html = engine.get_template('child.mjml').render({'name': 'Bob'})
+        self.assertEqual(html.count('<html '), 1)
+        self.assertIn('[child Bob]', html)
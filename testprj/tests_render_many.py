@@ -0,0 +1,58 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from mjml import settings as mjml_settings
+from mjml import tools
+from mjml.tools import mjml_render_many
+from testprj.tools import safe_change_mjml_settings, get_mjml_version
+
+
+class TestMJMLRenderMany(TestCase):
+    @staticmethod
+    def _get_source(text: str) -> str:
+        if get_mjml_version() >= 4:
+            return f'<mjml><mj-body><mj-section><mj-column><mj-text>{text}</mj-text></mj-column></mj-section></mj-body></mjml>'
+        return f'<mjml><mj-body><mj-container><mj-text>{text}</mj-text></mj-container></mj-body></mjml>'
+
+    def test_order(self) -> None:
+        sources = [self._get_source(f'[text {i}]') for i in range(10)]
+        results = mjml_render_many(sources, max_workers=4)
+        self.assertEqual(len(results), 10)
+        for i, html in enumerate(results):
+            self.assertIn('<html ', html)
+            self.assertIn(f'[text {i}]', html)
+
+    def test_dedupe(self) -> None:
+        sources = [self._get_source('one'), self._get_source('two'), self._get_source('one')]
+        with safe_change_mjml_settings(), \
+                mock.patch('mjml.tools.mjml_render', side_effect=lambda s: s.upper()) as render_mock:
+            mjml_settings.MJML_CMD_BATCH = False
+            results = mjml_render_many(sources)
+        self.assertEqual(render_mock.call_count, 2)
+        self.assertEqual(results, [s.upper() for s in sources])
+
+    def test_errors(self) -> None:
+        sources = [self._get_source('one'), 'wrong', self._get_source('two')]
+        with self.assertRaises(RuntimeError):
+            mjml_render_many(sources, max_workers=2)
+
+        results = mjml_render_many(sources, max_workers=2, return_exceptions=True)
+        self.assertIn('one', results[0])
+        self.assertIsInstance(results[1], RuntimeError)
+        self.assertIn('two', results[2])
+
+    def test_empty(self) -> None:
+        self.assertEqual(mjml_render_many([]), [])
+
+    def test_default_max_workers(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_BACKEND_MODE = 'worker'
+            mjml_settings.MJML_WORKER_POOL_SIZE = 3
+            self.assertEqual(tools._get_default_max_workers(), 3)
+            mjml_settings.MJML_BACKEND_MODE = 'tcpserver'
+            mjml_settings.MJML_TCPSERVER_POOL_SIZE = 2
+            self.assertEqual(tools._get_default_max_workers(), len(mjml_settings.MJML_TCPSERVERS) * 2)
+            mjml_settings.MJML_BACKEND_MODE = 'httpserver'
+            mjml_settings.MJML_HTTPSERVER_POOL_SIZE = 5
+            self.assertEqual(tools._get_default_max_workers(), len(mjml_settings.MJML_HTTPSERVERS) * 5)
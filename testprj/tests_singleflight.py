@@ -0,0 +1,132 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from unittest import mock
+
+from django.test import TestCase
+
+from mjml import settings as mjml_settings
+from mjml.singleflight import AsyncSingleFlight, SingleFlight
+from mjml.tools import mjml_render, mjml_render_async
+from testprj.tools import safe_change_mjml_settings
+
+
+class TestSingleFlight(TestCase):
+    def _run_concurrently(self, func, count: int):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [executor.submit(func) for _ in range(count)]
+            return [f.exception() or f.result() for f in futures]
+
+    def test_coalesce(self) -> None:
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def func(value):
+            calls.append(value)
+            release.wait(5)
+            return value * 2
+
+        def wait_and_release():
+            while single_flight._calls.get('key') is None or single_flight._calls['key'].waiters < 4:
+                time.sleep(0.01)
+            release.set()
+
+        threading.Thread(target=wait_and_release, daemon=True).start()
+        results = self._run_concurrently(lambda: single_flight.do('key', func, 21), 5)
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(calls, [21])
+        self.assertEqual(single_flight.in_flight(), 0)
+
+        # the next call after the end isn't coalesced
+        self.assertEqual(single_flight.do('key', func, 1), 2)
+        self.assertEqual(calls, [21, 1])
+
+    def test_exception(self) -> None:
+        single_flight = SingleFlight()
+        release = threading.Event()
+
+        def func():
+            release.wait(5)
+            raise RuntimeError('error')
+
+        def wait_and_release():
+            while single_flight._calls.get('key') is None or single_flight._calls['key'].waiters < 2:
+                time.sleep(0.01)
+            release.set()
+
+        threading.Thread(target=wait_and_release, daemon=True).start()
+        results = self._run_concurrently(lambda: single_flight.do('key', func), 3)
+        for e in results:
+            self.assertIsInstance(e, RuntimeError)
+        self.assertEqual(single_flight.in_flight(), 0)
+
+    def test_async(self) -> None:
+        calls = []
+
+        async def func(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            if value is None:
+                raise RuntimeError('error')
+            return value * 2
+
+        async def run():
+            single_flight = AsyncSingleFlight()
+            results = await asyncio.gather(*(single_flight.do('a', func, 21) for _ in range(5)))
+            errors = await asyncio.gather(*(single_flight.do('b', func, None) for _ in range(3)),
+                                          return_exceptions=True)
+
+            # cancellation of the first caller doesn't cancel the call for the others
+            first = asyncio.ensure_future(single_flight.do('c', func, 1))
+            second = asyncio.ensure_future(single_flight.do('c', func, 1))
+            await asyncio.sleep(0)
+            first.cancel()
+            return results, errors, await second, single_flight.in_flight()
+
+        results, errors, second_result, in_flight = asyncio.run(run())
+        self.assertEqual(results, [42] * 5)
+        for e in errors:
+            self.assertIsInstance(e, RuntimeError)
+        self.assertEqual(second_result, 2)
+        self.assertEqual(in_flight, 0)
+        self.assertEqual(calls, [21, None, 1])
+
+
+class TestMJMLRenderCoalescing(TestCase):
+    def test_render(self) -> None:
+        barrier = threading.Barrier(4, timeout=5)
+
+        def render(mjml_source):
+            time.sleep(0.2)
+            return mjml_source.upper()
+
+        def call():
+            barrier.wait()
+            return mjml_render('<mjml>same</mjml>')
+
+        with mock.patch('mjml.tools._mjml_render', side_effect=render) as render_mock:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                results = [f.result() for f in [executor.submit(call) for _ in range(4)]]
+            self.assertEqual(results, ['<MJML>SAME</MJML>'] * 4)
+            self.assertEqual(render_mock.call_count, 1)
+
+            with safe_change_mjml_settings():
+                mjml_settings.MJML_COALESCE_RENDERS = False
+                barrier.reset()
+                with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                    [f.result() for f in [executor.submit(call) for _ in range(4)]]
+                self.assertEqual(render_mock.call_count, 5)
+
+    def test_render_async(self) -> None:
+        async def render(mjml_source):
+            await asyncio.sleep(0.05)
+            return mjml_source.upper()
+
+        async def run():
+            return await asyncio.gather(*(mjml_render_async('<mjml>same</mjml>') for _ in range(4)))
+
+        with mock.patch('mjml.tools._mjml_render_async', side_effect=render) as render_mock:
+            self.assertEqual(asyncio.run(run()), ['<MJML>SAME</MJML>'] * 4)
+            self.assertEqual(render_mock.call_count, 1)
@@ -0,0 +1,203 @@
+import io
+import json
+import os
+import tempfile
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase
+
+from mjml import settings as mjml_settings
+from mjml.instrumentation import RenderInfo
+from mjml.signals import render_finished
+from mjml.stats import (
+    RenderStats, clear_stats, disable_stats, enable_stats, format_prometheus, get_histogram_quantile,
+    get_render_stats, get_stats_snapshot, merge_snapshots,
+)
+from mjml.tools import mjml_render, mjml_render_many
+from mjml.views import metrics
+from testprj.tools import safe_change_mjml_settings, get_mjml_version
+
+
+def _get_info(backend: str = 'cmd', server=None, duration: float = 0.02, error=None) -> RenderInfo:
+    info = RenderInfo(backend, 100)
+    info.server = server
+    info.attempts = 1
+    info.output_size = 1000
+    info.duration = duration
+    info.timings = {'compile': duration}
+    info.error = error
+    return info
+
+
+class TestRenderFinishedSignal(TestCase):
+    @staticmethod
+    def _get_source(text: str) -> str:
+        if get_mjml_version() >= 4:
+            return f'<mjml><mj-body><mj-section><mj-column><mj-text>{text}</mj-text></mj-column></mj-section></mj-body></mjml>'
+        return f'<mjml><mj-body><mj-container><mj-text>{text}</mj-text></mj-container></mj-body></mjml>'
+
+    def setUp(self) -> None:
+        self.infos = []
+        render_finished.connect(self.receiver)
+        self.addCleanup(render_finished.disconnect, self.receiver)
+
+    def receiver(self, sender, info, **kwargs) -> None:
+        self.infos.append(info)
+
+    def test_render(self) -> None:
+        source = self._get_source('[signal]')
+        html = mjml_render(source)
+        self.assertEqual(len(self.infos), 1)
+        info = self.infos[0]
+        self.assertEqual(info.backend, 'cmd')
+        self.assertIsNone(info.server)
+        self.assertIsNone(info.cache)
+        self.assertFalse(info.coalesced)
+        self.assertIsNone(info.error)
+        self.assertEqual(info.input_size, len(source.encode('utf-8')))
+        self.assertEqual(info.output_size, len(html.encode('utf-8')))
+        self.assertGreater(info.duration, 0)
+        self.assertIn('compile', info.timings)
+
+    def test_cache(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_CACHE = {}
+            mjml_render(self._get_source('[cache]'))
+            mjml_render(self._get_source('[cache]'))
+        self.assertEqual([info.cache for info in self.infos], ['miss', 'hit'])
+        self.assertNotIn('compile', self.infos[1].timings)
+
+    def test_error(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_EXEC_CMD = 'mjml-wrong-cmd'
+            with self.assertRaises(RuntimeError):
+                mjml_render(self._get_source('[error]'))
+        self.assertEqual(len(self.infos), 1)
+        self.assertIsInstance(self.infos[0].error, RuntimeError)
+        self.assertIsNone(self.infos[0].output_size)
+
+    def test_render_many_batch(self) -> None:
+        sources = [self._get_source(f'[batch {i}]') for i in range(3)]
+        mjml_render_many(sources)
+        self.assertEqual(len(self.infos), 3)
+        for info in self.infos:
+            self.assertEqual(info.backend, 'cmd')
+            self.assertEqual(info.batch_size, 3)
+            self.assertIsNone(info.error)
+
+    def test_no_listeners(self) -> None:
+        render_finished.disconnect(self.receiver)
+        self.assertIn('<html ', mjml_render(self._get_source('[no listeners]')))
+        self.assertEqual(self.infos, [])
+
+
+class TestRenderStats(TestCase):
+    def setUp(self) -> None:
+        enable_stats()
+        self.addCleanup(disable_stats)
+        self.addCleanup(clear_stats)
+        clear_stats()
+
+    def test_record(self) -> None:
+        stats = RenderStats(buckets=(0.01, 0.1, 1.0))
+        stats.record(_get_info(duration=0.05))
+        stats.record(_get_info(duration=0.5, error=RuntimeError('error')))
+        snapshot = stats.get_snapshot()
+        counters = {(name, tuple(sorted(labels.items()))): value for name, labels, value in snapshot['counters']}
+        self.assertEqual(counters[('mjml_renders_total', (('backend', 'cmd'), ('server', ''), ('status', 'ok')))], 1)
+        self.assertEqual(counters[('mjml_renders_total', (('backend', 'cmd'), ('server', ''), ('status', 'error')))], 1)
+        self.assertEqual(counters[('mjml_render_attempts_total', (('backend', 'cmd'),))], 2)
+        self.assertEqual(counters[('mjml_render_output_bytes_total', (('backend', 'cmd'),))], 2000)
+        histograms = {name: values for name, labels, values in snapshot['histograms']}
+        self.assertEqual(histograms['mjml_render_duration_seconds'][:-1], [0, 1, 1, 0])
+        self.assertAlmostEqual(histograms['mjml_render_duration_seconds'][-1], 0.55)
+        self.assertFalse(stats.is_empty())
+        stats.clear()
+        self.assertTrue(stats.is_empty())
+
+    def test_quantile(self) -> None:
+        buckets = [0.01, 0.1, 1.0]
+        self.assertEqual(get_histogram_quantile(buckets, [0, 0, 0, 0, 0], 0.5), 0.0)
+        self.assertEqual(get_histogram_quantile(buckets, [5, 4, 1, 0, 1.0], 0.5), 0.01)
+        self.assertEqual(get_histogram_quantile(buckets, [5, 4, 1, 0, 1.0], 0.95), 1.0)
+        self.assertEqual(get_histogram_quantile(buckets, [0, 0, 0, 1, 50.0], 0.5), float('inf'))
+
+    def test_merge_and_prometheus(self) -> None:
+        stats1, stats2 = RenderStats(buckets=(0.1,)), RenderStats(buckets=(0.1,))
+        stats1.record(_get_info(backend='tcpserver', server='tcp://127.0.0.1:28101', duration=0.05))
+        stats2.record(_get_info(backend='tcpserver', server='tcp://127.0.0.1:28101', duration=0.5))
+        snapshot = merge_snapshots([stats1.get_snapshot(), stats2.get_snapshot()])
+        text = format_prometheus(snapshot)
+        labels = 'backend="tcpserver",server="tcp://127.0.0.1:28101"'
+        self.assertIn('# TYPE mjml_renders_total counter\n', text)
+        self.assertIn(f'mjml_renders_total{{{labels},status="ok"}} 2\n', text)
+        self.assertIn('# TYPE mjml_render_duration_seconds histogram\n', text)
+        self.assertIn(f'mjml_render_duration_seconds_bucket{{{labels},le="0.1"}} 1\n', text)
+        self.assertIn(f'mjml_render_duration_seconds_bucket{{{labels},le="+Inf"}} 2\n', text)
+        self.assertIn(f'mjml_render_duration_seconds_sum{{{labels}}} 0.55\n', text)
+        self.assertIn(f'mjml_render_duration_seconds_count{{{labels}}} 2\n', text)
+        self.assertIn('mjml_render_phase_seconds_count{backend="tcpserver",phase="compile"} 2\n', text)
+
+    def test_signal_receiver(self) -> None:
+        render_finished.send(sender=RenderInfo, info=_get_info())
+        snapshot = get_stats_snapshot()
+        self.assertIn(['mjml_renders_total', {'backend': 'cmd', 'server': '', 'status': 'ok'}, 1],
+                      snapshot['counters'])
+
+    def test_stats_dir(self) -> None:
+        with tempfile.TemporaryDirectory() as stats_dir, safe_change_mjml_settings():
+            mjml_settings.MJML_STATS_DIR = stats_dir
+            other = RenderStats()
+            other.record(_get_info())
+            other.record(_get_info(backend='httpserver', server='http://127.0.0.1:28101/v1/render'))
+            with open(os.path.join(stats_dir, '1.json'), 'w', encoding='utf-8') as f:
+                json.dump(other.get_snapshot(), f)
+            with open(os.path.join(stats_dir, '2.json'), 'w', encoding='utf-8') as f:
+                f.write('{')  # partially written file is skipped
+            render_finished.send(sender=RenderInfo, info=_get_info())
+            snapshot = get_stats_snapshot()
+            self.assertTrue(os.path.exists(os.path.join(stats_dir, f'{os.getpid()}.json')))
+            self.assertIn(['mjml_renders_total', {'backend': 'cmd', 'server': '', 'status': 'ok'}, 2],
+                          snapshot['counters'])
+            self.assertIn(['mjml_renders_total', {
+                'backend': 'httpserver', 'server': 'http://127.0.0.1:28101/v1/render', 'status': 'ok',
+            }, 1], snapshot['counters'])
+            clear_stats()
+            self.assertEqual(os.listdir(stats_dir), [])
+            self.assertTrue(get_render_stats().is_empty())
+
+    def test_command(self) -> None:
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('mjml_stats', stdout=stdout, stderr=stderr)
+        self.assertEqual(stdout.getvalue(), 'No renders.\n')
+        self.assertIn('Stats are disabled', stderr.getvalue())
+
+        render_finished.send(sender=RenderInfo, info=_get_info(duration=0.02))
+        render_finished.send(sender=RenderInfo, info=_get_info(duration=0.04, error=RuntimeError('error')))
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with mock.patch.object(mjml_settings, 'MJML_STATS', True):
+            call_command('mjml_stats', stdout=stdout, stderr=stderr)
+        self.assertEqual(stderr.getvalue(), '')
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[0].split(), ['backend', 'server', 'ok', 'errors', 'mean', 'p50', 'p95', 'p99'])
+        self.assertEqual(lines[1].split(), ['cmd', '-', '1', '1', '0.030', '0.025', '0.050', '0.050'])
+        self.assertIn('mjml_render_attempts_total (backend=cmd): 2', lines)
+
+        stdout = io.StringIO()
+        call_command('mjml_stats', format='json', stdout=stdout)
+        self.assertEqual(json.loads(stdout.getvalue()), get_stats_snapshot())
+
+        stdout = io.StringIO()
+        call_command('mjml_stats', format='prometheus', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), format_prometheus(get_stats_snapshot()))
+
+        call_command('mjml_stats', clear=True)
+        self.assertTrue(get_render_stats().is_empty())
+
+    def test_metrics_view(self) -> None:
+        render_finished.send(sender=RenderInfo, info=_get_info())
+        response = metrics(RequestFactory().get('/metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('mjml_renders_total{backend="cmd",server="",status="ok"} 1\n', response.content.decode())
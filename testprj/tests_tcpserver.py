@@ -1,7 +1,47 @@
+import asyncio
+import socket
+import threading
+import time
+from unittest import mock
+
 from django.test import TestCase
 
 from mjml import settings as mjml_settings
-from testprj.tools import safe_change_mjml_settings, MJMLServers, MJMLFixtures, render_tpl
+from mjml import tools
+from mjml.pool import TCPConnectionPool
+from mjml.signals import render_finished
+from mjml.tools import mjml_render_async, mjml_render_many
+from testprj.tools import safe_change_mjml_settings, MJMLServers, MJMLFixtures, render_tpl, get_mjml_version
+
+
+class TestSocketRecvall(TestCase):
+    def test_recvall(self) -> None:
+        sock, peer = socket.socketpair()
+        data = bytes(range(256)) * 4096
+        sender = threading.Thread(target=lambda: [peer.sendall(data[i:i + 1000]) for i in range(0, len(data), 1000)])
+        sender.start()
+        self.assertEqual(tools.socket_recvall(sock, 10), data[:10])
+        self.assertEqual(tools.socket_recvall(sock, len(data) - 10), data[10:])
+        sender.join()
+        peer.sendall(b'123')
+        peer.close()
+        self.assertIsNone(tools.socket_recvall(sock, 4))
+        sock.close()
+
+    def test_recvall_deadline(self) -> None:
+        # the server sends a byte every 0.1s, each recv is fast but the whole response isn't
+        sock, peer = socket.socketpair()
+        stop = threading.Event()
+        sender = threading.Thread(target=lambda: [peer.sendall(b'0') for _ in range(20) if not stop.wait(0.1)])
+        sender.start()
+        started_at = time.monotonic()
+        with self.assertRaises(socket.timeout):
+            tools.socket_recvall(sock, 10, deadline=time.monotonic() + 0.35)
+        self.assertLess(time.monotonic() - started_at, 0.6)
+        stop.set()
+        sender.join()
+        sock.close()
+        peer.close()
 
 
 class TestMJMLTCPServer(MJMLFixtures, MJMLServers, TestCase):
@@ -53,3 +93,217 @@ class TestMJMLTCPServer(MJMLFixtures, MJMLServers, TestCase):
         self.assertIn('Український текст', html)
         self.assertIn(self.TEXTS['unicode'], html)
         self.assertIn('©', html)
+
+    def _get_pools(self):
+        return [tools._get_tcpserver_pool(server) for server in mjml_settings.MJML_TCPSERVERS]
+
+    def test_connection_reuse(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVERS = mjml_settings.MJML_TCPSERVERS[:1]
+            with mock.patch.object(TCPConnectionPool, 'connect', autospec=True,
+                                   side_effect=TCPConnectionPool.connect) as connect_mock:
+                for i in range(3):
+                    html = render_tpl(self.TPLS['with_text_context'], {'text': f'text {i}'})
+                    self.assertIn(f'text {i}', html)
+            self.assertEqual(connect_mock.call_count, 1)
+            pool = self._get_pools()[0]
+            self.assertEqual(len(pool._idle), 1)
+            pool.close()
+
+    def test_pool_disabled(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVER_POOL_SIZE = 0
+            render_tpl(self.TPLS['simple'])
+            render_tpl(self.TPLS['simple'])
+            for pool in self._get_pools():
+                self.assertEqual(len(pool._idle), 0)
+
+    def test_idle_timeout(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVERS = mjml_settings.MJML_TCPSERVERS[:1]
+            mjml_settings.MJML_TCPSERVER_POOL_IDLE_TIMEOUT = 0.1
+            render_tpl(self.TPLS['simple'])
+            pool = self._get_pools()[0]
+            sock = pool._idle[-1][0]
+            time.sleep(0.2)
+            render_tpl(self.TPLS['simple'])
+            self.assertEqual(sock.fileno(), -1)  # closed
+            self.assertIsNot(pool._idle[-1][0], sock)
+            pool.close()
+
+    def test_reconnect(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVERS = mjml_settings.MJML_TCPSERVERS[:1]
+            pool = self._get_pools()[0]
+
+            # closed by server connection is dropped by the health check on checkout
+            sock, peer = socket.socketpair()
+            peer.close()
+            pool._idle.append((sock, time.monotonic()))
+            html = render_tpl(self.TPLS['simple'])
+            self.assertIn('Test title', html)
+            self.assertEqual(sock.fileno(), -1)
+
+            # connection which is closed by server while sending request is transparently replaced
+            sock, peer = socket.socketpair()
+            pool._idle.append((sock, time.monotonic()))
+            with mock.patch.object(TCPConnectionPool, 'is_healthy', return_value=True):
+                peer.close()
+                html = render_tpl(self.TPLS['simple'])
+            self.assertIn('Test title', html)
+            self.assertEqual(sock.fileno(), -1)
+            pool.close()
+
+    def test_failover(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVERS = [('127.0.0.1', 28199)] + list(mjml_settings.MJML_TCPSERVERS)
+            with mock.patch('random.shuffle'):
+                html = render_tpl(self.TPLS['simple'])
+            self.assertIn('Test title', html)
+
+            mjml_settings.MJML_TCPSERVERS = [('127.0.0.1', 28199)]
+            with self.assertRaises(RuntimeError) as cm:
+                render_tpl(self.TPLS['simple'])
+            self.assertIn('no working server', str(cm.exception))
+
+    def test_render_info(self) -> None:
+        infos = []
+
+        def receiver(sender, info, **kwargs):
+            infos.append(info)
+
+        render_finished.connect(receiver)
+        self.addCleanup(render_finished.disconnect, receiver)
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVERS = [('127.0.0.1', 28199)] + list(mjml_settings.MJML_TCPSERVERS)
+            server_health = tools._get_server_health()
+            with mock.patch.object(server_health, 'get_servers_order', side_effect=lambda servers, key: servers):
+                render_tpl(self.TPLS['simple'])
+                asyncio.run(mjml_render_async(self._get_source('async')))
+        self.assertEqual(len(infos), 2)
+        for info in infos:
+            self.assertEqual(info.backend, 'tcpserver')
+            self.assertEqual(info.attempts, 2)
+            self.assertEqual(info.server, tools._get_tcpserver_key(mjml_settings.MJML_TCPSERVERS[0]))
+            self.assertIsNone(info.error)
+            self.assertGreater(info.output_size, info.input_size)
+            self.assertEqual(set(info.timings), {'connect', 'transfer'})
+
+    def test_circuit_breaker(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVERS = [('127.0.0.1', 28199)] + list(mjml_settings.MJML_TCPSERVERS)
+            mjml_settings.MJML_CIRCUIT_BREAKER_FAILURES = 2
+            with mock.patch.object(TCPConnectionPool, 'connect', autospec=True,
+                                   side_effect=TCPConnectionPool.connect) as connect_mock:
+                for _ in range(20):
+                    render_tpl(self.TPLS['simple'])
+            dead_server_attempts = [c for c in connect_mock.call_args_list if c[0][0].address[1] == 28199]
+            self.assertEqual(len(dead_server_attempts), 2)
+            stats = tools._get_server_health().get_stats()
+            self.assertEqual(stats['tcp://127.0.0.1:28199']['state'], 'open')
+
+    def test_render_many(self) -> None:
+        tpl = self.TPLS['with_text_context'].replace('{% mjml %}', '').replace('{% endmjml %}', '')
+        if get_mjml_version() >= 4:
+            tpl = tpl.replace('<mj-container>', '').replace('</mj-container>', '')
+        sources = [tpl.replace('{{ text }}', f'[text {i}]') for i in range(20)]
+        results = mjml_render_many(sources)
+        for i, html in enumerate(results):
+            self.assertIn(f'[text {i}]', html)
+
+    def test_protocol_auto(self) -> None:
+        # mjml-tcpserver supports only protocol 1, the client falls back to it
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVER_PROTOCOL = 'auto'
+            html = render_tpl(self.TPLS['with_text_context'], {'text': '[auto]'})
+            self.assertIn('[auto]', html)
+            self.assertEqual(set(tools._get_tcpserver_protocols().values()), {1})
+
+    def test_async(self) -> None:
+        mjml_source = '<mjml><mj-body><mj-container><mj-text>{}</mj-text></mj-container></mj-body></mjml>'
+        if get_mjml_version() >= 4:
+            mjml_source = mjml_source.replace('<mj-container>', '').replace('</mj-container>', '')
+
+        async def render_all():
+            return await asyncio.gather(*(mjml_render_async(mjml_source.format(f'text {i}')) for i in range(10)))
+
+        results = asyncio.run(render_all())
+        for i, html in enumerate(results):
+            self.assertIn('<html ', html)
+            self.assertIn(f'text {i}', html)
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(mjml_render_async('<mjml><mj-body><mj-button></mj-body></mjml>'))
+
+    def test_async_connection_reuse(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVERS = mjml_settings.MJML_TCPSERVERS[:1]
+
+            async def render_twice():
+                html1 = await mjml_render_async(self._get_source('one'))
+                pool = tools._get_async_tcpserver_pool(mjml_settings.MJML_TCPSERVERS[0])
+                conn = pool._idle[-1][0]
+                html2 = await mjml_render_async(self._get_source('two'))
+                self.assertIs(pool._idle[-1][0], conn)
+                self.assertEqual(len(pool._idle), 1)
+                pool.close()
+                return html1, html2
+
+            html1, html2 = asyncio.run(render_twice())
+            self.assertIn('one', html1)
+            self.assertIn('two', html2)
+
+    @staticmethod
+    def _get_source(text: str) -> str:
+        if get_mjml_version() >= 4:
+            return f'<mjml><mj-body><mj-section><mj-column><mj-text>{text}</mj-text></mj-column></mj-section></mj-body></mjml>'
+        return f'<mjml><mj-body><mj-container><mj-text>{text}</mj-text></mj-container></mj-body></mjml>'
+
+    @staticmethod
+    def _get_stuck_server() -> socket.socket:
+        # connections are established (backlog) but the server never responds
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(10)
+        return sock
+
+    def test_render_timeout(self) -> None:
+        stuck_server = self._get_stuck_server()
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVERS = [stuck_server.getsockname()] * 3
+            mjml_settings.MJML_READ_TIMEOUT = 0.5
+            mjml_settings.MJML_RENDER_TIMEOUT = 0.8
+            for render in (
+                lambda: render_tpl(self.TPLS['simple']),
+                lambda: asyncio.run(mjml_render_async(self._get_source('async'))),
+            ):
+                started_at = time.monotonic()
+                with self.assertRaises(RuntimeError) as cm:
+                    render()
+                self.assertLess(time.monotonic() - started_at, 1.5)
+                self.assertIn('no working server', str(cm.exception))
+                self.assertIn('Timeouts: 2', str(cm.exception))
+                tools._cache.clear()
+        stuck_server.close()
+
+    def test_hedged_request(self) -> None:
+        stuck_server = self._get_stuck_server()
+        stuck_server_addr = stuck_server.getsockname()
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_TCPSERVERS = [stuck_server_addr, mjml_settings.MJML_TCPSERVERS[0]]
+            mjml_settings.MJML_READ_TIMEOUT = 10
+            mjml_settings.MJML_HEDGE_PERCENTILE = 90
+            for render in (
+                lambda: render_tpl(self.TPLS['with_text_context'], {'text': 'hedged'}),
+                lambda: asyncio.run(mjml_render_async(self._get_source('hedged'))),
+            ):
+                server_health = tools._get_server_health()
+                for _ in range(10):
+                    server_health.record_success(tools._get_tcpserver_key(stuck_server_addr), 0.1)
+                with mock.patch.object(server_health, 'get_servers_order', side_effect=lambda servers, key: servers):
+                    started_at = time.monotonic()
+                    html = render()
+                self.assertLess(time.monotonic() - started_at, 5)
+                self.assertIn('hedged', html)
+                tools._cache.clear()
+        stuck_server.close()
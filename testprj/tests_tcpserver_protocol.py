@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+from django.test import TestCase
+
+from mjml import settings as mjml_settings
+from mjml import tools
+from mjml.tools import mjml_render, mjml_render_async, mjml_render_many
+from testprj.fakeserver import FakeMJMLTCPServer
+from testprj.tools import MJMLSettingsMixin
+
+SOURCE = '<mjml><mj-body><mj-section><mj-column><mj-text>{}</mj-text></mj-column></mj-section></mj-body></mjml>'
+
+
+class TestTCPServerProtocol(MJMLSettingsMixin, TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        mjml_settings.MJML_BACKEND_MODE = 'tcpserver'
+        mjml_settings.MJML_TCPSERVER_PROTOCOL = 'auto'
+        mjml_settings.MJML_COALESCE_RENDERS = False
+
+    def _start(self, **kwargs) -> FakeMJMLTCPServer:
+        server = self._start_server(FakeMJMLTCPServer(**kwargs))
+        mjml_settings.MJML_TCPSERVERS = [server.address]
+        return server
+
+    def test_multiplexed(self) -> None:
+        server = self._start(latency=(0.0, 0.1), seed=1)  # responses come in other order than requests
+        started = time.monotonic()
+        htmls = mjml_render_many([SOURCE.format(f'[render {i}]') for i in range(20)], max_workers=20)
+        self.assertLess(time.monotonic() - started, 1)
+        for i, html in enumerate(htmls):
+            self.assertIn(f'[render {i}]', html)
+        self.assertEqual(server.stats['connections'], 1)
+        self.assertEqual(server.stats['multiplexed'], 20)
+        self.assertEqual(tools._get_tcpserver_protocols(), {server.address: 2})
+        with self.assertRaises(RuntimeError) as cm:
+            mjml_render('123')
+        self.assertIn('Malformed MJML', str(cm.exception))
+
+    def test_multiplexed_async(self) -> None:
+        server = self._start(latency=(0.0, 0.1), seed=1)
+
+        async def render_all():
+            return await asyncio.gather(*(mjml_render_async(SOURCE.format(f'[async {i}]')) for i in range(20)))
+
+        for i, html in enumerate(asyncio.run(render_all())):
+            self.assertIn(f'[async {i}]', html)
+        self.assertEqual(server.stats['connections'], 1)
+        self.assertEqual(server.stats['multiplexed'], 20)
+
+    def test_old_server(self) -> None:
+        server = self._start(max_protocol=1)
+        for i in range(3):
+            self.assertIn(f'[old {i}]', mjml_render(SOURCE.format(f'[old {i}]')))
+        self.assertIn('[async]', asyncio.run(mjml_render_async(SOURCE.format('[async]'))))
+        self.assertEqual(tools._get_tcpserver_protocols(), {server.address: 1})
+        # the connection of the hello request is reused for renders, the hello is asked once per process
+        self.assertEqual(server.stats['connections'], 2)  # sync and async
+        self.assertEqual(server.stats['requests'], 5)
+        self.assertEqual(server.stats['multiplexed'], 0)
+
+    def test_protocol_1(self) -> None:
+        mjml_settings.MJML_TCPSERVER_PROTOCOL = 1
+        server = self._start()
+        mjml_render(SOURCE.format('[1]'))
+        self.assertEqual(server.stats['multiplexed'], 0)
+        self.assertEqual(tools._get_tcpserver_protocols(), {})
+
+    def test_timeout(self) -> None:
+        server = self._start(timeout_rate=1)
+        mjml_settings.MJML_READ_TIMEOUT = 0.2
+        with self.assertRaises(RuntimeError) as cm:
+            mjml_render(SOURCE.format('[timeout]'))
+        self.assertIn('no working server', str(cm.exception))
+        # the connection isn't broken by the lost response
+        server.timeout_rate = 0
+        self.assertIn('[ok]', mjml_render(SOURCE.format('[ok]')))
+        self.assertEqual(server.stats['connections'], 1)
+
+    def test_reconnect(self) -> None:
+        server = self._start()
+        mjml_render(SOURCE.format('[first]'))
+        conn = tools._get_tcpserver_connection(server.address, 1, 1)
+        server.close_connections()
+        deadline = time.monotonic() + 5
+        while not conn.closed and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(conn.closed)
+        self.assertIn('[second]', mjml_render(SOURCE.format('[second]')))
+        self.assertEqual(server.stats['connections'], 2)
+        self.assertIsNot(tools._get_tcpserver_connection(server.address, 1, 1), conn)
+
+    def test_closed_with_event_loop(self) -> None:
+        for protocol in (1, 'auto'):
+            mjml_settings.MJML_TCPSERVER_PROTOCOL = protocol
+            server = self._start()
+            for i in range(5):
+                self.assertIn(f'[loop {i}]', asyncio.run(mjml_render_async(SOURCE.format(f'[loop {i}]'))))
+            # connections of every event loop are closed on its shutdown instead of being kept with the loop
+            deadline = time.monotonic() + 5
+            while server._connections and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(server._connections, set())
+            self.assertEqual(server.stats['connections'], 5)
+            for key in (('async_tcpserver_pools', server.address), ('async_tcpserver_connections', server.address)):
+                self.assertEqual(tools._get_process_local(key, dict), {})
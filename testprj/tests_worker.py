@@ -0,0 +1,157 @@
+import asyncio
+import sys
+import threading
+import time
+
+from django.test import TestCase
+
+from mjml import settings as mjml_settings
+from mjml import tools
+from mjml.tools import mjml_render_async
+from testprj.tools import safe_change_mjml_settings, MJMLFixtures, render_tpl, get_mjml_version
+
+
+class TestMJMLWorkerMode(MJMLFixtures, TestCase):
+    _settings_manager = None
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls._settings_manager = safe_change_mjml_settings()
+        cls._settings_manager.__enter__()
+        mjml_settings.MJML_BACKEND_MODE = 'worker'
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        super().tearDownClass()
+        cls._settings_manager.__exit__(None, None, None)
+
+    def tearDown(self) -> None:
+        tools._get_worker_pool().close()
+        super().tearDown()
+
+    def test_simple(self) -> None:
+        html = render_tpl(self.TPLS['simple'])
+        self.assertIn('<html ', html)
+        self.assertIn('<body', html)
+        self.assertIn('20px ', html)
+        self.assertIn('Test title', html)
+        self.assertIn('Test button', html)
+
+        with self.assertRaises(RuntimeError):
+            render_tpl("""
+                {% mjml %}
+                    123
+                {% endmjml %}
+            """)
+
+    def test_large_tpl(self) -> None:
+        html = render_tpl(self.TPLS['with_text_context'], {
+            'text': '[START]' + ('1 2 3 4 5 6 7 8 9 0 ' * 410 * 1024) + '[END]',
+        })
+        self.assertIn('<html ', html)
+        self.assertIn('<body', html)
+        self.assertIn('[START]', html)
+        self.assertIn('[END]', html)
+
+    def test_unicode(self) -> None:
+        html = render_tpl(self.TPLS['with_text_context_and_unicode'], {
+            'text': self.TEXTS['unicode'],
+        })
+        self.assertIn('<html ', html)
+        self.assertIn('<body', html)
+        self.assertIn('Український текст', html)
+        self.assertIn(self.TEXTS['unicode'], html)
+        self.assertIn('©', html)
+
+    def test_reuse_process(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_WORKER_POOL_SIZE = 1
+            mjml_settings.MJML_WORKER_MAX_RENDERS = 3
+            worker = tools._get_worker_pool().workers[0]
+            pids = []
+            for i in range(4):
+                html = render_tpl(self.TPLS['with_text_context'], {'text': f'text {i}'})
+                self.assertIn(f'text {i}', html)
+                pids.append(worker._process.pid if worker.is_alive() else None)
+            self.assertEqual(pids[0], pids[1])
+            self.assertIsNone(pids[2])  # restarted after MJML_WORKER_MAX_RENDERS
+            self.assertIsNotNone(pids[3])
+            self.assertNotEqual(pids[0], pids[3])
+            tools._get_worker_pool().close()
+
+    def test_crash_recovery(self) -> None:
+        render_tpl(self.TPLS['simple'])
+        pool = tools._get_worker_pool()
+        for worker in pool.workers:
+            if worker.is_alive():
+                worker._process.kill()
+                worker._process.wait()
+        html = render_tpl(self.TPLS['simple'])
+        self.assertIn('Test title', html)
+
+    def test_node_is_not_available(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_WORKER_NODE_CMD = '/no_node_exec_test'
+            with self.assertRaises(RuntimeError):
+                render_tpl(self.TPLS['simple'])
+
+    def test_worker_exits(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_WORKER_NODE_CMD = ['node', '-e', 'process.exit(3)']
+            with self.assertRaises(RuntimeError) as cm:
+                render_tpl(self.TPLS['simple'])
+            self.assertIn('MJML worker process died unexpectedly', str(cm.exception))
+            tools._get_worker_pool().close()
+
+    def test_threads(self) -> None:
+        results = {}
+
+        def render(i: int) -> None:
+            results[i] = render_tpl(self.TPLS['with_text_context'], {'text': f'[thread {i}]'})
+
+        threads = [threading.Thread(target=render, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 8)
+        for i, html in results.items():
+            self.assertIn(f'[thread {i}]', html)
+
+    def test_async(self) -> None:
+        mjml_source = '<mjml><mj-body><mj-container><mj-text>{}</mj-text></mj-container></mj-body></mjml>'
+        if get_mjml_version() >= 4:
+            mjml_source = mjml_source.replace('<mj-container>', '').replace('</mj-container>', '')
+
+        async def render_all():
+            return await asyncio.gather(*(mjml_render_async(mjml_source.format(f'text {i}')) for i in range(10)))
+
+        results = asyncio.run(render_all())
+        for i, html in enumerate(results):
+            self.assertIn('<html ', html)
+            self.assertIn(f'text {i}', html)
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(mjml_render_async('<mjml><mj-body><mj-button></mj-body></mjml>'))
+
+    def test_hung_worker_is_killed_by_timeout(self) -> None:
+        with safe_change_mjml_settings():
+            mjml_settings.MJML_WORKER_NODE_CMD = [sys.executable, '-c', 'import time; time.sleep(100)']
+            mjml_settings.MJML_WORKER_POOL_SIZE = 1
+            mjml_settings.MJML_RENDER_TIMEOUT = 1
+            mjml_settings.MJML_FALLBACK_BACKEND_MODES = ['cmd']
+            worker = tools._get_worker_pool().workers[0]
+            started = time.monotonic()
+            html = render_tpl(self.TPLS['simple'])
+            self.assertLess(time.monotonic() - started, 10)  # 1s of the worker and the cmd render
+            self.assertIn('Test title', html)
+            self.assertFalse(worker.is_alive())
+
+            mjml_settings.MJML_FALLBACK_BACKEND_MODES = []
+            started = time.monotonic()
+            with self.assertRaises(RuntimeError) as cm:
+                render_tpl(self.TPLS['simple'])
+            self.assertLess(time.monotonic() - started, 2)
+            self.assertIn('has not responded in time', str(cm.exception))
+            tools._get_worker_pool().close()
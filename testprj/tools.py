@@ -1,7 +1,6 @@
 import copy
 import os
 import subprocess
-import time
 from contextlib import contextmanager, suppress
 from typing import Optional, Dict, Any
 from urllib.parse import urlparse
@@ -11,6 +10,7 @@ from django.template import Template, Context
 
 from mjml import settings as mjml_settings
 from mjml import tools
+from testprj.fakeserver import FakeMJMLServer, wait_for_server
 
 
 def get_mjml_version() -> int:
@@ -44,6 +44,26 @@ def safe_change_mjml_settings():
         tools._cache.clear()
 
 
+class MJMLSettingsMixin:
+    """
+    Mixin for TestCase: mjml settings can be changed in tests, they are restored after each test.
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        settings_manager = safe_change_mjml_settings()
+        settings_manager.__enter__()
+        self.addCleanup(settings_manager.__exit__, None, None, None)
+
+    def _start_server(self, server: FakeMJMLServer) -> FakeMJMLServer:
+        """
+        Start the fake server, it is stopped after the test.
+        """
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+
 def render_tpl(tpl: str, context: Optional[Dict[str, Any]] = None) -> str:
     if get_mjml_version() >= 4:
         tpl = tpl.replace('<mj-container>', '').replace('</mj-container>', '')
@@ -59,6 +79,7 @@ class MJMLServers:
         while cls._processes:
             p = cls._processes.pop()
             p.terminate()
+            p.wait()
 
     @classmethod
     def _start_tcp_servers(cls) -> None:
@@ -72,9 +93,9 @@ class MJMLServers:
                 tcpserver_path,
                 f'--port={port}',
                 f'--host={host}',
-            ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
             cls._processes.append(p)
-        time.sleep(5)
+            wait_for_server(host, port, process=p)
 
     @classmethod
     def _stop_tcp_servers(cls) -> None:
@@ -91,9 +112,9 @@ class MJMLServers:
                 f'--host={host}',
                 f'--port={port}',
                 '--max-body=8500kb',
-            ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
             cls._processes.append(p)
-        time.sleep(5)
+            wait_for_server(host, int(port), process=p)
 
     @classmethod
     def _stop_http_servers(cls) -> None:
@@ -4,10 +4,11 @@ import subprocess
 import shutil
 
 
-COMMANDS_LIST = ('testmanage', 'test', 'release')
+COMMANDS_LIST = ('testmanage', 'test', 'bench', 'release')
 COMMANDS_INFO = {
     'testmanage': 'run manage for test project',
     'test': 'run tests (eq. "testmanage test")',
+    'bench': 'run benchmark of backend modes (see "bench --help")',
     'release': 'make distributive and upload to pypi (setup.py bdist_wheel upload)'
 }
 
@@ -24,6 +25,16 @@ def test(*args):
     testmanage('test', *args)
 
 
+def bench(*args):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testprj.settings")
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testprj'))
+    import django
+    django.setup()
+    from testprj.bench import main
+    sys.exit(main(*args))
+
+
 def release(*args):
     root_dir = os.path.dirname(os.path.abspath(__file__))
     shutil.rmtree(os.path.join(root_dir, 'build'), ignore_errors=True)